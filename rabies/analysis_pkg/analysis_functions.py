@@ -1,62 +1,76 @@
 import numpy as np
-import nibabel as nb
 
 
-def seed_based_FC(bold_file, brain_mask, seed_list):
+def seed_based_FC(bold_file, brain_mask, seed_list, cache_dir=None):
     import os
-    import nibabel as nb
     import numpy as np
-    from rabies.analysis_pkg.analysis_functions import seed_corr
+    from rabies.preprocess_pkg.utils import hash_image
+    from rabies.analysis_pkg.analysis_functions import resample_seed, vcorrcoef_matrix
+    from rabies.analysis_pkg.utils import MaskIndex
 
     if len(seed_list)>0:
-        mask_array = np.asarray(nb.load(brain_mask).dataobj)
-        mask_vector = mask_array.reshape(-1)
-        mask_indices = (mask_vector==True)
-        mask_vector = mask_vector.astype(float)
-
-        corr_maps = np.zeros(list(mask_array.shape)+[len(seed_list)])
-        i = 0
-        for seed in seed_list:
-            mask_vector[mask_indices] = seed_corr(bold_file, brain_mask, seed)
-            corr_maps[:,:,:,i] = mask_vector.reshape(mask_array.shape)
-            i+=1
+        mask_index = MaskIndex(brain_mask)
+        # the mask is hashed once for all seeds
+        mask_hash = hash_image(brain_mask)
+
+        # the BOLD timeseries are loaded once, and the seed timecourses are all extracted from the same array
+        sub_timeseries = mask_index.gather_file(bold_file).T
+        seed_timeseries = np.zeros([sub_timeseries.shape[1], len(seed_list)], dtype=np.float32)
+        for i, seed in enumerate(seed_list):
+            seed_voxels = resample_seed(seed, brain_mask, cache_dir=cache_dir, mask_hash=mask_hash)
+            if len(seed_voxels) == 0:
+                print('The seed %s does not overlap with the brain mask.' % (seed))
+                continue
+            seed_timeseries[:, i] = sub_timeseries[seed_voxels].mean(axis=0)
+
+        # all seed maps are obtained from a single (voxels x T) @ (T x seeds) product
+        corrs = vcorrcoef_matrix(sub_timeseries, seed_timeseries)
 
         corr_map_file = os.path.abspath(os.path.basename(
             seed).split('.nii')[0]+'_corr_map.nii.gz')
-        nb.Nifti1Image(corr_maps, nb.load(brain_mask).affine, nb.load(
-            brain_mask).header).to_filename(corr_map_file)
+        mask_index.to_img(corrs.T.astype(np.float32)).to_filename(corr_map_file)
         return corr_map_file
     else:
         return None
 
 
-def seed_corr(bold_file, brain_mask, seed):
-    import os
-    from nilearn.input_data import NiftiMasker
+# seed indices computed within this process, keyed on the content of the seed and of the brain mask
+_seed_index_cache = {}
 
-    resampled = os.path.abspath('resampled.nii.gz')
+def resample_seed(seed, brain_mask, cache_dir=None, mask_hash=None):
+    # returns the indices of the seed voxels among the brain mask voxels, after resampling the seed onto the mask grid.
+    # the indices are cached in memory and in cache_dir if provided, so that each seed is only resampled once
+    # for all the scans sharing the same commonspace mask. mask_hash can provide the precomputed digest of the mask.
+    import os
+    import pathlib
+    import numpy as np
+    from rabies.preprocess_pkg.utils import hash_image
+    from rabies.analysis_pkg.utils import MaskIndex
+    if mask_hash is None:
+        mask_hash = hash_image(brain_mask)
+    key = hash_image(seed, extra=[mask_hash])
+
+    if key in _seed_index_cache:
+        return _seed_index_cache[key]
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'seed_%s.npy' % (key))
+        if os.path.isfile(cache_file):
+            _seed_index_cache[key] = np.load(cache_file)
+            return _seed_index_cache[key]
+
+    resampled = os.path.abspath(pathlib.Path(seed).name.rsplit(".nii")[0]+'_resampled.nii.gz')
     os.system('antsApplyTransforms -i %s -r %s -o %s -n GenericLabel' %
               (seed, brain_mask, resampled))
+    seed_voxels = np.flatnonzero(MaskIndex(brain_mask).gather_file(resampled) != 0)
 
-    masker = NiftiMasker(mask_img=nb.load(resampled), standardize=False, verbose=0)
-    # extract the voxel timeseries within the mask
-    voxel_seed_timeseries = masker.fit_transform(bold_file)
-    # take the mean ROI timeseries
-    seed_timeseries = np.mean(voxel_seed_timeseries, axis=1)
-
-    mask_array = np.asarray(nb.load(brain_mask).dataobj)
-    mask_vector = mask_array.reshape(-1)
-    mask_indices = (mask_vector==True)
-
-    timeseries_array = np.asarray(nb.load(bold_file).dataobj)
-    sub_timeseries = np.zeros([mask_indices.sum(), timeseries_array.shape[3]])
-    for t in range(timeseries_array.shape[3]):
-        sub_timeseries[:, t] = (
-            timeseries_array[:, :, :, t].reshape(-1))[mask_indices]
-
-    corrs = vcorrcoef(sub_timeseries, seed_timeseries)
-    corrs[np.isnan(corrs)] = 0
-    return corrs
+    _seed_index_cache[key] = seed_voxels
+    if cache_dir is not None:
+        # write to a temporary file first, since parallel nodes may populate the cache at the same time
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file+'.%s.tmp.npy' % (os.getpid())
+        np.save(tmp_file, seed_voxels)
+        os.replace(tmp_file, cache_file)
+    return seed_voxels
 
 
 def vcorrcoef(X, y):  # return a correlation between each row of X with y
@@ -68,6 +82,17 @@ def vcorrcoef(X, y):  # return a correlation between each row of X with y
     return r
 
 
+def vcorrcoef_matrix(X, Y):  # return the correlation between each row of X (voxels x time) with each column of Y (time x seeds)
+    X = X-X.mean(axis=1)[:, np.newaxis]
+    Y = Y-Y.mean(axis=0)[np.newaxis, :]
+    X_norm = np.sqrt((X**2).sum(axis=1))
+    Y_norm = np.sqrt((Y**2).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.dot(X, Y)/np.outer(X_norm, Y_norm)
+    r[~np.isfinite(r)] = 0
+    return r
+
+
 def get_CAPs(data, volumes, n_clusters):
     from sklearn.cluster import KMeans
     kmeans = KMeans(n_clusters=n_clusters, n_init=10, max_iter=300)
@@ -81,29 +106,15 @@ def get_CAPs(data, volumes, n_clusters):
 
 
 def recover_3D(mask_file, vector_map):
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-    volume = np.zeros(brain_mask.shape)
-    volume[volume_indices] = vector_map
-    volume_img = nb.Nifti1Image(volume, nb.load(
-        mask_file).affine, nb.load(mask_file).header)
-    return volume_img
+    # the volume keeps the dtype of vector_map
+    from rabies.analysis_pkg.utils import MaskIndex
+    return MaskIndex(mask_file).to_img(vector_map)
 
 
 def recover_3D_mutiple(mask_file, vector_maps):
     # vector maps of shape num_volumeXnum_voxel
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-    shape = (brain_mask.shape[0], brain_mask.shape[1],
-             brain_mask.shape[2], vector_maps.shape[0])
-    volumes = np.zeros(shape)
-    for i in range(vector_maps.shape[0]):
-        volume = volumes[:, :, :, i]
-        volume[volume_indices] = vector_maps[i, :]
-        volumes[:, :, :, i] = volume
-    volume_img = nb.Nifti1Image(volumes, nb.load(
-        mask_file).affine, nb.load(mask_file).header)
-    return volume_img
+    from rabies.analysis_pkg.utils import MaskIndex
+    return MaskIndex(mask_file).to_img(vector_maps)
 
 
 def threshold_maps(vector_maps, fraction):
@@ -124,73 +135,300 @@ FC matrix
 '''
 
 
-def run_FC_matrix(bold_file, mask_file, atlas, roi_type='parcellated'):
+def run_FC_matrix(bold_file, mask_file, atlas, roi_type='parcellated', FC_dtype='float32', top_k=0, threshold=None, max_mem_gb=1,
+                  atlas_list=[], cache_dir=None):
+    # if a list of atlases is provided, one matrix is derived for each atlas and lists of files are returned.
+    # Parcellated matrices are stored as float32 upper triangles in .npz files, together with the ROI labels
     import os
-    import pickle
+    import numpy as np
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
-    figname = os.path.abspath(filename_split[0]+'_FC_matrix.png')
 
-    from rabies.analysis_pkg.analysis_functions import parcellated_FC_matrix, voxelwise_FC_matrix, plot_matrix
+    from rabies.analysis_pkg.analysis_functions import parcellated_FC_matrix, voxelwise_FC_matrix, plot_matrix, resample_atlas
     if roi_type == 'parcellated':
-        corr_matrix = parcellated_FC_matrix(bold_file, atlas)
+        if len(atlas_list) > 0:
+            atlas_files = [resample_atlas(atlas_file, mask_file, cache_dir=cache_dir) for atlas_file in atlas_list]
+            atlas_names = [pathlib.Path(atlas_file).name.rsplit(".nii")[0] for atlas_file in atlas_list]
+            prefixes = [filename_split[0]+'_'+atlas_name for atlas_name in atlas_names]
+        else:
+            atlas_files = [atlas]
+            atlas_names = ['labels']
+            prefixes = [filename_split[0]]
+        # the timeseries are read once for all atlases
+        corr_matrices = parcellated_FC_matrix(bold_file, atlas_files)
     elif roi_type == 'voxelwise':
-        corr_matrix = voxelwise_FC_matrix(bold_file, mask_file)
+        # the voxelwise matrix is written to disk block by block, and only a subset of voxels is displayed
+        figname = os.path.abspath(filename_split[0]+'_FC_matrix.png')
+        data_file, plot_matrix_array = voxelwise_FC_matrix(bold_file, mask_file, os.path.abspath(filename_split[0]),
+                                                           FC_dtype=FC_dtype, top_k=top_k, threshold=threshold, max_mem_gb=max_mem_gb)
+        plot_matrix(figname, plot_matrix_array)
+        return data_file, figname
     else:
         raise ValueError(
             "Invalid --ROI_type provided: %s. Must be either 'parcellated' or 'voxelwise.'" % (roi_type))
-    plot_matrix(figname, corr_matrix)
-
-    data_file = os.path.abspath(filename_split[0]+'_FC_matrix.pkl')
-    with open(data_file, 'wb') as handle:
-        pickle.dump(corr_matrix, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    return data_file, figname
-
-
-def voxelwise_FC_matrix(bold_file, mask_file):
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-
-    timeseries_array = np.asarray(nb.load(bold_file).dataobj)
-    sub_timeseries = np.zeros(
-        [timeseries_array.shape[3], volume_indices.sum()])
-    for t in range(timeseries_array.shape[3]):
-        sub_timeseries[t, :] = timeseries_array[:, :, :, t][volume_indices]
-
-    corr_matrix = np.corrcoef(sub_timeseries.T)
-    return corr_matrix
-
-
-def extract_timeseries(bold_file, atlas):
-    from nilearn.input_data import NiftiMasker
-    atlas_img = nb.load(atlas)
-    atlas_data = np.asarray(atlas_img.dataobj)
-    max_int = atlas_data.max()
-
-    timeseries_dict = {}
-    for i in range(1, max_int+1):
-        if np.max(i == atlas_data):  # taking a ROI only if it has labeled voxels
-            roi_mask = np.asarray(atlas_data == i, dtype=int)
-            roi_mask_nb = nb.Nifti1Image(roi_mask, nb.load(
-                atlas).affine, nb.load(atlas).header)
-            masker = NiftiMasker(mask_img=roi_mask_nb,
-                                 standardize=False, verbose=0)
-            # extract the voxel timeseries within the mask
-            voxel_timeseries = masker.fit_transform(bold_file)
-            # take the mean ROI timeseries
-            roi_timeseries = np.mean(voxel_timeseries, axis=1)
-            timeseries_dict[str(i)] = roi_timeseries
-    return timeseries_dict
-
-
-def parcellated_FC_matrix(bold_file, atlas):
-    timeseries_dict = extract_timeseries(bold_file, atlas)
-    roi_labels = timeseries_dict.keys()
-    sub_timeseries = []
-    for roi in roi_labels:
-        sub_timeseries.append(timeseries_dict[roi])
-    corr_matrix = np.corrcoef(sub_timeseries)
-    return corr_matrix
+
+    data_files = []
+    fignames = []
+    for prefix, atlas_name, (roi_labels, corr_matrix) in zip(prefixes, atlas_names, corr_matrices):
+        figname = os.path.abspath(prefix+'_FC_matrix.png')
+        plot_matrix(figname, corr_matrix)
+
+        data_file = os.path.abspath(prefix+'_FC_matrix.npz')
+        np.savez(data_file, upper_triangle=corr_matrix[np.triu_indices(len(roi_labels), 1)].astype(np.float32),
+                 labels=roi_labels, atlas=atlas_name)
+        data_files.append(data_file)
+        fignames.append(figname)
+    if len(atlas_list) == 0:
+        return data_files[0], fignames[0]
+    return data_files, fignames
+
+
+def voxelwise_FC_matrix(bold_file, mask_file, prefix, FC_dtype='float32', top_k=0, threshold=None, max_mem_gb=1, num_plot_voxels=1000):
+    '''
+    Computes the correlation between all pairs of voxels in blocks of rows, so that the full matrix is never held in memory.
+    The size of the blocks is chosen to fit within max_mem_gb. Depending on the options, the output is either
+        -the upper triangle (excluding the diagonal) as a 1D memory-mapped .npy array, stored row by row in the
+         order of np.triu_indices(num_voxels, 1)
+        -the top_k most correlated voxels for each voxel, as 'indices' and 'values' arrays in a .npz file
+        -the pairs of voxels (i<j) with an absolute correlation above threshold, as 'rows', 'cols' and 'values' arrays in a .npz file
+    Returns the output file, and the matrix for a subset of voxels for display.
+    '''
+    import numpy as np
+    from rabies.analysis_pkg.utils import MaskIndex
+
+    if top_k > 0 and threshold is not None:
+        raise ValueError("Only one of --FC_top_k and --FC_threshold can be selected.")
+    out_dtype = np.dtype(FC_dtype)
+
+    # the timeseries are standardized to unit norm, so that correlations are obtained from dot products
+    sub_timeseries = MaskIndex(mask_file).gather_file(bold_file).T
+    num_voxels = sub_timeseries.shape[0]
+    sub_timeseries -= sub_timeseries.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt((sub_timeseries**2).sum(axis=1))
+    norm[norm == 0] = 1
+    sub_timeseries /= norm[:, np.newaxis]
+
+    # each row of a block requires the float32 products, a boolean or int64 index buffer, and the output values
+    row_bytes = num_voxels*(4+8+out_dtype.itemsize)
+    available = max_mem_gb*1024**3 - sub_timeseries.nbytes - 2*row_bytes
+    if available < row_bytes:
+        raise ValueError("The voxelwise FC matrix requires more than %s GB for %s voxels. Increase --FC_mem_gb."
+                         % (max_mem_gb, num_voxels))
+    block_size = int(min(available // row_bytes, num_voxels))
+
+    if top_k > 0:
+        top_k = min(top_k, num_voxels-1)
+        indices = np.zeros([num_voxels, top_k], dtype=np.int32)
+        values = np.zeros([num_voxels, top_k], dtype=out_dtype)
+        for start in range(0, num_voxels, block_size):
+            stop = min(start+block_size, num_voxels)
+            block = np.dot(sub_timeseries[start:stop], sub_timeseries.T)
+            block[np.arange(stop-start), np.arange(start, stop)] = -np.inf  # exclude the voxel itself
+            idx = np.argpartition(block, -top_k, axis=1)[:, -top_k:]
+            val = np.take_along_axis(block, idx, axis=1)
+            order = np.argsort(-val, axis=1)
+            indices[start:stop] = np.take_along_axis(idx, order, axis=1)
+            values[start:stop] = np.take_along_axis(val, order, axis=1)
+        data_file = prefix+'_FC_topk.npz'
+        np.savez(data_file, indices=indices, values=values)
+    elif threshold is not None:
+        rows, cols, data = [], [], []
+        for start in range(0, num_voxels, block_size):
+            stop = min(start+block_size, num_voxels)
+            block = np.dot(sub_timeseries[start:stop], sub_timeseries[start:].T)
+            upper = np.arange(block.shape[1])[np.newaxis, :] > np.arange(stop-start)[:, np.newaxis]
+            row, col = np.nonzero(upper & (np.abs(block) >= threshold))
+            rows.append((row+start).astype(np.int32))
+            cols.append((col+start).astype(np.int32))
+            data.append(block[row, col].astype(out_dtype))
+        data_file = prefix+'_FC_sparse.npz'
+        np.savez(data_file, rows=np.concatenate(rows), cols=np.concatenate(cols), values=np.concatenate(data),
+                 num_voxels=num_voxels)
+    else:
+        data_file = prefix+'_FC_matrix.npy'
+        num_pairs = num_voxels*(num_voxels-1)//2
+        upper_triangle = np.lib.format.open_memmap(data_file, mode='w+', dtype=out_dtype, shape=(num_pairs,))
+        for start in range(0, num_voxels, block_size):
+            stop = min(start+block_size, num_voxels)
+            block = np.dot(sub_timeseries[start:stop], sub_timeseries[start:].T)
+            upper = np.arange(block.shape[1])[np.newaxis, :] > np.arange(stop-start)[:, np.newaxis]
+            # the rows of the block are contiguous in the packed upper triangle
+            offset = start*num_voxels - start*(start+1)//2
+            values = block[upper]
+            upper_triangle[offset:offset+len(values)] = values
+            upper_triangle.flush()
+        del upper_triangle
+
+    # the matrix for an evenly spaced subset of voxels is returned for display
+    plot_idx = np.unique(np.linspace(0, num_voxels-1, min(num_plot_voxels, num_voxels)).astype(int))
+    plot_matrix_array = np.dot(sub_timeseries[plot_idx], sub_timeseries[plot_idx].T)
+    return data_file, plot_matrix_array
+
+
+def resample_atlas(atlas, brain_mask, cache_dir=None):
+    # resamples a label image onto the grid of the brain mask. The resampled file is cached in cache_dir if provided,
+    # keyed on the content of the atlas and on the grid of the mask, so that each atlas is only resampled once for the dataset
+    import os
+    import pathlib
+    import nibabel as nb
+    from rabies.preprocess_pkg.utils import hash_image, run_command
+    mask_img = nb.load(brain_mask)
+    key = hash_image(atlas, extra=[mask_img.shape, mask_img.affine.tolist()])
+
+    if cache_dir is None:
+        resampled = os.path.abspath(pathlib.Path(atlas).name.rsplit(".nii")[0]+'_resampled.nii.gz')
+    else:
+        resampled = os.path.join(cache_dir, 'atlas_%s.nii.gz' % (key))
+        if os.path.isfile(resampled):
+            return resampled
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # write to a temporary file first, since parallel nodes may populate the cache at the same time
+    tmp_file = resampled.rsplit('.nii')[0]+'.%s.tmp.nii.gz' % (os.getpid())
+    command = 'antsApplyTransforms -i %s -r %s -o %s -n GenericLabel' % (atlas, brain_mask, tmp_file)
+    error_message = "The resampling of the atlas %s onto the brain mask %s failed." % (atlas, brain_mask)
+    try:
+        rc = run_command(command)
+    except Exception as e:
+        raise ValueError(error_message) from e
+    if not rc == 0 or not os.path.isfile(tmp_file):
+        raise ValueError(error_message)
+    os.replace(tmp_file, resampled)
+    return resampled
+
+
+# averaging operators computed within this process, keyed on the content of the atlas
+_atlas_operator_cache = {}
+
+def atlas_operator(atlas):
+    # returns the atlas labels, the boolean volume of labeled voxels, and a sparse (labels x labeled voxels)
+    # matrix averaging the voxels of each label
+    import numpy as np
+    import nibabel as nb
+    import scipy.sparse
+    from rabies.preprocess_pkg.utils import hash_image
+    key = hash_image(atlas)
+    if key in _atlas_operator_cache:
+        return _atlas_operator_cache[key]
+
+    atlas_data = np.rint(np.asarray(nb.load(atlas).dataobj)).astype(np.int64)
+    labeled_voxels = atlas_data > 0
+    roi_labels, inverse, counts = np.unique(
+        atlas_data[labeled_voxels], return_inverse=True, return_counts=True)
+    operator = scipy.sparse.csr_matrix(((1.0/counts[inverse]).astype(np.float32), (inverse, np.arange(len(inverse)))),
+                                       shape=(len(roi_labels), len(inverse)))
+    _atlas_operator_cache[key] = (roi_labels, labeled_voxels, operator)
+    return _atlas_operator_cache[key]
+
+
+def extract_timeseries(bold_file, atlas_list):
+    # returns, for each atlas, the labels with the mean timeseries of each label (labels x time).
+    # The timeseries are read once, and each chunk of timepoints is shared across atlases
+    import numpy as np
+    import nibabel as nb
+    from rabies.analysis_pkg.analysis_functions import atlas_operator
+    operators = [atlas_operator(atlas) for atlas in atlas_list]
+
+    img = nb.load(bold_file)
+    num_timepoints = img.shape[3]
+    roi_timeseries_list = [np.zeros([len(roi_labels), num_timepoints], dtype=np.float32)
+                           for roi_labels, labeled_voxels, operator in operators]
+    for start in range(0, num_timepoints, 50):
+        stop = min(start+50, num_timepoints)
+        timeseries_chunk = np.asarray(img.dataobj[:, :, :, start:stop])
+        for (roi_labels, labeled_voxels, operator), roi_timeseries in zip(operators, roi_timeseries_list):
+            roi_timeseries[:, start:stop] = operator.dot(
+                timeseries_chunk[labeled_voxels].astype(np.float32))
+    return [(roi_labels, roi_timeseries) for (roi_labels, labeled_voxels, operator), roi_timeseries in zip(operators, roi_timeseries_list)]
+
+
+def parcellated_FC_matrix(bold_file, atlas_list):
+    # returns the labels and the correlation matrix for each atlas
+    corr_matrices = []
+    for roi_labels, roi_timeseries in extract_timeseries(bold_file, atlas_list):
+        corr_matrices.append((roi_labels, np.corrcoef(roi_timeseries)))
+    return corr_matrices
+
+
+def load_FC_matrix(data_file):
+    # returns the ROI labels and the full correlation matrix from a parcellated FC matrix .npz file
+    data = np.load(data_file)
+    roi_labels = data['labels']
+    corr_matrix = np.eye(len(roi_labels), dtype=np.float32)
+    corr_matrix[np.triu_indices(len(roi_labels), 1)] = data['upper_triangle']
+    corr_matrix.T[np.triu_indices(len(roi_labels), 1)] = data['upper_triangle']
+    return roi_labels, corr_matrix
+
+
+def stack_FC_matrices(data_file_list):
+    '''
+    Stacks the parcellated FC matrices of all scans, for each atlas, into a memory-mapped (scans x edges) float32 .npy
+    array, and derives the group mean and variance of the Fisher z-transformed correlations in a single streaming pass
+    over the scans. The group statistics are saved in a .npz file with the ROI labels and the list of stacked files.
+    Scans may have different ROI labels (e.g. native space atlases with ROIs falling outside of the mask): the edges
+    are then defined over the union of the labels, edges missing from a scan are NaN in the stack, and the group
+    statistics of each edge are computed over the scans where it is present.
+    '''
+    import os
+    import numpy as np
+    from nipype import logging
+    from rabies.preprocess_pkg.utils import flatten_list
+    log = logging.getLogger('nipype.workflow')
+    data_file_list = flatten_list(list(data_file_list))
+
+    # scans are grouped by atlas
+    atlas_files = {}
+    for data_file in data_file_list:
+        atlas_name = str(np.load(data_file)['atlas'])
+        atlas_files.setdefault(atlas_name, []).append(data_file)
+
+    stack_files = []
+    stats_files = []
+    for atlas_name in sorted(atlas_files.keys()):
+        file_list = sorted(atlas_files[atlas_name])
+        label_list = [np.load(data_file)['labels'] for data_file in file_list]
+        roi_labels = np.unique(np.concatenate(label_list))
+        num_rois = len(roi_labels)
+        num_edges = num_rois*(num_rois-1)//2
+        if not all([np.array_equal(labels, roi_labels) for labels in label_list]):
+            log.warning("The ROI labels from %s differ across scans. The FC matrices are stacked over the union of "
+                        "%i labels, and missing edges are set to NaN." % (atlas_name, num_rois))
+        # index of each edge within the upper triangle of the union of labels
+        edge_index = np.zeros((num_rois, num_rois), dtype=int)
+        edge_index[np.triu_indices(num_rois, 1)] = np.arange(num_edges)
+        edge_index = np.maximum(edge_index, edge_index.T)
+
+        stack_file = os.path.abspath('%s_FC_matrices.npy' % (atlas_name))
+        stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=np.float32, shape=(len(file_list), num_edges))
+        # running count, mean and sum of squared deviations (Welford) of the Fisher z-transformed correlations
+        count = np.zeros(num_edges)
+        mean = np.zeros(num_edges)
+        M2 = np.zeros(num_edges)
+        for i, (data_file, labels) in enumerate(zip(file_list, label_list)):
+            upper_triangle = np.load(data_file)['upper_triangle']
+            positions = np.searchsorted(roi_labels, labels)
+            rows, cols = np.triu_indices(len(labels), 1)
+            edges = edge_index[positions[rows], positions[cols]]
+            stack[i, :] = np.nan
+            stack[i, edges] = upper_triangle
+            z = np.arctanh(np.clip(upper_triangle.astype(np.float64), -0.999999, 0.999999))
+            count[edges] += 1
+            delta = z-mean[edges]
+            mean[edges] += delta/count[edges]
+            M2[edges] += delta*(z-mean[edges])
+        stack.flush()
+        del stack
+        # as nanmean and nanvar, the statistics are NaN for edges without enough scans
+        mean[count == 0] = np.nan
+        var = np.full(num_edges, np.nan)
+        var[count > 1] = M2[count > 1]/(count[count > 1]-1)
+
+        stats_file = os.path.abspath('%s_FC_group_stats.npz' % (atlas_name))
+        np.savez(stats_file, mean_z=mean.astype(np.float32), var_z=var.astype(np.float32),
+                 num_scans=count.astype(np.int32), labels=roi_labels, files=np.array(file_list))
+        stack_files.append(stack_file)
+        stats_files.append(stats_file)
+    return stack_files, stats_files
 
 
 def plot_matrix(filename, corr_matrix):
@@ -211,19 +449,28 @@ ICA
 '''
 
 
-def run_group_ICA(bold_file_list, mask_file, dim, tr):
+def run_group_ICA(bold_file_list, mask_file, dim, tr, engine='melodic', migp_dim=0):
     import os
     import pandas as pd
 
-    # create a filelist.txt
-    file_path = os.path.abspath('filelist.txt')
     from rabies.preprocess_pkg.utils import flatten_list
     merged = flatten_list(list(bold_file_list))
+    out_dir = os.path.abspath('group_melodic.ica')
+
+    if engine == 'migp':
+        from rabies.analysis_pkg.analysis_functions import migp_group_ICA
+        IC_file = migp_group_ICA(merged, mask_file, dim, out_dir, migp_dim=migp_dim)
+        return out_dir, IC_file
+    elif not engine == 'melodic':
+        raise ValueError(
+            "Invalid --group_ICA_engine provided: %s. Must be either 'melodic' or 'migp'." % (engine))
+
+    # create a filelist.txt
+    file_path = os.path.abspath('filelist.txt')
     df = pd.DataFrame(data=merged)
     df.to_csv(file_path, header=False, sep=',', index=False)
 
     from rabies.preprocess_pkg.utils import run_command
-    out_dir = os.path.abspath('group_melodic.ica')
     command = 'melodic -i %s -m %s -o %s --tr=%s -d %s --report' % (
         file_path, mask_file, out_dir, tr, dim)
     rc = run_command(command)
@@ -231,18 +478,91 @@ def run_group_ICA(bold_file_list, mask_file, dim, tr):
     return out_dir, IC_file
 
 
-def run_DR_ICA(bold_file, mask_file, IC_file):
+def migp(bold_file_list, mask_file, migp_dim):
+    '''
+    MELODIC's Incremental Group PCA (Smith et al. 2014). Scans are streamed one at a time: the demeaned and variance
+    normalized timeseries of a scan are appended to the current (migp_dim x voxels) estimate, which is then reduced
+    back to its migp_dim strongest eigenvectors. Memory is thus bounded by a single scan and the MIGP estimate,
+    independently of the number of scans. Returns the (migp_dim x voxels) float32 estimate.
+    '''
+    import numpy as np
+    from rabies.analysis_pkg.utils import MaskIndex
+    mask_index = MaskIndex(mask_file)
+
+    W = None
+    for bold_file in bold_file_list:
+        timeseries = mask_index.gather_file(bold_file)
+        timeseries -= timeseries.mean(axis=0)
+        std = timeseries.std(axis=0)
+        std[std == 0] = 1
+        timeseries /= std
+
+        W = timeseries if W is None else np.concatenate((W, timeseries), axis=0)
+        if W.shape[0] > migp_dim:
+            # project onto the strongest temporal eigenvectors of the concatenated data
+            eigenvalues, eigenvectors = np.linalg.eigh(np.dot(W, W.T).astype(np.float64))
+            U = eigenvectors[:, ::-1][:, :migp_dim].astype(np.float32)
+            W = np.dot(U.T, W)
+    return W
+
+
+def migp_group_ICA(bold_file_list, mask_file, dim, out_dir, migp_dim=0, random_state=0):
+    # group-ICA computed in-process from the MIGP estimate, with a spatial FastICA on the dim strongest components.
+    # The IC maps are written as melodic_IC.nii.gz in out_dir, in the same format as MELODIC.
     import os
-    import pickle
+    import numpy as np
+    import nibabel as nb
+    from sklearn.decomposition import FastICA
+    from rabies.analysis_pkg.analysis_functions import migp
+    from rabies.analysis_pkg.utils import MaskIndex
+
+    if dim <= 0:
+        raise ValueError("The number of components must be specified with --dim to run group-ICA with MIGP.")
+    if migp_dim <= 0:
+        # by default, the internal MIGP dimension is the length of one scan, and at least twice the number of components
+        migp_dim = max(2*dim, nb.load(bold_file_list[0]).shape[3])
+    W = migp(bold_file_list, mask_file, migp_dim)
+    num_voxels = W.shape[1]
+    if W.shape[0] < dim:
+        raise ValueError("The dataset only provides %s timepoints, which is less than the %s components requested."
+                         % (W.shape[0], dim))
+
+    # whitened spatial PCA maps from the strongest eigenvectors of the MIGP estimate
+    eigenvalues, eigenvectors = np.linalg.eigh(np.dot(W, W.T).astype(np.float64))
+    eigenvalues = eigenvalues[::-1][:dim]
+    eigenvectors = eigenvectors[:, ::-1][:, :dim]
+    whitened = np.dot(W.T, (eigenvectors/np.sqrt(eigenvalues)).astype(np.float32))*np.sqrt(num_voxels)
+
+    ica = FastICA(whiten=False, max_iter=500, tol=1e-4, random_state=random_state)
+    sources = ica.fit_transform(whitened)
+
+    # components are ordered by the variance they explain in the MIGP estimate, with a positive skew
+    loadings = np.dot(eigenvectors*np.sqrt(eigenvalues), ica.mixing_)
+    order = np.argsort((loadings**2).sum(axis=0))[::-1]
+    sources = sources[:, order]
+    sources = (sources-sources.mean(axis=0))/sources.std(axis=0)
+    sign = np.sign((sources.astype(np.float64)**3).sum(axis=0))
+    sign[sign == 0] = 1
+    sources *= sign.astype(np.float32)
+
+    os.makedirs(out_dir, exist_ok=True)
+    IC_file = out_dir+'/melodic_IC.nii.gz'
+    MaskIndex(mask_file).to_img(sources.T.astype(np.float32)).to_filename(IC_file)
+    return IC_file
+
+
+def run_DR_ICA(bold_file, mask_file, IC_file, cache_dir=None):
+    import os
+    import numpy as np
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
 
     from rabies.analysis_pkg.analysis_functions import sub_DR_ICA, recover_3D_mutiple
-    sub_ICs = sub_DR_ICA(bold_file, mask_file, IC_file)
+    sub_ICs = sub_DR_ICA(bold_file, mask_file, IC_file, cache_dir=cache_dir)
 
-    data_file = os.path.abspath(filename_split[0]+'_DR_ICA.pkl')
-    with open(data_file, 'wb') as handle:
-        pickle.dump(sub_ICs, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # the subject's IC vectors (num_ICs x num_voxels) are saved as a float32 .npy array
+    data_file = os.path.abspath(filename_split[0]+'_DR_ICA.npy')
+    np.save(data_file, sub_ICs.astype(np.float32))
 
     # save the subjects' IC maps as .nii file
     nii_file = os.path.abspath(filename_split[0]+'_DR_ICA.nii.gz')
@@ -250,25 +570,64 @@ def run_DR_ICA(bold_file, mask_file, IC_file):
     return data_file, nii_file
 
 
-def sub_DR_ICA(bold_file, mask_file, IC_file):
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
+def batch_DR_ICA(bold_file_list, mask_file, IC_file, cache_dir=None):
+    # runs dual regression on a list of scans within a single process, where the first-stage operator is only computed once
+    from rabies.analysis_pkg.analysis_functions import run_DR_ICA
+    data_files = []
+    nii_files = []
+    for bold_file in bold_file_list:
+        data_file, nii_file = run_DR_ICA(bold_file, mask_file, IC_file, cache_dir=cache_dir)
+        data_files.append(data_file)
+        nii_files.append(nii_file)
+    return data_files, nii_files
 
-    timeseries_array = np.asarray(nb.load(bold_file).dataobj)
-    sub_timeseries = np.zeros(
-        [timeseries_array.shape[3], volume_indices.sum()])
-    for t in range(timeseries_array.shape[3]):
-        sub_timeseries[t, :] = timeseries_array[:, :, :, t][volume_indices]
 
-    all_IC_array = np.asarray(nb.load(IC_file).dataobj)
-    all_IC_vectors = np.zeros([all_IC_array.shape[3], volume_indices.sum()])
-    for i in range(all_IC_array.shape[3]):
-        all_IC_vectors[i, :] = (all_IC_array[:, :, :, i])[volume_indices]
+def sub_DR_ICA(bold_file, mask_file, IC_file, cache_dir=None):
+    from rabies.analysis_pkg.analysis_functions import get_DR_operator
+    from rabies.analysis_pkg.utils import MaskIndex
+    operator = get_DR_operator(IC_file, mask_file, cache_dir=cache_dir)
 
-    sub_ICs = dual_regression(all_IC_vectors, sub_timeseries)
+    # timeseries of shape num_timepointsxnum_voxels
+    sub_timeseries = MaskIndex(mask_file).gather_file(bold_file)
+
+    sub_ICs = dual_regression(None, sub_timeseries, operator=operator)
     return sub_ICs
 
 
+# first-stage operators computed within this process, keyed on the content of the IC file and of the mask
+_DR_operator_cache = {}
+
+def get_DR_operator(IC_file, mask_file, cache_dir=None):
+    # returns the first-stage dual regression operator for the ICs within the mask. It only depends on the
+    # group ICs, and is cached in memory and in cache_dir if provided, so that it is shared across all scans
+    import os
+    import numpy as np
+    from rabies.preprocess_pkg.utils import hash_image
+    from rabies.analysis_pkg.analysis_functions import DR_operator
+    from rabies.analysis_pkg.utils import MaskIndex
+    key = hash_image(IC_file, extra=[hash_image(mask_file)])
+
+    if key in _DR_operator_cache:
+        return _DR_operator_cache[key]
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'DR_operator_%s.npy' % (key))
+        if os.path.isfile(cache_file):
+            _DR_operator_cache[key] = np.load(cache_file)
+            return _DR_operator_cache[key]
+
+    all_IC_vectors = MaskIndex(mask_file).gather_file(IC_file)
+    operator = DR_operator(all_IC_vectors)
+
+    _DR_operator_cache[key] = operator
+    if cache_dir is not None:
+        # write to a temporary file first, since parallel nodes may populate the cache at the same time
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file+'.%s.tmp.npy' % (os.getpid())
+        np.save(tmp_file, operator)
+        os.replace(tmp_file, cache_file)
+    return operator
+
+
 '''
 LINEAR REGRESSION --- CLOSED-FORM SOLUTION
 '''
@@ -288,29 +647,33 @@ def mse(X, Y, w):
     return np.mean((Y-np.matmul(X, w))**2)
 
 
-def dual_regression(IC_vectors, timeseries):
+def DR_operator(IC_vectors):
+    # IC_vectors is of shape num_ICxnum_voxels
+    # returns the least squares operator (num_ICxnum_voxels) of the spatially centered group ICs
+    X = IC_vectors.transpose().astype(np.float64)
+    X = X-X.mean(axis=0)
+    return np.linalg.inv(X.transpose().dot(X)).dot(X.transpose()).astype(np.float32)
+
+
+def dual_regression(IC_vectors, timeseries, operator=None):
     # IC_vectors is of shape num_ICxnum_voxels
     # timeseries is of shape num_timepointsxnum_voxels
-    X = IC_vectors.transpose()
-    Y = timeseries.transpose()
+    # the first-stage operator can be provided to avoid recomputing it from the IC_vectors for every subject
 
     # spatial and temporal centering of the matrices as suggested here https://mandymejia.com/2018/03/29/the-role-of-centering-in-dual-regression/#:~:text=Dual%20regression%20requires%20centering%20across%20time%20and%20space&text=time%20points.,each%20time%20course%20at%20zero).
     # spatial centering of the group ICs
-    X = X-X.mean(axis=0)
-    # spatial and temporal centering of the timeseries
-    Y = Y-Y.mean(axis=0)
-    Y = (Y.T-Y.mean(axis=1)).T
+    if operator is None:
+        operator = DR_operator(IC_vectors)
+    # since the operator rows sum to zero over voxels, the spatial centering of the timeseries has no effect,
+    # and the temporal centering can be applied on the estimated timecourses
 
     # for one given volume, it's values can be expressed through a linear combination of the components ()
-    w = closed_form(X, Y, intercept=False)
+    w = np.dot(operator, timeseries.transpose())
+    w = (w.T-w.mean(axis=1)).T
 
     # normalize the component timecourses to unit variance
-    std = w.std(axis=1)
-    for i in range(w.shape[0]):
-        w[i, :] = w[i, :]/std[i]
+    w = (w.T/w.std(axis=1)).T
 
     # for a given voxel timeseries, it's signal can be explained a linear combination of the component timecourses
-    X = w.transpose()
-    Y = timeseries
     # return recovered components of dim num_ICsxnum_voxels
-    return closed_form(X, Y, intercept=False)
+    return np.dot(np.linalg.inv(w.dot(w.T)).dot(w).astype(timeseries.dtype), timeseries)
@@ -6,7 +6,7 @@ from nipype import Function
 from .analysis_functions import run_group_ICA, run_DR_ICA, run_FC_matrix, seed_based_FC
 
 
-def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf"):
+def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], cache_dir=None, name="analysis_wf"):
 
     workflow = pe.Workflow(name=name)
     subject_inputnode = pe.Node(niu.IdentityInterface(
@@ -30,11 +30,12 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
         if not commonspace_cr:
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run seed-based analysis. Try running confound regression again with --commonspace_bold.')
-        seed_based_FC_node = pe.Node(Function(input_names=['bold_file', 'brain_mask', 'seed_list'],
+        seed_based_FC_node = pe.Node(Function(input_names=['bold_file', 'brain_mask', 'seed_list', 'cache_dir'],
                                               output_names=['corr_map_file'],
                                               function=seed_based_FC),
                                      name='seed_based_FC', mem_gb=1)
         seed_based_FC_node.inputs.seed_list = seed_list
+        seed_based_FC_node.inputs.cache_dir = os.path.join(cache_dir, 'seeds') if cache_dir is not None else None
 
         workflow.connect([
             (subject_inputnode, seed_based_FC_node, [
@@ -53,10 +54,12 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run dual regression. Try running confound regression again with --commonspace_bold.')
 
-        DR_ICA = pe.Node(Function(input_names=['bold_file', 'mask_file', 'IC_file'],
+        DR_ICA = pe.Node(Function(input_names=['bold_file', 'mask_file', 'IC_file', 'cache_dir'],
                                   output_names=['data_file', 'nii_file'],
                                   function=run_DR_ICA),
                          name='DR_ICA', mem_gb=1)
+        # the first-stage operator is shared across scans through the dataset cache
+        DR_ICA.inputs.cache_dir = os.path.join(cache_dir, 'DR_operators') if cache_dir is not None else None
 
         workflow.connect([
             (subject_inputnode, DR_ICA, [
@@ -82,12 +85,14 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
         if not commonspace_cr:
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run group-ICA. Try running confound regression again with --commonspace_bold.')
-        group_ICA = pe.Node(Function(input_names=['bold_file_list', 'mask_file', 'dim', 'tr'],
+        group_ICA = pe.Node(Function(input_names=['bold_file_list', 'mask_file', 'dim', 'tr', 'engine', 'migp_dim'],
                                      output_names=['out_dir', 'IC_file'],
                                      function=run_group_ICA),
                             name='group_ICA', mem_gb=1)
         group_ICA.inputs.tr = float(opts.TR.split('s')[0])
         group_ICA.inputs.dim = opts.dim
+        group_ICA.inputs.engine = opts.group_ICA_engine
+        group_ICA.inputs.migp_dim = opts.migp_dim
 
         workflow.connect([
             (group_inputnode, group_ICA, [
@@ -107,12 +112,22 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
                     ]),
                 ])
 
-    if opts.FC_matrix:
-        FC_matrix = pe.Node(Function(input_names=['bold_file', 'mask_file', 'atlas', 'roi_type'],
+    if opts.FC_matrix is not None:
+        if len(opts.FC_matrix) > 0 and not commonspace_cr:
+            raise ValueError(
+                'Outputs from confound regression must be in commonspace to use atlases provided with --FC_matrix. Try running confound regression again with --commonspace_bold.')
+        # the voxelwise matrix is computed in blocks fitting within --FC_mem_gb, which is declared to the scheduler
+        FC_matrix = pe.Node(Function(input_names=['bold_file', 'mask_file', 'atlas', 'roi_type', 'FC_dtype', 'top_k', 'threshold', 'max_mem_gb', 'atlas_list', 'cache_dir'],
                                      output_names=['data_file', 'figname'],
                                      function=run_FC_matrix),
-                            name='FC_matrix', mem_gb=1)
+                            name='FC_matrix', mem_gb=opts.FC_mem_gb if opts.ROI_type == 'voxelwise' else 1)
         FC_matrix.inputs.roi_type = opts.ROI_type
+        FC_matrix.inputs.FC_dtype = opts.FC_dtype
+        FC_matrix.inputs.top_k = opts.FC_top_k
+        FC_matrix.inputs.threshold = opts.FC_threshold
+        FC_matrix.inputs.max_mem_gb = opts.FC_mem_gb
+        FC_matrix.inputs.atlas_list = [os.path.abspath(atlas) for atlas in opts.FC_matrix]
+        FC_matrix.inputs.cache_dir = os.path.join(cache_dir, 'atlases') if cache_dir is not None else None
 
         workflow.connect([
             (subject_inputnode, FC_matrix, [
@@ -0,0 +1,74 @@
+import numpy as np
+import nibabel as nb
+
+
+class MaskIndex(object):
+    '''
+    Holds the flat indices of the voxels within a mask, together with the affine and header of the mask, to convert
+    between (volumes x voxels) arrays and volumes in a single vectorized call. The mask file is read once, and the
+    arrays keep the dtype provided by the caller.
+    '''
+
+    def __init__(self, mask_file):
+        mask_img = nb.load(mask_file)
+        self.shape = tuple(mask_img.shape[:3])
+        self.affine = mask_img.affine
+        self.header = mask_img.header.copy()
+        self.indices = np.flatnonzero(np.asarray(mask_img.dataobj).reshape(-1) != 0)
+
+    @property
+    def num_voxels(self):
+        return len(self.indices)
+
+    @property
+    def mask(self):
+        # boolean volume of the mask
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[self.indices] = True
+        return mask.reshape(self.shape)
+
+    def gather(self, array, dtype=None):
+        # takes a 3D volume or a 4D array of volumes, and returns a vector of the mask voxels (for 3D),
+        # or a (volumes x voxels) array (for 4D)
+        array = np.asarray(array)
+        if array.ndim == 3:
+            vectors = array.reshape(-1)[self.indices]
+        else:
+            vectors = array.reshape(-1, array.shape[3])[self.indices].T
+        if dtype is not None:
+            vectors = vectors.astype(dtype, copy=False)
+        return vectors
+
+    def gather_file(self, img_file, dtype=np.float32, chunk_size=50):
+        # reads the mask voxels from a 3D or 4D image. 4D images are read by chunks of volumes, so that
+        # only the (volumes x voxels) array is held in memory
+        img = nb.load(img_file)
+        if len(img.shape) == 3:
+            return self.gather(img.dataobj, dtype=dtype)
+        num_volumes = img.shape[3]
+        vectors = np.zeros([num_volumes, self.num_voxels], dtype=dtype)
+        for start in range(0, num_volumes, chunk_size):
+            stop = min(start+chunk_size, num_volumes)
+            vectors[start:stop] = self.gather(img.dataobj[:, :, :, start:stop])
+        return vectors
+
+    def scatter(self, vectors, dtype=None):
+        # takes a vector of the mask voxels, or a (volumes x voxels) array, and returns the corresponding 3D volume
+        # or 4D array of volumes, with zeros outside the mask
+        vectors = np.asarray(vectors)
+        if dtype is None:
+            dtype = vectors.dtype
+        if vectors.ndim == 1:
+            volume = np.zeros(int(np.prod(self.shape)), dtype=dtype)
+            volume[self.indices] = vectors
+            return volume.reshape(self.shape)
+        volumes = np.zeros([int(np.prod(self.shape)), vectors.shape[0]], dtype=dtype)
+        volumes[self.indices] = vectors.T
+        return volumes.reshape(self.shape+(vectors.shape[0],))
+
+    def to_img(self, vectors, dtype=None):
+        # returns a nifti image from scatter(), with the affine and header of the mask
+        array = self.scatter(vectors, dtype=dtype)
+        header = self.header.copy()
+        header.set_data_dtype(array.dtype)
+        return nb.Nifti1Image(array, self.affine, header)
@@ -2,11 +2,11 @@
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype import Function
-from .utils import regress, data_diagnosis, select_timeseries, exec_ICA_AROMA
+from .utils import regress, data_diagnosis, select_timeseries
 
 
-def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.3, run_aroma=False, aroma_dim=0, conf_list=[],
-                                TR='1.0s', apply_scrubbing=False, scrubbing_threshold=0.1, timeseries_interval='all', diagnosis_output=False, name="confound_regression_wf"):
+def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.3, run_aroma=False, aroma_dim=0, aroma_ica_engine='melodic', conf_list=[],
+                                TR='1.0s', apply_scrubbing=False, scrubbing_threshold=0.1, timeseries_interval='all', diagnosis_output=False, cache_dir=None, rabies_mem_scale=1.0, name="confound_regression_wf"):
 
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(fields=[
@@ -14,11 +14,17 @@ def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.
     outputnode = pe.Node(niu.IdentityInterface(fields=[
                          'cleaned_path', 'VE_file', 'aroma_out', 'mel_out', 'tSNR_file']), name='outputnode')
 
+    if run_aroma:
+        # the ICA and the AROMA denoising are computed in-process on the full timeseries
+        regress_mem = 4*rabies_mem_scale
+    else:
+        regress_mem = 1
     regress_node = pe.Node(Function(input_names=['bold_file', 'brain_mask_file', 'confounds_file', 'csf_mask', 'FD_file', 'conf_list',
-                                                 'TR', 'lowpass', 'highpass', 'smoothing_filter', 'apply_scrubbing', 'scrubbing_threshold', 'timeseries_interval'],
-                                    output_names=['cleaned_path', 'bold_file', 'VE_file'],
+                                                 'TR', 'lowpass', 'highpass', 'smoothing_filter', 'apply_scrubbing', 'scrubbing_threshold', 'timeseries_interval',
+                                                 'run_aroma', 'aroma_dim', 'aroma_ica_engine', 'cache_dir'],
+                                    output_names=['cleaned_path', 'bold_file', 'VE_file', 'aroma_out'],
                                     function=regress),
-                           name='regress', mem_gb=1)
+                           name='regress', mem_gb=regress_mem)
     regress_node.inputs.conf_list = conf_list
     regress_node.inputs.TR = float(TR.split('s')[0])
     regress_node.inputs.lowpass = lowpass
@@ -27,6 +33,7 @@ def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.
     regress_node.inputs.apply_scrubbing = apply_scrubbing
     regress_node.inputs.scrubbing_threshold = scrubbing_threshold
     regress_node.inputs.timeseries_interval = timeseries_interval
+    regress_node.inputs.run_aroma = run_aroma
 
     select_timeseries_node = pe.Node(Function(input_names=['bold_file', 'timeseries_interval'],
                                               output_names=['bold_file'],
@@ -43,6 +50,9 @@ def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.
             ("confounds_file", "confounds_file"),
             ("FD_file", "FD_file"),
             ]),
+        (select_timeseries_node, regress_node, [
+            ("bold_file", "bold_file"),
+            ]),
         (regress_node, outputnode, [
             ("cleaned_path", "cleaned_path"),
             ("VE_file", "VE_file"),
@@ -50,35 +60,20 @@ def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.
         ])
 
     if run_aroma:
-        ica_aroma_node = pe.Node(Function(input_names=['inFile', 'mc_file', 'brain_mask', 'csf_mask', 'tr', 'aroma_dim'],
-                                          output_names=['cleaned_file', 'aroma_out'],
-                                          function=exec_ICA_AROMA),
-                                 name='ica_aroma', mem_gb=1)
-        ica_aroma_node.inputs.tr = float(TR.split('s')[0])
-        ica_aroma_node.inputs.aroma_dim = aroma_dim
+        # ICA-AROMA is executed within the regress node, so that the denoised timeseries
+        # are cleaned without being written to disk first
+        regress_node.inputs.aroma_dim = aroma_dim
+        regress_node.inputs.aroma_ica_engine = aroma_ica_engine
+        regress_node.inputs.cache_dir = cache_dir
 
         workflow.connect([
-            (inputnode, ica_aroma_node, [
-                ("brain_mask", "brain_mask"),
-                ("confounds_file", "mc_file"),
+            (inputnode, regress_node, [
                 ("csf_mask", "csf_mask"),
                 ]),
-            (select_timeseries_node, ica_aroma_node, [
-                ("bold_file", "inFile"),
-                ]),
-            (ica_aroma_node, regress_node, [
-                ("cleaned_file", "bold_file"),
-                ]),
-            (ica_aroma_node, outputnode, [
+            (regress_node, outputnode, [
                 ("aroma_out", "aroma_out"),
                 ]),
             ])
-    else:
-        workflow.connect([
-            (select_timeseries_node, regress_node, [
-                ("bold_file", "bold_file"),
-                ]),
-            ])
 
     if diagnosis_output:
         data_diagnosis_node = pe.Node(data_diagnosis(),
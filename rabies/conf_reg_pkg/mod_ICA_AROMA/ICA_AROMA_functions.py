@@ -12,9 +12,12 @@ from past.utils import old_div
 import numpy as np
 
 ###RABIES modification
-def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melDir="",dim=0,overwrite=False):
+def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melDir="",dim=0,overwrite=False,cache_dir=None,in_memory=False,ica_engine='melodic'):
     ###additional function for the execution of ICA_AROMA within RABIES
+    ###returns a dictionary of the denoised images, which are only kept in memory if in_memory is True
+    ###ica_engine selects between FSL MELODIC ('melodic') and the in-process PCA+FastICA decomposition ('fastica')
     import os
+    import time
     import subprocess
     import shutil
     import rabies.conf_reg_pkg.mod_ICA_AROMA.classification_plots as classification_plots
@@ -63,8 +66,8 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
 
     #------------------------------------------- PREPARE -------------------------------------------#
 
-    # Define the FSL-bin directory
-    fslDir = os.path.join(os.environ["FSLDIR"], 'bin', '')
+    # Define the FSL-bin directory (FSL is not required with the fastica engine)
+    fslDir = os.path.join(os.environ.get("FSLDIR", ""), 'bin', '')
 
     # Create output directory if needed
     if os.path.isdir(outDir) and overwrite is False:
@@ -101,8 +104,16 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
 
     #---------------------------------------- Run ICA-AROMA ----------------------------------------#
 
-    print('Step 1) MELODIC')
-    aromafunc.runICA(fslDir, inFile, outDir, melDir, mask, dim, TR)
+    start = time.time()
+    if ica_engine == 'melodic':
+        print('Step 1) MELODIC')
+        aromafunc.runICA(fslDir, inFile, outDir, melDir, mask, dim, TR)
+    elif ica_engine == 'fastica':
+        print('Step 1) PCA + FastICA')
+        aromafunc.runICA_python(inFile, outDir, mask, dim, TR)
+    else:
+        raise ValueError("Unknown ICA engine %s. Must be either 'melodic' or 'fastica'." % (ica_engine))
+    print('  - ICA decomposition completed in %.1f seconds' % (time.time() - start))
     melIC = os.path.join(outDir, 'melodic_IC_thr.nii.gz')
 
     print('Step 2) Automatic classification of the components')
@@ -112,7 +123,7 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
     print('  - computing edge and out masks')
     mask_edge = os.path.join(outDir, 'mask_edge.nii.gz')
     mask_out = os.path.join(outDir, 'mask_out.nii.gz')
-    aromafunc.compute_edge_mask(mask,mask_edge, num_edge_voxels=1)
+    aromafunc.compute_edge_mask(mask,mask_edge, num_edge_voxels=1, cache_dir=cache_dir)
     aromafunc.compute_out_mask(mask,mask_out)
 
     print('  - extracting the CSF & Edge fraction features')
@@ -133,14 +144,16 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
                                              outDir)
 
 
+    denoised = {}
     if (denType != 'no'):
         print('Step 3) Data denoising')
-        aromafunc.denoising(fslDir, inFile, outDir, melmix, denType, motionICs)
+        denoised = aromafunc.denoising(fslDir, inFile, outDir, melmix, denType, motionICs, mask=mask, write=not in_memory)
 
     # Revert to old directory
     os.chdir(cwd)
 
     print('\n----------------------------------- Finished -----------------------------------\n')
+    return denoised
 ###end of RABIES modification
 
 
@@ -164,7 +177,6 @@ def runICA(fslDir, inFile, outDir, melDirIn, mask, dim, TR):
 
     # Import needed modules
     import os
-    import subprocess
 
     # Define the 'new' MELODIC directory and predefine some associated files
     melDir = os.path.join(outDir, 'melodic.ica')
@@ -219,48 +231,209 @@ def runICA(fslDir, inFile, outDir, melDirIn, mask, dim, TR):
                             '--Ostats --nobet --mmthresh=0.5 --report',
                             '--tr=' + str(TR)]))
 
+    ###RABIES modification
+    # the thresholded maps are read and merged in memory, instead of extracting and merging each IC with fslroi/fslmerge
+    import numpy as np
+    import nibabel as nb
+
     # Get number of components
-    cmd = ' '.join([os.path.join(fslDir, 'fslinfo'),
-                    melIC,
-                    '| grep dim4 | head -n1 | awk \'{print $2}\''])
-    nrICs = int(float(subprocess.getoutput(cmd)))
+    melIC_img = nb.load(melIC)
+    nrICs = melIC_img.shape[3] if len(melIC_img.shape) == 4 else 1
 
     # Merge mixture modeled thresholded spatial maps. Note! In case that mixture modeling did not converge, the file will contain two spatial maps. The latter being the results from a simple null hypothesis test. In that case, this map will have to be used (first one will be empty).
+    thr_array = np.zeros(list(melIC_img.shape[:3]) + [nrICs], dtype=np.float32)
     for i in range(1, nrICs + 1):
         # Define thresholded zstat-map file
-        zTemp = os.path.join(melDir, 'stats', 'thresh_zstat' + str(i) + '.nii.gz')
-        cmd = ' '.join([os.path.join(fslDir, 'fslinfo'),
-                        zTemp,
-                        '| grep dim4 | head -n1 | awk \'{print $2}\''])
-        lenIC = int(float(subprocess.getoutput(cmd)))
-
-        # Define zeropad for this IC-number and new zstat file
-        cmd = ' '.join([os.path.join(fslDir, 'zeropad'),
-                        str(i),
-                        '4'])
-        ICnum = subprocess.getoutput(cmd)
-        zstat = os.path.join(outDir, 'thr_zstat' + ICnum)
+        zTemp = nb.load(os.path.join(melDir, 'stats', 'thresh_zstat' + str(i) + '.nii.gz'))
 
         # Extract last spatial map within the thresh_zstat file
-        os.system(' '.join([os.path.join(fslDir, 'fslroi'),
-                            zTemp,      # input
-                            zstat,      # output
-                            str(lenIC - 1),   # first frame
-                            '1']))      # number of frames
+        if len(zTemp.shape) == 4:
+            thr_array[:, :, :, i - 1] = zTemp.dataobj[:, :, :, zTemp.shape[3] - 1]
+        else:
+            thr_array[:, :, :, i - 1] = np.asarray(zTemp.dataobj)
 
-    # Merge and subsequently remove all mixture modeled Z-maps within the output directory
-    os.system(' '.join([os.path.join(fslDir, 'fslmerge'),
-                        '-t',                       # concatenate in time
-                        melICthr,                   # output
-                        os.path.join(outDir, 'thr_zstat????.nii.gz')]))  # inputs
+    # Apply the mask to the merged file (in case a melodic-directory was predefined and run with a different mask)
+    mask_array = np.asarray(nb.load(mask).dataobj) != 0
+    thr_array[~mask_array] = 0
 
-    os.system('rm ' + os.path.join(outDir, 'thr_zstat????.nii.gz'))
+    header = melIC_img.header.copy()
+    header.set_data_dtype(np.float32)
+    nb.Nifti1Image(thr_array, melIC_img.affine, header).to_filename(melICthr)
+    ###end of RABIES modification
 
-    # Apply the mask to the merged file (in case a melodic-directory was predefined and run with a different mask)
-    os.system(' '.join([os.path.join(fslDir, 'fslmaths'),
-                        melICthr,
-                        '-mas ' + mask,
-                        melICthr]))
+
+###RABIES modification
+def runICA_python(inFile, outDir, mask, dim, TR, z_thresh=2.3, random_state=0):
+    """ In-process alternative to runICA. A temporal PCA reduction is followed by spatial FastICA on the masked float32 data matrix,
+    and the outputs are written in the format expected from MELODIC by the rest of ICA-AROMA.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    inFile:     Full path to the fMRI data file (nii.gz) on which the ICA should be run
+    outDir:     Full path of the output directory
+    mask:       Full path of the mask to be applied during the ICA
+    dim:        Dimensionality of ICA (automatically estimated if 0)
+    TR:     TR (in seconds) of the fMRI data
+    z_thresh:   Threshold applied on the robustly standardized Z-maps, in place of mixture modeling
+    random_state:   Seed for the initialization of FastICA
+
+    Output (within the requested output directory)
+    ---------------------------------------------------------------------------------
+    melodic.ica     directory containing melodic_IC.nii.gz, melodic_mix and melodic_FTmix
+    melodic_IC_thr.nii.gz   merged file containing the thresholded Z-statistical maps """
+
+    # Import needed modules
+    import os
+    import numpy as np
+    import nibabel as nb
+    from sklearn.decomposition import FastICA
+    from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import estimate_pca_dim
+
+    melDir = os.path.join(outDir, 'melodic.ica')
+    os.makedirs(melDir, exist_ok=True)
+
+    img = nb.load(inFile)
+    mask_array = np.asarray(nb.load(mask).dataobj) != 0
+    # voxels x time matrix, demeaned and variance normalized for each voxel as with MELODIC
+    data = np.asarray(img.dataobj)[mask_array].astype(np.float32)
+    num_voxels, num_timepoints = data.shape
+    data -= data.mean(axis=1)[:, np.newaxis]
+    if int(dim) <= 0:
+        # the dimensionality is estimated before variance normalization, which makes the noise anisotropic,
+        # from the covariance of the timepoints centered across voxels
+        mean = data.mean(axis=0, dtype=np.float64)
+        centered_cov = np.dot(data.T, data).astype(np.float64) / (num_voxels - 1) \
+            - np.outer(mean, mean) * num_voxels / (num_voxels - 1)
+        centered_eigenvalues = np.linalg.eigvalsh(centered_cov)
+    std = data.std(axis=1)
+    std[std == 0] = 1
+    data /= std[:, np.newaxis]
+
+    # temporal PCA from the eigendecomposition of the time x time covariance
+    cov = np.dot(data.T, data).astype(np.float64) / (num_voxels - 1)
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    eigenvalues = np.maximum(eigenvalues[::-1], 0)
+    eigenvectors = eigenvectors[:, ::-1]
+    dim = int(dim)
+    if dim <= 0:
+        dim = estimate_pca_dim(centered_eigenvalues, num_voxels)
+    dim = max(1, min(dim, num_timepoints - 1, int((eigenvalues > 1e-10).sum())))
+    print('  - Estimating ' + str(dim) + ' components')
+
+    # whitened PC maps, then spatial ICA
+    sqrt_eig = np.sqrt(eigenvalues[:dim])
+    reduced = np.dot(data, (eigenvectors[:, :dim] / sqrt_eig).astype(np.float32))
+    ica = FastICA(whiten=False, max_iter=500, tol=1e-4, random_state=random_state)
+    sources = ica.fit_transform(reduced)
+    mix = np.dot(eigenvectors[:, :dim] * sqrt_eig, ica.mixing_)
+
+    # unit variance timecourses with the amplitude held by the maps, and maps with a positive skew
+    scale = mix.std(axis=0)
+    scale[scale == 0] = 1
+    mix /= scale
+    maps = sources * scale.astype(np.float32)
+    sign = np.sign((maps.astype(np.float64)**3).sum(axis=0))
+    sign[sign == 0] = 1
+    mix *= sign
+    maps *= sign.astype(np.float32)
+
+    # Z-statistics from the voxelwise residual standard deviation left after the PCA reduction
+    explained = ((reduced * sqrt_eig.astype(np.float32))**2).sum(axis=1)
+    resid_std = np.sqrt(np.maximum(num_timepoints - explained, 1e-6) / max(num_timepoints - dim, 1))
+    z_maps = maps / resid_std[:, np.newaxis]
+
+    # sort components by decreasing explained variance
+    order = np.argsort((maps.astype(np.float64)**2).sum(axis=0))[::-1]
+    mix = mix[:, order]
+    z_maps = z_maps[:, order]
+
+    # the power spectra of the timecourses, ranging up to the Nyquist frequency
+    FTmix = np.abs(np.fft.rfft(mix, axis=0)[1:])**2
+
+    np.savetxt(os.path.join(melDir, 'melodic_mix'), mix, fmt='%.6e', delimiter='  ')
+    np.savetxt(os.path.join(melDir, 'melodic_FTmix'), FTmix, fmt='%.6e', delimiter='  ')
+
+    # in the absence of mixture modeling, the maps are thresholded after robust standardization
+    median = np.median(z_maps, axis=0)
+    mad = np.median(np.abs(z_maps - median), axis=0) * 1.4826
+    mad[mad == 0] = 1
+    thr_maps = z_maps * (np.abs(z_maps - median) / mad > z_thresh)
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    for array, filename in zip([z_maps, thr_maps], [os.path.join(melDir, 'melodic_IC.nii.gz'), os.path.join(outDir, 'melodic_IC_thr.nii.gz')]):
+        out_array = np.zeros(list(mask_array.shape) + [dim], dtype=np.float32)
+        out_array[mask_array] = array
+        nb.Nifti1Image(out_array, img.affine, header).to_filename(filename)
+
+
+def estimate_pca_dim(eigenvalues, n_samples):
+    """ Estimates the number of PCA components with the Laplace approximation of Minka (2000), as with
+    scikit-learn's PCA(n_components='mle').
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    eigenvalues:    Eigenvalues of the covariance matrix of the data centered across samples, in decreasing order
+    n_samples:  Number of samples (voxels) on which the covariance was computed
+
+    Returns
+    ---------------------------------------------------------------------------------
+    dim:        Estimated dimensionality """
+
+    # Import required modules
+    import numpy as np
+    from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import minka_log_likelihood
+
+    spectrum = np.sort(np.asarray(eigenvalues, dtype=np.float64))[::-1]
+    # null eigenvalues (e.g. from the removal of the mean of each voxel) would dominate the likelihood
+    spectrum = spectrum[spectrum > spectrum[0] * 1e-8]
+    if len(spectrum) < 2:
+        return 1
+    return int(np.argmax(minka_log_likelihood(spectrum, n_samples))) + 1
+
+
+def minka_log_likelihood(spectrum, n_samples):
+    """ Log-likelihood of Minka (2000) for each rank k=1..n-1 of the decreasing eigenvalue spectrum, evaluated
+    for all ranks at once with the same terms as scikit-learn's _assess_dimension. """
+
+    # Import required modules
+    import numpy as np
+    from scipy.special import gammaln
+
+    n = len(spectrum)
+    eps = 1e-15
+    k = np.arange(1, n)
+
+    pu = -k * np.log(2.) + np.cumsum(gammaln((n - k + 1) / 2.) - np.log(np.pi) * (n - k + 1) / 2.)
+    pl = -np.cumsum(np.log(spectrum[:-1])) * n_samples / 2.
+    # noise variance, i.e. the mean of the remaining eigenvalues
+    v = np.maximum(eps, np.cumsum(spectrum[::-1])[::-1][1:] / (n - k))
+    pv = -np.log(v) * n_samples * (n - k) / 2.
+    m = n * k - k * (k + 1.) / 2.
+    pp = np.log(2. * np.pi) * (m + k) / 2.
+
+    # pa sums log((s_i-s_j)(1/s'_j-1/s'_i)) over i<k and j>i, where s' is the spectrum with the noise
+    # eigenvalues replaced by v
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upper = np.triu(np.ones([n, n], dtype=bool), 1)
+        log_diff = np.where(upper, np.log(spectrum[:, np.newaxis] - spectrum[np.newaxis, :]), 0)
+        log_inv_diff = np.where(upper, np.log(1. / spectrum[np.newaxis, :] - 1. / spectrum[:, np.newaxis]), 0)
+        # pairs with both i,j<k
+        signal_pairs = np.cumsum((log_diff + log_inv_diff).sum(axis=0))[:-1]
+        # pairs with i<k<=j: the sum of log_diff[:k,k:], and the terms with v
+        tail = np.cumsum(log_diff[:, ::-1], axis=1)[:, ::-1]
+        noise_pairs = np.cumsum(tail, axis=0)[k - 1, k]
+        log_inv_v = np.where(np.arange(n - 1)[np.newaxis, :] < k[:, np.newaxis],
+                             np.log(1. / v[:, np.newaxis] - 1. / spectrum[np.newaxis, :-1]), 0)
+        noise_pairs = noise_pairs + (n - k) * log_inv_v.sum(axis=1)
+    num_pairs = k * (n - 1) - k * (k - 1) / 2.
+    pa = signal_pairs + noise_pairs + num_pairs * np.log(n_samples)
+
+    ll = pu + pl + pv + pp - pa / 2. - k * np.log(n_samples) / 2.
+    ll[spectrum[:-1] < eps] = -np.inf
+    ll[np.isnan(ll)] = -np.inf
+    return ll
+###end of RABIES modification
 
 
 def register2MNI(fslDir, inFile, outFile, affmat, warp):
@@ -467,29 +640,57 @@ def feature_frequency(melFTmix, TR):
     return HFC
 
 ###RABIES modification
-def compute_edge_mask(in_mask,out_file, num_edge_voxels):
+#edge masks computed within this process, keyed on the content of the input mask
+_edge_mask_cache = {}
+
+def compute_edge_mask(in_mask,out_file, num_edge_voxels, cache_dir=None):
     #custom function for computing edge mask from an input brain mask
+    #the result is cached based on the content of the input mask, in memory and in cache_dir if provided,
+    #so that every scan sharing the same commonspace mask reuses the same edge mask
+    import os
+    import shutil
     import numpy as np
     import nibabel as nb
+    from rabies.preprocess_pkg.utils import hash_image
     img=nb.load(in_mask)
-    mask_array=np.asarray(img.dataobj)
+    key=hash_image(in_mask, extra=[num_edge_voxels])
+
+    if key in _edge_mask_cache:
+        nb.Nifti1Image(_edge_mask_cache[key], img.affine, img.header).to_filename(out_file)
+        return
+    if cache_dir is not None:
+        cache_file=os.path.join(cache_dir, 'edge_mask_%s.nii.gz' % (key))
+        if os.path.isfile(cache_file):
+            shutil.copyfile(cache_file, out_file)
+            _edge_mask_cache[key]=np.asarray(nb.load(cache_file).dataobj).astype(bool)
+            return
+
+    from scipy import ndimage
+    mask_array=np.asarray(img.dataobj)!=0
     shape=mask_array.shape
 
-    #iterate through all voxels from the three dimensions and look if it contains surrounding voxels
+    #a mask voxel belongs to the edge if any voxel in its 3x3x3 neighbourhood is outside the mask,
+    #which corresponds to the voxels removed by a binary erosion with a full structuring element.
+    #Voxels outside the image boundary count as part of the mask.
+    structure=np.ones([3,3,3], dtype=bool)
     edge_mask=np.zeros(shape, dtype=bool)
-    num_voxel=0
-    while num_voxel<num_edge_voxels:
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                for z in range(shape[2]):
-                    #only look if the voxel is part of the mask
-                    if mask_array[x,y,z]:
-                        if (mask_array[x-1:x+2,y-1:y+2,z-1:z+2]==0).sum()>0:
-                            edge_mask[x,y,z]=1
-        mask_array=mask_array-edge_mask
-        num_voxel+=1
-
+    for num_voxel in range(num_edge_voxels):
+        edge=mask_array & ~ndimage.binary_erosion(mask_array, structure=structure, border_value=1)
+        #the first slice along each axis is never labeled, as in the original voxelwise loop
+        edge[0,:,:]=0
+        edge[:,0,:]=0
+        edge[:,:,0]=0
+        edge_mask|=edge
+        mask_array&=~edge
+
+    _edge_mask_cache[key]=edge_mask
     nb.Nifti1Image(edge_mask, img.affine, img.header).to_filename(out_file)
+    if cache_dir is not None:
+        #write to a temporary file first, since parallel nodes may populate the cache at the same time
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file=cache_file+'.%s.tmp.nii.gz' % (os.getpid())
+        shutil.copyfile(out_file, tmp_file)
+        os.replace(tmp_file, cache_file)
 
 def compute_out_mask(in_mask,out_file):
     #custom function for computing a mask for the outside of the brain
@@ -504,13 +705,15 @@ def compute_out_mask(in_mask,out_file):
 
 def mod_feature_spatial(fslDir, tempDir, melIC, mask_csf, mask_edge, mask_out):
     #This is a modified version of the orginial ICA-AROMA function where the CSF and edge masks are provided manually.
+    #The thresholded Z-maps are loaded once and the features of all components are computed together
+    #with masked reductions, instead of extracting each IC with fslroi/fslmaths/fslstats.
     """
     This function extracts the spatial feature scores. For each IC it determines the fraction of the mixture modeled thresholded Z-maps respecitvely located within the CSF or at the brain edges, using predefined standardized masks.
 
     Parameters
     ---------------------------------------------------------------------------------
-    fslDir:     Full path of the bin-directory of FSL
-    tempDir:    Full path of a directory where temporary files can be stored (called 'temp_IC.nii.gz')
+    fslDir:     Full path of the bin-directory of FSL (unused, kept for compatibility)
+    tempDir:    Full path of a directory where temporary files can be stored (unused, kept for compatibility)
     melIC:      Full path of the nii.gz file containing mixture-modeled threholded (p>0.5) Z-maps, which overlays with the provided masks.
 
     Returns
@@ -520,103 +723,33 @@ def mod_feature_spatial(fslDir, tempDir, melIC, mask_csf, mask_edge, mask_out):
 
     # Import required modules
     import numpy as np
-    import os
-    import subprocess
-
-    # Get the number of ICs
-    numICs = int(subprocess.getoutput('%sfslinfo %s | grep dim4 | head -n1 | awk \'{print $2}\'' % (fslDir, melIC) ))
+    import nibabel as nb
 
-    # Loop over ICs
+    # Load all absolute Z-maps as a voxels x ICs matrix
+    IC_array = np.abs(np.asarray(nb.load(melIC).dataobj, dtype=np.float32))
+    if IC_array.ndim == 3:
+        IC_array = IC_array[:, :, :, np.newaxis]
+    numICs = IC_array.shape[3]
+    IC_matrix = IC_array.reshape(-1, numICs)
+
+    # Stack the CSF, edge and out masks, and get the sum of Z-values within each mask for all ICs in a single product
+    masks = np.zeros([3, IC_matrix.shape[0]], dtype=np.float32)
+    for i, mask_file in enumerate([mask_csf, mask_edge, mask_out]):
+        masks[i, :] = (np.asarray(nb.load(mask_file).dataobj) != 0).reshape(-1)
+    csfSum, edgeSum, outSum = np.dot(masks, IC_matrix).astype(np.float64)
+
+    # Get sum of Z-values within the total Z-map
+    totSum = IC_matrix.sum(axis=0, dtype=np.float64)
+    for i in np.where(totSum == 0)[0]:
+        print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
+
+    # Determine edge and CSF fraction
     edgeFract = np.zeros(numICs)
     csfFract = np.zeros(numICs)
-    for i in range(0, numICs):
-        # Define temporary IC-file
-        tempIC = os.path.join(tempDir, 'temp_IC.nii.gz')
-
-        # Extract IC from the merged melodic_IC_thr2MNI2mm file
-        os.system(' '.join([os.path.join(fslDir, 'fslroi'),
-                  melIC,
-                  tempIC,
-                  str(i),
-                  '1']))
-
-        # Change to absolute Z-values
-        os.system(' '.join([os.path.join(fslDir, 'fslmaths'),
-                  tempIC,
-                  '-abs',
-                  tempIC]))
-
-        # Get sum of Z-values within the total Z-map (calculate via the mean and number of non-zero voxels)
-        totVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (totVox == 0):
-            totMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-M'])))
-        else:
-            print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
-            totMean = 0
-
-        totSum = totMean * totVox
-
-        # Get sum of Z-values of the voxels located within the CSF (calculate via the mean and number of non-zero voxels)
-        csfVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k ', mask_csf,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (csfVox == 0):
-            csfMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k ', mask_csf,
-                                                           '-M'])))
-        else:
-            csfMean = 0
-
-        csfSum = csfMean * csfVox
-
-        # Get sum of Z-values of the voxels located within the Edge (calculate via the mean and number of non-zero voxels)
-        edgeVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                     tempIC,
-                                                     '-k ', mask_edge,
-                                                     '-V | awk \'{print $1}\''])))
-        if not (edgeVox == 0):
-            edgeMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                            tempIC,
-                                                            '-k ', mask_edge,
-                                                            '-M'])))
-        else:
-            edgeMean = 0
-
-        edgeSum = edgeMean * edgeVox
-
-        # Get sum of Z-values of the voxels located outside the brain (calculate via the mean and number of non-zero voxels)
-        outVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k ', mask_out,
-                                                    '-V | awk \'{print $1}\''])))
-        if not (outVox == 0):
-            outMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k ', mask_out,
-                                                           '-M'])))
-        else:
-            outMean = 0
-
-        outSum = outMean * outVox
-
-        # Determine edge and CSF fraction
-        if not (totSum == 0):
-            edgeFract[i] = old_div((outSum + edgeSum), (totSum - csfSum))
-            csfFract[i] = old_div(csfSum, totSum)
-        else:
-            edgeFract[i] = 0
-            csfFract[i] = 0
-
-    # Remove the temporary IC-file
-    os.remove(tempIC)
+    nonzero = totSum != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edgeFract[nonzero] = (outSum[nonzero] + edgeSum[nonzero]) / (totSum[nonzero] - csfSum[nonzero])
+        csfFract[nonzero] = csfSum[nonzero] / totSum[nonzero]
 
     # Return feature scores
     return edgeFract, csfFract
@@ -639,107 +772,15 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
     csfFract:   Array of the CSF fraction feature scores for the components of the melIC file"""
 
     # Import required modules
-    import numpy as np
     import os
-    import subprocess
-
-    # Get the number of ICs
-    numICs = int(subprocess.getoutput('%sfslinfo %s | grep dim4 | head -n1 | awk \'{print $2}\'' % (fslDir, melIC) ))
-
-    # Loop over ICs
-    edgeFract = np.zeros(numICs)
-    csfFract = np.zeros(numICs)
-    for i in range(0, numICs):
-        # Define temporary IC-file
-        tempIC = os.path.join(tempDir, 'temp_IC.nii.gz')
-
-        # Extract IC from the merged melodic_IC_thr2MNI2mm file
-        os.system(' '.join([os.path.join(fslDir, 'fslroi'),
-                  melIC,
-                  tempIC,
-                  str(i),
-                  '1']))
-
-        # Change to absolute Z-values
-        os.system(' '.join([os.path.join(fslDir, 'fslmaths'),
-                  tempIC,
-                  '-abs',
-                  tempIC]))
-
-        # Get sum of Z-values within the total Z-map (calculate via the mean and number of non-zero voxels)
-        totVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (totVox == 0):
-            totMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-M'])))
-        else:
-            print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
-            totMean = 0
-
-        totSum = totMean * totVox
-
-        # Get sum of Z-values of the voxels located within the CSF (calculate via the mean and number of non-zero voxels)
-        csfVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k mask_csf.nii.gz',
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (csfVox == 0):
-            csfMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k mask_csf.nii.gz',
-                                                           '-M'])))
-        else:
-            csfMean = 0
-
-        csfSum = csfMean * csfVox
-
-        # Get sum of Z-values of the voxels located within the Edge (calculate via the mean and number of non-zero voxels)
-        edgeVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                     tempIC,
-                                                     '-k mask_edge.nii.gz',
-                                                     '-V | awk \'{print $1}\''])))
-        if not (edgeVox == 0):
-            edgeMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                            tempIC,
-                                                            '-k mask_edge.nii.gz',
-                                                            '-M'])))
-        else:
-            edgeMean = 0
-
-        edgeSum = edgeMean * edgeVox
-
-        # Get sum of Z-values of the voxels located outside the brain (calculate via the mean and number of non-zero voxels)
-        outVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k mask_out.nii.gz',
-                                                    '-V | awk \'{print $1}\''])))
-        if not (outVox == 0):
-            outMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k mask_out.nii.gz',
-                                                           '-M'])))
-        else:
-            outMean = 0
-
-        outSum = outMean * outVox
 
-        # Determine edge and CSF fraction
-        if not (totSum == 0):
-            edgeFract[i] = old_div((outSum + edgeSum), (totSum - csfSum))
-            csfFract[i] = old_div(csfSum, totSum)
-        else:
-            edgeFract[i] = 0
-            csfFract[i] = 0
-
-    # Remove the temporary IC-file
-    os.remove(tempIC)
-
-    # Return feature scores
-    return edgeFract, csfFract
+    ###RABIES modification
+    # the features are computed in memory for all ICs at once with the masks from the ICA-AROMA directory
+    return mod_feature_spatial(fslDir, tempDir, melIC,
+                               os.path.join(aromaDir, 'mask_csf.nii.gz'),
+                               os.path.join(aromaDir, 'mask_edge.nii.gz'),
+                               os.path.join(aromaDir, 'mask_out.nii.gz'))
+    ###end of RABIES modification
 
 
 def classification(outDir, maxRPcorr, edgeFract, HFC, csfFract):
@@ -819,7 +860,7 @@ def classification(outDir, maxRPcorr, edgeFract, HFC, csfFract):
     return motionICs
 
 
-def denoising(fslDir, inFile, outDir, melmix, denType, denIdx):
+def denoising(fslDir, inFile, outDir, melmix, denType, denIdx, mask=None, write=True):
     """ This function classifies the ICs based on the four features;
     maximum RP correlation, high-frequency content, edge-fraction and CSF-fraction
 
@@ -831,45 +872,100 @@ def denoising(fslDir, inFile, outDir, melmix, denType, denIdx):
     melmix:     Full path of the melodic_mix text file
     denType:    Type of requested denoising ('aggr': aggressive, 'nonaggr': non-aggressive, 'both': both aggressive and non-aggressive
     denIdx:     Indices of the components that should be regressed out
+    mask:       Full path of a mask restricting the voxels that are denoised (optional, RABIES modification)
+    write:      Whether to write the denoised data to the output directory (RABIES modification)
 
     Output (within the requested output directory)
     ---------------------------------------------------------------------------------
-    denoised_func_data_<denType>.nii.gz:        A nii.gz file of the denoised fMRI data"""
+    denoised_func_data_<denType>.nii.gz:        A nii.gz file of the denoised fMRI data
+
+    Returns (RABIES modification)
+    ---------------------------------------------------------------------------------
+    denoised:   Dictionary with the in-memory denoised image for each of the requested denoising types"""
 
     # Import required modules
     import os
     import numpy as np
+    import nibabel as nb
+
+    ###RABIES modification
+    # the regression is computed in memory with regfilt instead of fsl_regfilt, so that the result
+    # can be handed directly to the confound regression without writing it to disk
+    denIdx = np.atleast_1d(denIdx)
+    den_types = []
+    if (denType == 'nonaggr') or (denType == 'both'):
+        den_types.append('nonaggr')
+    if (denType == 'aggr') or (denType == 'both'):
+        den_types.append('aggr')
+
+    img = nb.load(inFile)
+    denoised = {}
 
     # Check if denoising is needed (i.e. are there components classified as motion)
     check = denIdx.size > 0
 
     if check == 1:
-        # Put IC indices into a char array
-        if denIdx.size == 1:
-            denIdxStrJoin = "%d"%(denIdx + 1)
+        data_array = np.asarray(img.dataobj, dtype=np.float32)
+        if mask is None:
+            mask_array = np.ones(data_array.shape[:3], dtype=bool)
         else:
-            denIdxStr = np.char.mod('%i', (denIdx + 1))
-            denIdxStrJoin = ','.join(denIdxStr)
-
-        # Non-aggressive denoising of the data using fsl_regfilt (partial regression), if requested
-        if (denType == 'nonaggr') or (denType == 'both'):
-            os.system(' '.join([os.path.join(fslDir, 'fsl_regfilt'),
-                                '--in=' + inFile,
-                                '--design=' + melmix,
-                                '--filter="' + denIdxStrJoin + '"',
-                                '--out=' + os.path.join(outDir, 'denoised_func_data_nonaggr.nii.gz')]))
-
-        # Aggressive denoising of the data using fsl_regfilt (full regression)
-        if (denType == 'aggr') or (denType == 'both'):
-            os.system(' '.join([os.path.join(fslDir, 'fsl_regfilt'),
-                                '--in=' + inFile,
-                                '--design=' + melmix,
-                                '--filter="' + denIdxStrJoin + '"',
-                                '--out=' + os.path.join(outDir, 'denoised_func_data_aggr.nii.gz'),
-                                '-a']))
+            mask_array = np.asarray(nb.load(mask).dataobj) != 0
+        mix = np.loadtxt(melmix, ndmin=2)
+
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
+        for den in den_types:
+            # Non-aggressive denoising of the data (partial regression), or aggressive denoising (full regression)
+            denoised_array = data_array.copy() if len(den_types) > 1 else data_array
+            denoised_array[mask_array] = regfilt(data_array[mask_array], mix, denIdx, aggressive=(den == 'aggr'))
+            denoised[den] = nb.Nifti1Image(denoised_array, img.affine, header)
+            if write:
+                denoised[den].to_filename(os.path.join(outDir, 'denoised_func_data_%s.nii.gz' % (den)))
     else:
         print("  - None of the components were classified as motion, so no denoising is applied (a symbolic link to the input file will be created).")
-        if (denType == 'nonaggr') or (denType == 'both'):
-            os.symlink(inFile, os.path.join(outDir, 'denoised_func_data_nonaggr.nii.gz'))
-        if (denType == 'aggr') or (denType == 'both'):
-            os.symlink(inFile, os.path.join(outDir, 'denoised_func_data_aggr.nii.gz'))
+        for den in den_types:
+            denoised[den] = img
+            if write:
+                os.symlink(inFile, os.path.join(outDir, 'denoised_func_data_%s.nii.gz' % (den)))
+
+    return denoised
+    ###end of RABIES modification
+
+
+###RABIES modification
+def regfilt(voxel_timeseries, mix, denIdx, aggressive=False, block_size=10000):
+    """ This function reproduces the regression of fsl_regfilt on a voxels x timepoints float32 array.
+    For non-aggressive denoising, the full mixing matrix is fitted and only the contribution of the
+    selected components is removed (partial regression). For aggressive denoising, only the
+    selected components are fitted and removed (full regression).
+    The component timecourses are demeaned, so the voxel means are preserved without demeaning
+    the data. Voxels are processed by blocks to limit the size of temporary arrays.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    voxel_timeseries:   Array of shape num_voxels x num_timepoints
+    mix:        Array of shape num_timepoints x num_ICs with the component timecourses (melodic_mix)
+    denIdx:     Indices of the components that should be regressed out
+    aggressive: Whether to apply aggressive instead of non-aggressive denoising
+    block_size: Number of voxels processed at once
+
+    Returns
+    ---------------------------------------------------------------------------------
+    denoised:   Array of shape num_voxels x num_timepoints with the denoised timeseries, in float32"""
+
+    import numpy as np
+    mix = mix - mix.mean(axis=0)
+    noise_mix = mix[:, denIdx]
+    if aggressive:
+        noise_pinv = np.linalg.pinv(noise_mix)
+    else:
+        noise_pinv = np.linalg.pinv(mix)[denIdx, :]
+    noise_mix = noise_mix.astype(np.float32)
+    noise_pinv = noise_pinv.astype(np.float32)
+
+    denoised = np.empty(voxel_timeseries.shape, dtype=np.float32)
+    for start in range(0, voxel_timeseries.shape[0], block_size):
+        block = np.asarray(voxel_timeseries[start:start+block_size], dtype=np.float32)
+        denoised[start:start+block_size] = block - np.dot(np.dot(block, noise_pinv.T), noise_mix.T)
+    return denoised
+###end of RABIES modification
@@ -48,7 +48,8 @@ def find_scans(scan_info, bold_files, brain_mask_files, confounds_files, csf_mas
     return bold_file, brain_mask_file, confounds_file, csf_mask, FD_file
 
 
-def exec_ICA_AROMA(inFile, mc_file, brain_mask, csf_mask, tr, aroma_dim):
+def exec_ICA_AROMA(inFile, mc_file, brain_mask, csf_mask, tr, aroma_dim, cache_dir=None, in_memory=False, ica_engine='melodic'):
+    # if in_memory is True, the denoised image is returned as a nibabel image instead of a file path
     import os
     from rabies.conf_reg_pkg.utils import csv2par
     from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import run_ICA_AROMA
@@ -57,8 +58,10 @@ def exec_ICA_AROMA(inFile, mc_file, brain_mask, csf_mask, tr, aroma_dim):
     aroma_out = os.getcwd()+'/aroma_out'
     cleaned_file = aroma_out+'/%s_aroma.nii.gz' % (filename_split[0])
 
-    run_ICA_AROMA(aroma_out, os.path.abspath(inFile), mc=csv2par(mc_file), TR=float(tr), mask=os.path.abspath(
-        brain_mask), mask_csf=os.path.abspath(csf_mask), denType="nonaggr", melDir="", dim=str(aroma_dim), overwrite=True)
+    denoised = run_ICA_AROMA(aroma_out, os.path.abspath(inFile), mc=csv2par(mc_file), TR=float(tr), mask=os.path.abspath(
+        brain_mask), mask_csf=os.path.abspath(csf_mask), denType="nonaggr", melDir="", dim=str(aroma_dim), overwrite=True, cache_dir=cache_dir, in_memory=in_memory, ica_engine=ica_engine)
+    if in_memory:
+        return denoised['nonaggr'], aroma_out
     os.rename(aroma_out+'/denoised_func_data_nonaggr.nii.gz', cleaned_file)
     return cleaned_file, aroma_out
 
@@ -121,12 +124,13 @@ def select_timeseries(bold_file, timeseries_interval):
 
 
 def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR, lowpass, highpass, smoothing_filter,
-            apply_scrubbing, scrubbing_threshold, timeseries_interval):
+            apply_scrubbing, scrubbing_threshold, timeseries_interval, run_aroma=False, aroma_dim=0, aroma_ica_engine='melodic', csf_mask=None, cache_dir=None):
     import os
     import numpy as np
     import pandas as pd
+    import nibabel as nb
     import nilearn.image
-    from rabies.conf_reg_pkg.utils import scrubbing
+    from rabies.conf_reg_pkg.utils import scrubbing, exec_ICA_AROMA
 
     if ('mot_6' in conf_list) and ('mot_24' in conf_list):
         raise ValueError(
@@ -134,7 +138,17 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
 
     cr_out = os.getcwd()
     import pathlib  # Better path manipulation
-    filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
+    filename_template = pathlib.Path(bold_file).name.rsplit(".nii")[0]
+
+    if run_aroma:
+        # ICA-AROMA is applied within the same process, and the denoised timeseries
+        # are passed to the cleaning steps below without being written to disk
+        bold_img, aroma_out = exec_ICA_AROMA(bold_file, confounds_file, brain_mask_file, csf_mask, TR, aroma_dim,
+                                             cache_dir=cache_dir, in_memory=True, ica_engine=aroma_ica_engine)
+        filename_template += '_aroma'
+    else:
+        bold_img = nb.load(bold_file)
+        aroma_out = None
 
     confounds = pd.read_csv(confounds_file)
     keys = confounds.keys()
@@ -213,11 +227,10 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
         total_VE = pred_VE*VE_tot
         return total_VE, VE_observations, residuals
 
-    import nibabel as nb
     brain_mask = np.asarray(nb.load(brain_mask_file).dataobj)
     volume_indices = brain_mask.astype(bool)
 
-    data_array = np.asarray(nb.load(bold_file).dataobj)
+    data_array = np.asarray(bold_img.dataobj)
     timeseries = np.zeros([data_array.shape[3], volume_indices.sum()])
     for i in range(data_array.shape[3]):
         timeseries[i, :] = (data_array[:, :, :, i])[volume_indices]
@@ -239,16 +252,16 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
         i += 1
 
     import pickle
-    VE_file = cr_out+'/'+filename_split[0]+'_VE_dict.pkl'
+    VE_file = cr_out+'/'+filename_template+'_VE_dict.pkl'
     with open(VE_file, 'wb') as handle:
         pickle.dump(VE_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
     # cleaning includes detrending, standardization
     if len(conf_list) > 0:
-        cleaned = nilearn.image.clean_img(bold_file, detrend=True, standardize=True, low_pass=lowpass,
+        cleaned = nilearn.image.clean_img(bold_img, detrend=True, standardize=True, low_pass=lowpass,
                                           high_pass=highpass, confounds=confounds_array, t_r=TR, mask_img=brain_mask_file)
     else:
-        cleaned = nilearn.image.clean_img(bold_file, detrend=True, standardize=True,
+        cleaned = nilearn.image.clean_img(bold_img, detrend=True, standardize=True,
                                           low_pass=lowpass, high_pass=highpass, confounds=None, t_r=TR, mask_img=brain_mask_file)
 
     if apply_scrubbing:
@@ -258,9 +271,9 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
     if smoothing_filter is not None:
         cleaned = nilearn.image.smooth_img(cleaned, smoothing_filter)
 
-    cleaned_path = cr_out+'/'+filename_split[0]+'_cleaned.nii.gz'
+    cleaned_path = cr_out+'/'+filename_template+'_cleaned.nii.gz'
     cleaned.to_filename(cleaned_path)
-    return cleaned_path, bold_file, VE_file
+    return cleaned_path, bold_file, VE_file, aroma_out
 
 
 class data_diagnosisInputSpec(BaseInterfaceInputSpec):
@@ -295,13 +308,15 @@ class data_diagnosis(BaseInterface):
         command = 'melodic -i %s -o %s -m %s --report' % (
             self.inputs.cleaned_path, mel_out, self.inputs.brain_mask_file)
         os.system(command)
+
+        from rabies.preprocess_pkg.utils import compute_temporal_stats
+        mean, std, tSNR, DVARS = compute_temporal_stats(
+            self.inputs.bold_file, self.inputs.brain_mask_file)
         img = nb.load(self.inputs.bold_file)
-        array = np.asarray(img.dataobj)
-        mean = array.mean(axis=3)
-        std = array.std(axis=3)
-        tSNR = np.divide(mean, std)
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
         tSNR_file = os.path.abspath('tSNR.nii.gz')
-        nb.Nifti1Image(tSNR, img.affine, img.header).to_filename(tSNR_file)
+        nb.Nifti1Image(tSNR, img.affine, header).to_filename(tSNR_file)
 
         setattr(self, 'tSNR_file', tSNR_file)
         setattr(self, 'mel_out', mel_out)
@@ -24,6 +24,9 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
             path to output folder for the workflow and datasink
         apply_despiking
             whether to apply despiking using AFNI's 3dDespike https://afni.nimh.nih.gov/pub/dist/doc/program_help/3dDespike.html.
+        despike_method
+            'afni' runs 3dDespike on the input EPI, before the BOLD reference and motion estimation, while
+            'native' computes the despiking in-process within the STC step, after these are derived.
         tr
             repetition time for the EPI
         tpattern
@@ -32,6 +35,9 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
             whether to apply slice timing correction (STC) or not
         detect_dummy
             whether to detect and remove dummy volumes at the beginning of the EPI Sequences
+        hmc_engine
+            'ants' runs antsMotionCorr for head motion estimation, while 'sitk' estimates the rigid parameters in-process,
+            without writing motion corrected timeseries unless slice_mc is selected
         slice_mc
             whether to apply slice-specific motion correction through 2D registration of each slice, which can improve the correction
             of within-TR motion
@@ -45,6 +51,9 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
             Specified dimensions for the resampling of the corrected EPI in native space.
         commonspace_resampling
             Specified dimensions for the resampling of the corrected EPI in common space.
+        brain_crop
+            whether to crop the resampled EPI grids (and the HMC reference with the 'sitk' engine) to the padded bounding
+            box of the brain mask, so that the subsequent voxelwise steps are computed over the brain only
 
     **Outputs**
 
@@ -157,23 +166,27 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
         num_scan = opts.local_threads
 
     # execute the registration of the generate anatomical template with the provided atlas for labeling and masking
-    template_reg = pe.Node(Function(input_names=['reg_method', 'moving_image', 'fixed_image', 'anat_mask', 'rabies_data_type'],
+    # registrations are cached across runs, keyed on the content of their inputs
+    if opts.no_reg_cache:
+        reg_cache_dir = None
+    else:
+        reg_cache_dir = output_folder+'/rabies_cache/registrations'
+
+    template_reg = pe.Node(Function(input_names=['reg_method', 'moving_image', 'fixed_image', 'anat_mask', 'rabies_data_type', 'cache_dir'],
                                     output_names=['affine', 'warp',
                                                   'inverse_warp', 'warped_image'],
                                     function=run_antsRegistration),
                            name='template_reg', mem_gb=2*opts.scale_min_memory)
     template_reg.inputs.anat_mask = str(opts.brain_mask)
     template_reg.inputs.rabies_data_type = opts.data_type
+    template_reg.inputs.cache_dir = reg_cache_dir
 
-    bold_main_wf = init_bold_main_wf(opts=opts)
+    bold_main_wf = init_bold_main_wf(opts=opts, cache_dir=reg_cache_dir)
 
     if opts.fast_commonspace:
-        import rabies
-        dir_path = os.path.dirname(os.path.realpath(rabies.__file__))
-        reg_script = dir_path+'/shell_scripts/null_nonlin.sh'
-        template_reg.inputs.reg_method = str(reg_script)
+        template_reg.inputs.reg_method = 'null_nonlin'
 
-        commonspace_reg = pe.Node(Function(input_names=['reg_method', 'moving_image', 'fixed_image', 'anat_mask', 'rabies_data_type'],
+        commonspace_reg = pe.Node(Function(input_names=['reg_method', 'moving_image', 'fixed_image', 'anat_mask', 'rabies_data_type', 'cache_dir'],
                                            output_names=['affine', 'warp',
                                                          'inverse_warp', 'warped_image'],
                                            function=run_antsRegistration),
@@ -183,6 +196,7 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
         commonspace_reg.inputs.anat_mask = str(opts.brain_mask)
         commonspace_reg.inputs.reg_method = str(opts.template_reg_script)
         commonspace_reg.inputs.rabies_data_type = opts.data_type
+        commonspace_reg.inputs.cache_dir = reg_cache_dir
 
         commonspace_selectfiles = pe.Node(niu.IdentityInterface(fields=['anat_to_template_affine', 'anat_to_template_warp', 'anat_to_template_inverse_warp', 'warped_anat']),
                                           name="commonspace_selectfiles")
@@ -240,18 +254,23 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
     template_diagnosis.inputs.opts = opts
     template_diagnosis.inputs.out_dir = output_folder+'/QC_report/template_files/'
 
-    bold_denoising_diagnosis = pe.Node(Function(input_names=['raw_img','init_denoise','warped_mask','final_denoise', 'name_source', 'out_dir'],
+    bold_denoising_diagnosis = pe.Node(Function(input_names=['raw_img','init_denoise','warped_mask','final_denoise', 'name_source', 'out_dir', 'dpi', 'max_dim', 'qc_mode'],
                                        function=visual_diagnosis.denoising_diagnosis),
                               name='bold_denoising_diagnosis')
     bold_denoising_diagnosis.inputs.out_dir = output_folder+'/QC_report/bold_denoising/'
+    bold_denoising_diagnosis.inputs.dpi = opts.qc_dpi
+    bold_denoising_diagnosis.inputs.max_dim = opts.qc_max_dim
+    bold_denoising_diagnosis.inputs.qc_mode = opts.qc_mode
 
-    temporal_diagnosis = pe.Node(Function(input_names=['bold_file', 'confounds_csv', 'FD_csv', 'rabies_data_type', 'name_source', 'out_dir'],
+    temporal_diagnosis = pe.Node(Function(input_names=['bold_file', 'brain_mask', 'confounds_csv', 'FD_csv', 'name_source', 'out_dir', 'dpi', 'max_dim', 'qc_mode'],
                                           output_names=[
                                             'std_filename', 'tSNR_filename'],
                                        function=visual_diagnosis.temporal_diagnosis),
                               name='temporal_diagnosis')
     temporal_diagnosis.inputs.out_dir = output_folder+'/QC_report/temporal_diagnosis/'
-    temporal_diagnosis.inputs.rabies_data_type = opts.data_type
+    temporal_diagnosis.inputs.dpi = opts.qc_dpi
+    temporal_diagnosis.inputs.max_dim = opts.qc_max_dim
+    temporal_diagnosis.inputs.qc_mode = opts.qc_mode
 
     # MAIN WORKFLOW STRUCTURE #######################################################
     workflow.connect([
@@ -267,6 +286,9 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
         (bold_convert_to_RAS_node, bold_main_wf, [
             ("RAS_file", "inputnode.bold"),
             ]),
+        (bold_selectfiles, bold_main_wf, [
+            ("out_file", "inputnode.bids_bold"),
+            ]),
         (resample_template_node, template_diagnosis, [
             ("resampled_template", "anat_template"),
             ]),
@@ -316,6 +338,7 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
          [("out_file", "name_source")]),
         (bold_main_wf, temporal_diagnosis, [
             ("outputnode.commonspace_bold", "bold_file"),
+            ("outputnode.commonspace_mask", "brain_mask"),
             ("outputnode.confounds_csv", "confounds_csv"),
             ("outputnode.FD_csv", "FD_csv"),
             ]),
@@ -344,7 +367,8 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
 
         # setting anat preprocessing nodes
         anat_preproc_wf = init_anat_preproc_wf(reg_script=opts.anat_reg_script,
-                                               disable_anat_preproc=opts.disable_anat_preproc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory)
+                                               disable_anat_preproc=opts.disable_anat_preproc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory,
+                                               cache_dir=reg_cache_dir)
         anat_preproc_wf.inputs.inputnode.template_mask = str(opts.brain_mask)
 
         transform_masks = pe.Node(Function(input_names=['brain_mask_in', 'WM_mask_in', 'CSF_mask_in', 'vascular_mask_in', 'atlas_labels_in', 'reference_image', 'anat_to_template_inverse_warp', 'anat_to_template_affine', 'template_to_common_affine', 'template_to_common_inverse_warp'],
@@ -407,10 +431,13 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
             ])
 
         if not opts.disable_anat_preproc:
-            anat_denoising_diagnosis = pe.Node(Function(input_names=['raw_img','init_denoise','warped_mask','final_denoise', 'name_source', 'out_dir'],
+            anat_denoising_diagnosis = pe.Node(Function(input_names=['raw_img','init_denoise','warped_mask','final_denoise', 'name_source', 'out_dir', 'dpi', 'max_dim', 'qc_mode'],
                                                function=visual_diagnosis.denoising_diagnosis),
                                       name='anat_denoising_diagnosis')
             anat_denoising_diagnosis.inputs.out_dir = output_folder+'/QC_report/anat_denoising/'
+            anat_denoising_diagnosis.inputs.dpi = opts.qc_dpi
+            anat_denoising_diagnosis.inputs.max_dim = opts.qc_max_dim
+            anat_denoising_diagnosis.inputs.qc_mode = opts.qc_mode
 
             workflow.connect([
                 (anat_selectfiles, anat_denoising_diagnosis, [
@@ -432,7 +459,7 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
         bold_main_wf.inputs.inputnode.labels = str(opts.atlas_labels)
 
         bias_cor_bold_main_wf = init_bold_main_wf(
-            bias_cor_only=True, name='bias_cor_bold_main_wf', opts=opts)
+            bias_cor_only=True, name='bias_cor_bold_main_wf', opts=opts, cache_dir=reg_cache_dir)
         bias_cor_bold_main_wf.inputs.inputnode.anat_mask = str(opts.brain_mask)
 
         workflow.connect([
@@ -458,15 +485,18 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
     PlotOverlap_Anat2Template_node = pe.Node(
         visual_diagnosis.PlotOverlap(), name='PlotOverlap_Anat2Template')
     PlotOverlap_Anat2Template_node.inputs.out_dir = output_folder+'/QC_report/Anat2Template/'
+    PlotOverlap_Anat2Template_node.inputs.qc_mode = opts.qc_mode
     PlotOverlap_Template2Commonspace_node = pe.Node(
         visual_diagnosis.PlotOverlap(), name='PlotOverlap_Template2Commonspace')
     PlotOverlap_Template2Commonspace_node.inputs.out_dir = output_folder+'/QC_report/Template2Commonspace'
     PlotOverlap_Template2Commonspace_node.inputs.name_source = ''
+    PlotOverlap_Template2Commonspace_node.inputs.qc_mode = opts.qc_mode
 
     if not opts.bold_only:
         PlotOverlap_EPI2Anat_node = pe.Node(
             visual_diagnosis.PlotOverlap(), name='PlotOverlap_EPI2Anat')
         PlotOverlap_EPI2Anat_node.inputs.out_dir = output_folder+'/QC_report/EPI2Anat'
+        PlotOverlap_EPI2Anat_node.inputs.qc_mode = opts.qc_mode
         workflow.connect([
             (bold_selectfiles, PlotOverlap_EPI2Anat_node,
              [("out_file", "name_source")]),
@@ -503,12 +533,12 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
     # Integrate confound regression
     if cr_opts is not None:
         workflow, confound_regression_wf = integrate_confound_regression(
-            workflow, outputnode, cr_opts, bold_only=opts.bold_only)
+            workflow, outputnode, cr_opts, bold_only=opts.bold_only, cache_dir=output_folder+'/rabies_cache')
 
         # Integrate analysis
         if analysis_opts is not None:
             workflow = integrate_analysis(
-                workflow, outputnode, confound_regression_wf, analysis_opts, opts.bold_only, cr_opts.commonspace_bold)
+                workflow, outputnode, confound_regression_wf, analysis_opts, opts.bold_only, cr_opts.commonspace_bold, cache_dir=output_folder+'/rabies_cache')
 
     elif opts.rabies_step == 'preprocess':
         # Datasink - creates output folder for important outputs
@@ -603,13 +633,14 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
     return workflow
 
 
-def integrate_confound_regression(workflow, outputnode, cr_opts, bold_only):
+def integrate_confound_regression(workflow, outputnode, cr_opts, bold_only, cache_dir):
     cr_output = os.path.abspath(str(cr_opts.output_dir))
 
     from rabies.conf_reg_pkg.confound_regression import init_confound_regression_wf
     confound_regression_wf = init_confound_regression_wf(lowpass=cr_opts.lowpass, highpass=cr_opts.highpass,
-                                                         smoothing_filter=cr_opts.smoothing_filter, run_aroma=cr_opts.run_aroma, aroma_dim=cr_opts.aroma_dim, conf_list=cr_opts.conf_list, TR=cr_opts.TR, apply_scrubbing=cr_opts.apply_scrubbing,
-                                                         scrubbing_threshold=cr_opts.scrubbing_threshold, timeseries_interval=cr_opts.timeseries_interval, diagnosis_output=cr_opts.diagnosis_output, name=cr_opts.wf_name)
+                                                         smoothing_filter=cr_opts.smoothing_filter, run_aroma=cr_opts.run_aroma, aroma_dim=cr_opts.aroma_dim, aroma_ica_engine=cr_opts.aroma_ica_engine, conf_list=cr_opts.conf_list, TR=cr_opts.TR, apply_scrubbing=cr_opts.apply_scrubbing,
+                                                         scrubbing_threshold=cr_opts.scrubbing_threshold, timeseries_interval=cr_opts.timeseries_interval, diagnosis_output=cr_opts.diagnosis_output, cache_dir=cache_dir+'/edge_masks',
+                                                         rabies_mem_scale=cr_opts.scale_min_memory, name=cr_opts.wf_name)
 
     workflow.connect([
         (outputnode, confound_regression_wf, [
@@ -661,12 +692,12 @@ def integrate_confound_regression(workflow, outputnode, cr_opts, bold_only):
     return workflow, confound_regression_wf
 
 
-def integrate_analysis(workflow, outputnode, confound_regression_wf, analysis_opts, bold_only, commonspace_bold):
+def integrate_analysis(workflow, outputnode, confound_regression_wf, analysis_opts, bold_only, commonspace_bold, cache_dir):
     analysis_output = os.path.abspath(str(analysis_opts.output_dir))
 
     from rabies.analysis_pkg.analysis_wf import init_analysis_wf
     analysis_wf = init_analysis_wf(
-        opts=analysis_opts, commonspace_cr=commonspace_bold, seed_list=analysis_opts.seed_list)
+        opts=analysis_opts, commonspace_cr=commonspace_bold, seed_list=analysis_opts.seed_list, cache_dir=cache_dir)
 
     analysis_datasink = pe.Node(DataSink(base_directory=analysis_output,
                                          container="analysis_datasink"),
@@ -737,6 +768,46 @@ def integrate_analysis(workflow, outputnode, confound_regression_wf, analysis_op
                 ("mask_file", "mask_file"),
                 ]),
             ])
+
+    if analysis_opts.FC_matrix is not None and analysis_opts.ROI_type == 'parcellated':
+        # the parcellated matrices from all scans are stacked into dataset-level arrays
+        from rabies.analysis_pkg.analysis_functions import stack_FC_matrices
+        FC_joinnode_main = pe.JoinNode(niu.IdentityInterface(fields=['file_list']),
+                                       name='FC_joinnode_main',
+                                       joinsource='main_split',
+                                       joinfield=['file_list'])
+        stack_FC_node = pe.Node(Function(input_names=['data_file_list'],
+                                         output_names=['stack_files', 'stats_files'],
+                                         function=stack_FC_matrices),
+                                name='stack_FC_matrices', mem_gb=1)
+        workflow.connect([
+            (FC_joinnode_main, stack_FC_node, [
+                ("file_list", "data_file_list"),
+                ]),
+            (stack_FC_node, analysis_datasink, [
+                ("stack_files", "group_FC_matrices"),
+                ("stats_files", "group_FC_stats"),
+                ]),
+            ])
+        if bold_only:
+            workflow.connect([
+                (analysis_wf, FC_joinnode_main, [
+                    ("outputnode.matrix_data_file", "file_list"),
+                    ]),
+                ])
+        else:
+            FC_joinnode_run = pe.JoinNode(niu.IdentityInterface(fields=['file_list']),
+                                          name='FC_joinnode_run',
+                                          joinsource='run_split',
+                                          joinfield=['file_list'])
+            workflow.connect([
+                (analysis_wf, FC_joinnode_run, [
+                    ("outputnode.matrix_data_file", "file_list"),
+                    ]),
+                (FC_joinnode_run, FC_joinnode_main, [
+                    ("file_list", "file_list"),
+                    ]),
+                ])
     return workflow
 
 
@@ -2,11 +2,11 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
-    File, BaseInterface
+    File, BaseInterface, isdefined
 )
 
 
-def init_anat_preproc_wf(reg_script, disable_anat_preproc=False, rabies_data_type=8, rabies_mem_scale=1.0, name='anat_preproc_wf'):
+def init_anat_preproc_wf(reg_script, disable_anat_preproc=False, rabies_data_type=8, rabies_mem_scale=1.0, cache_dir=None, name='anat_preproc_wf'):
     '''
     This workflow executes anatomical preprocessing based on anat_preproc.sh,
     which includes initial N4 bias field correction and Adaptive
@@ -23,6 +23,8 @@ def init_anat_preproc_wf(reg_script, disable_anat_preproc=False, rabies_data_typ
 
     anat_preproc = pe.Node(AnatPreproc(reg_script=reg_script, disable_anat_preproc=disable_anat_preproc, rabies_data_type=rabies_data_type),
                            name='Anat_Preproc', mem_gb=0.6*rabies_mem_scale)
+    if cache_dir is not None:
+        anat_preproc.inputs.cache_dir = cache_dir
 
     workflow.connect([
         (inputnode, anat_preproc, [
@@ -53,6 +55,8 @@ class AnatPreprocInputSpec(BaseInterfaceInputSpec):
                             desc="Specifying the script to use for registration.")
     rabies_data_type = traits.Int(mandatory=True,
         desc="Integer specifying SimpleITK data type.")
+    cache_dir = traits.Str(
+        desc="Directory of the persistent registration cache.")
 
 
 class AnatPreprocOutputSpec(TraitedSpec):
@@ -72,7 +76,7 @@ class AnatPreproc(BaseInterface):
         import os
         import numpy as np
         import SimpleITK as sitk
-        from rabies.preprocess_pkg.utils import resample_image_spacing, run_command
+        from rabies.preprocess_pkg.utils import resample_image_spacing, run_command, ensure_image_type
 
         import pathlib  # Better path manipulation
         filename_split = pathlib.Path(self.inputs.nii_anat).name.rsplit(".nii")
@@ -90,15 +94,15 @@ class AnatPreproc(BaseInterface):
         template_dim = template_image.GetSpacing()
         if not (np.array(anat_dim) == np.array(template_dim)).sum() == 3:
             print('Anat image will be resampled to the template resolution.')
-            resampled_anat = resample_image_spacing(anat_image, template_dim)
+            anat_image = resample_image_spacing(anat_image, template_dim)
             input_anat = cwd+filename_split[0]+'_resampled.nii.gz'
-            sitk.WriteImage(resampled_anat, input_anat)
+            sitk.WriteImage(anat_image, input_anat)
         else:
             input_anat = self.inputs.nii_anat
 
         if self.inputs.disable_anat_preproc:
-            # resample image to specified data format
-            sitk.WriteImage(sitk.ReadImage(input_anat, self.inputs.rabies_data_type), output_anat)
+            # the image was read with the specified data format
+            sitk.WriteImage(anat_image, output_anat)
             init_denoise=output_anat
             resampled_mask=self.inputs.template_mask
         else:
@@ -113,7 +117,8 @@ class AnatPreproc(BaseInterface):
             rc = run_command(command)
 
             from rabies.preprocess_pkg.registration import run_antsRegistration
-            [affine, warp, inverse_warp, warped_image] = run_antsRegistration(reg_method=self.inputs.reg_script, moving_image=input_anat, fixed_image=self.inputs.template_anat, anat_mask=self.inputs.template_mask)
+            [affine, warp, inverse_warp, warped_image] = run_antsRegistration(reg_method=self.inputs.reg_script, moving_image=input_anat, fixed_image=self.inputs.template_anat, anat_mask=self.inputs.template_mask,
+                cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
 
             command = 'antsApplyTransforms -d 3 -i %s -t [%s,1] -r %s -o resampled_mask.nii.gz -n GenericLabel' % (self.inputs.template_mask, affine, input_anat)
             rc = run_command(command)
@@ -123,8 +128,8 @@ class AnatPreproc(BaseInterface):
             command = 'DenoiseImage -d 3 -i N4.nii.gz -o %s' % (output_anat)
             rc = run_command(command)
 
-            # resample image to specified data format
-            sitk.WriteImage(sitk.ReadImage(output_anat, self.inputs.rabies_data_type), output_anat)
+            # convert the image to the specified data format, if DenoiseImage did not already output it
+            ensure_image_type(output_anat, self.inputs.rabies_data_type)
             init_denoise=cwd+'/denoise.nii.gz'
             resampled_mask=cwd+'/resampled_mask.nii.gz'
 
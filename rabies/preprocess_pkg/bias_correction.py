@@ -3,11 +3,11 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
-    File, BaseInterface
+    File, BaseInterface, isdefined
 )
 
 
-def bias_correction_wf(bias_cor_method='otsu_reg', rabies_data_type=8, rabies_mem_scale=1.0, name='bias_correction_wf'):
+def bias_correction_wf(bias_cor_method='otsu_reg', rabies_data_type=8, rabies_mem_scale=1.0, cache_dir=None, name='bias_correction_wf'):
 
     workflow = pe.Workflow(name=name)
 
@@ -28,6 +28,8 @@ def bias_correction_wf(bias_cor_method='otsu_reg', rabies_data_type=8, rabies_me
                                   name='bias_correction', mem_gb=0.3*rabies_mem_scale)
     else:
         raise ValueError("Wrong --bias_cor_method.")
+    if cache_dir is not None:
+        bias_correction.inputs.cache_dir = cache_dir
 
 
     workflow.connect([
@@ -57,6 +59,8 @@ class OtsuEPIBiasCorrectionInputSpec(BaseInterfaceInputSpec):
                        desc='Reference BOLD file for naming the output.')
     rabies_data_type = traits.Int(mandatory=True,
         desc="Integer specifying SimpleITK data type.")
+    cache_dir = traits.Str(
+        desc="Directory of the persistent registration cache.")
 
 
 class OtsuEPIBiasCorrectionOutputSpec(TraitedSpec):
@@ -87,7 +91,7 @@ class OtsuEPIBiasCorrection(BaseInterface):
         filename_split = pathlib.Path(
             self.inputs.name_source).name.rsplit(".nii")
 
-        from rabies.preprocess_pkg.utils import run_command, resample_image_spacing
+        from rabies.preprocess_pkg.utils import run_command, resample_image_spacing, ants_output_type
         from rabies.preprocess_pkg.registration import run_antsRegistration
 
         cwd = os.getcwd()
@@ -109,27 +113,25 @@ class OtsuEPIBiasCorrection(BaseInterface):
         largest_dim = (np.array(input_ref_EPI_img.GetSize())*np.array(input_ref_EPI_img.GetSpacing())).max()
         b_value = int(np.ceil(largest_dim/10)*10)
 
-        bias_cor_input = self.inputs.input_ref_EPI
-        otsu_bias_cor(target=bias_cor_input, otsu_ref=bias_cor_input, out_name='corrected_iter1.nii.gz', b_value=b_value)
-        otsu_bias_cor(target=bias_cor_input, otsu_ref='corrected_iter1.nii.gz', out_name='corrected_iter2.nii.gz', b_value=b_value)
+        bias_cor_input = sitk.ReadImage(self.inputs.input_ref_EPI, sitk.sitkFloat32)
+        corrected_iter1 = otsu_bias_cor(target=bias_cor_input, otsu_ref=bias_cor_input, b_value=b_value)
+        corrected_iter2 = otsu_bias_cor(target=bias_cor_input, otsu_ref=corrected_iter1, b_value=b_value)
+        # outputs are cast once to the output data type when they are first written
+        sitk.WriteImage(sitk.Cast(corrected_iter2, self.inputs.rabies_data_type), cwd+'/corrected_iter2.nii.gz')
 
-        [affine, warp, inverse_warp, warped_image] = run_antsRegistration(reg_method='Rigid', moving_image='corrected_iter2.nii.gz', fixed_image=self.inputs.anat, anat_mask=self.inputs.anat_mask)
+        [affine, warp, inverse_warp, warped_image] = run_antsRegistration(reg_method='Rigid', moving_image='corrected_iter2.nii.gz', fixed_image=self.inputs.anat, anat_mask=self.inputs.anat_mask, rabies_data_type=self.inputs.rabies_data_type,
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
 
-        command = 'antsApplyTransforms -d 3 -i %s -t [%s,1] -r %s -o %s -n GenericLabel' % (self.inputs.anat_mask, affine, 'corrected_iter2.nii.gz',resampled_mask)
+        command = 'antsApplyTransforms -d 3 -i %s -t [%s,1] -r %s -o %s -n GenericLabel -u %s' % (self.inputs.anat_mask, affine, 'corrected_iter2.nii.gz',resampled_mask, ants_output_type(self.inputs.rabies_data_type))
         rc = run_command(command)
 
-        otsu_bias_cor(target=bias_cor_input, otsu_ref='corrected_iter2.nii.gz', out_name=cwd+'/final_otsu.nii.gz', b_value=b_value, mask=resampled_mask)
+        final_otsu = otsu_bias_cor(target=bias_cor_input, otsu_ref=corrected_iter2, b_value=b_value, mask=resampled_mask)
 
         # resample to anatomical image resolution
         dim = sitk.ReadImage(self.inputs.anat, self.inputs.rabies_data_type).GetSpacing()
         low_dim = np.asarray(dim).min()
-        sitk.WriteImage(resample_image_spacing(sitk.ReadImage(cwd+'/final_otsu.nii.gz',
-                                                              self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI)
-
-        sitk.WriteImage(sitk.ReadImage('corrected_iter2.nii.gz', self.inputs.rabies_data_type), cwd+'/corrected_iter2.nii.gz')
-        sitk.WriteImage(sitk.ReadImage(biascor_EPI, self.inputs.rabies_data_type), biascor_EPI)
-        sitk.WriteImage(sitk.ReadImage(warped_image, self.inputs.rabies_data_type), warped_image)
-        sitk.WriteImage(sitk.ReadImage(resampled_mask, self.inputs.rabies_data_type), resampled_mask)
+        sitk.WriteImage(resample_image_spacing(sitk.Cast(final_otsu,
+                                                         self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI)
 
         setattr(self, 'init_denoise', cwd+'/corrected_iter2.nii.gz')
         setattr(self, 'corrected_EPI', biascor_EPI)
@@ -144,64 +146,68 @@ class OtsuEPIBiasCorrection(BaseInterface):
                 'init_denoise': getattr(self, 'init_denoise'),
                 'denoise_mask': getattr(self, 'denoise_mask')}
 
-def otsu_bias_cor(target, otsu_ref, out_name, b_value, mask=None, n_iter=200):
+def otsu_bias_cor(target, otsu_ref, b_value, out_name=None, mask=None, n_iter=200, shrink_factor=2, convergence_threshold=1e-4):
+    '''
+    Multi-pass N4 bias field correction of target, where each pass fits the bias field within a different
+    combination of the 5 Otsu classes of otsu_ref. target, otsu_ref and mask can be provided as files or
+    SimpleITK images. The image and masks are kept in memory across passes; each bias field is fitted on
+    the image shrunk by shrink_factor (at full resolution with SimpleITK<2.0), and applied at full resolution.
+    The corrected image is returned, and written to out_name if provided.
+    '''
+    import logging
+    import numpy as np
     import SimpleITK as sitk
-    from rabies.preprocess_pkg.utils import run_command
-    command = 'ImageMath 3 null_mask.nii.gz ThresholdAtMean %s 0' % (otsu_ref)
-    rc = run_command(command)
-    command = 'ThresholdImage 3 %s otsu_weight.nii.gz Otsu 4' % (otsu_ref)
-    rc = run_command(command)
+    from rabies.preprocess_pkg.visual_diagnosis import otsu_thresholds
+    log = logging.getLogger('root')
 
-    otsu_img = sitk.ReadImage(
-        'otsu_weight.nii.gz', sitk.sitkUInt8)
-    otsu_array = sitk.GetArrayFromImage(otsu_img)
+    if isinstance(target, str):
+        target = sitk.ReadImage(target, sitk.sitkFloat32)
+    else:
+        target = sitk.Cast(target, sitk.sitkFloat32)
+    if not isinstance(otsu_ref, str):
+        ref_array = sitk.GetArrayFromImage(otsu_ref)
+    else:
+        ref_array = sitk.GetArrayFromImage(sitk.ReadImage(otsu_ref, sitk.sitkFloat32))
 
+    # voxels above 0 define the domain of the fit, as with 'ImageMath ThresholdAtMean 0'
+    null_mask = ref_array > 0
+    # Otsu classes labeled from 0 to 4, as with 'ThresholdImage Otsu 4'
+    otsu_array = np.digitize(ref_array, otsu_thresholds(ref_array, num_thresholds=4))
     if mask is not None:
-        resampled_mask_img = sitk.ReadImage(
-            mask, sitk.sitkUInt8)
-        resampled_mask_array = sitk.GetArrayFromImage(resampled_mask_img)
-
-        otsu_array = otsu_array*resampled_mask_array
-
-    combined_mask=(otsu_array==1.0)+(otsu_array==2.0)
-    mask_img=sitk.GetImageFromArray(combined_mask.astype('uint8'), isVector=False)
-    mask_img.CopyInformation(otsu_img)
-    sitk.WriteImage(mask_img, 'mask12.nii.gz')
-
-    combined_mask=(otsu_array==3.0)+(otsu_array==4.0)
-    mask_img=sitk.GetImageFromArray(combined_mask.astype('uint8'), isVector=False)
-    mask_img.CopyInformation(otsu_img)
-    sitk.WriteImage(mask_img, 'mask34.nii.gz')
-
-    combined_mask=(otsu_array==1.0)+(otsu_array==2.0)+(otsu_array==3.0)
-    mask_img=sitk.GetImageFromArray(combined_mask.astype('uint8'), isVector=False)
-    mask_img.CopyInformation(otsu_img)
-    sitk.WriteImage(mask_img, 'mask123.nii.gz')
-
-    combined_mask=(otsu_array==2.0)+(otsu_array==3.0)+(otsu_array==4.0)
-    mask_img=sitk.GetImageFromArray(combined_mask.astype('uint8'), isVector=False)
-    mask_img.CopyInformation(otsu_img)
-    sitk.WriteImage(mask_img, 'mask234.nii.gz')
-
-    combined_mask=(otsu_array==1.0)+(otsu_array==2.0)+(otsu_array==3.0)+(otsu_array==4.0)
-    mask_img=sitk.GetImageFromArray(combined_mask.astype('uint8'), isVector=False)
-    mask_img.CopyInformation(otsu_img)
-    sitk.WriteImage(mask_img, 'mask1234.nii.gz')
-
-    command = 'N4BiasFieldCorrection -d 3 -i %s -b %s -s 1 -c [%sx%sx%s,1e-4] -w mask12.nii.gz -x null_mask.nii.gz -o corrected1.nii.gz' % (target, str(b_value), str(n_iter),str(n_iter),str(n_iter),)
-    rc = run_command(command)
-
-    command = 'N4BiasFieldCorrection -d 3 -i corrected1.nii.gz -b %s -s 1 -c [%sx%sx%s,1e-4] -w mask34.nii.gz -x null_mask.nii.gz -o corrected2.nii.gz' % (str(b_value), str(n_iter),str(n_iter),str(n_iter),)
-    rc = run_command(command)
-
-    command = 'N4BiasFieldCorrection -d 3 -i corrected2.nii.gz -b %s -s 1 -c [%sx%sx%s,1e-4] -w mask123.nii.gz -x null_mask.nii.gz -o corrected3.nii.gz' % (str(b_value), str(n_iter),str(n_iter),str(n_iter),)
-    rc = run_command(command)
-
-    command = 'N4BiasFieldCorrection -d 3 -i corrected3.nii.gz -b %s -s 1 -c [%sx%sx%s,1e-4] -w mask234.nii.gz -x null_mask.nii.gz -o corrected4.nii.gz' % (str(b_value), str(n_iter),str(n_iter),str(n_iter),)
-    rc = run_command(command)
-
-    command = 'N4BiasFieldCorrection -d 3 -i corrected4.nii.gz -b %s -s 1 -c [%sx%sx%s,1e-4] -w mask1234.nii.gz -x null_mask.nii.gz -o %s' % (str(b_value), str(n_iter),str(n_iter),str(n_iter),out_name,)
-    rc = run_command(command)
+        if isinstance(mask, str):
+            mask = sitk.ReadImage(mask, sitk.sitkUInt8)
+        otsu_array = otsu_array*sitk.GetArrayFromImage(mask)
+
+    # the B-spline mesh has a span of b_value mm, as with the -b option of N4BiasFieldCorrection
+    spline_order = 3
+    extent = (np.array(target.GetSize())-1)*np.array(target.GetSpacing())
+    control_points = [int(np.ceil(e/b_value))+spline_order for e in extent]
+
+    corrected = target
+    for i, classes in enumerate([[1, 2], [3, 4], [1, 2, 3], [2, 3, 4], [1, 2, 3, 4]]):
+        fit_mask = sitk.GetImageFromArray((np.isin(otsu_array, classes)*null_mask).astype(np.uint8), isVector=False)
+        fit_mask.CopyInformation(target)
+
+        n4 = sitk.N4BiasFieldCorrectionImageFilter()
+        n4.SetMaximumNumberOfIterations([n_iter]*3)
+        n4.SetConvergenceThreshold(convergence_threshold)
+        n4.SetSplineOrder(spline_order)
+        n4.SetNumberOfControlPoints(control_points)
+        # GetLogBiasFieldAsImage is only available from SimpleITK 2.0; with earlier versions the fitted field
+        # cannot be evaluated on another grid, and N4 is run at full resolution
+        if shrink_factor > 1 and hasattr(n4, 'GetLogBiasFieldAsImage'):
+            n4.Execute(sitk.Shrink(corrected, [shrink_factor]*3), sitk.Shrink(fit_mask, [shrink_factor]*3))
+            # the fitted field is evaluated on the full resolution grid
+            log_bias_field = sitk.Cast(n4.GetLogBiasFieldAsImage(corrected), sitk.sitkFloat32)
+            corrected = sitk.Cast(corrected/sitk.Exp(log_bias_field), sitk.sitkFloat32)
+        else:
+            corrected = sitk.Cast(n4.Execute(corrected, fit_mask), sitk.sitkFloat32)
+        log.info('N4 pass %i/5: %i iterations at the last fitting level, convergence measure %.2e.' % (
+            i+1, n4.GetElapsedIterations(), n4.GetCurrentConvergenceMeasurement()))
+
+    if out_name is not None:
+        sitk.WriteImage(corrected, out_name)
+    return corrected
 
 class EPIBiasCorrectionInputSpec(BaseInterfaceInputSpec):
     input_ref_EPI = File(exists=True, mandatory=True,
@@ -214,6 +220,8 @@ class EPIBiasCorrectionInputSpec(BaseInterfaceInputSpec):
                        desc='Reference BOLD file for naming the output.')
     rabies_data_type = traits.Int(mandatory=True,
         desc="Integer specifying SimpleITK data type.")
+    cache_dir = traits.Str(
+        desc="Directory of the persistent registration cache.")
 
 
 class EPIBiasCorrectionOutputSpec(TraitedSpec):
@@ -245,7 +253,7 @@ class EPIBiasCorrection(BaseInterface):
         filename_split = pathlib.Path(
             self.inputs.name_source).name.rsplit(".nii")
 
-        from rabies.preprocess_pkg.utils import run_command, resample_image_spacing
+        from rabies.preprocess_pkg.utils import run_command, resample_image_spacing, ants_output_type
         from rabies.preprocess_pkg.registration import run_antsRegistration
 
         cwd = os.getcwd()
@@ -261,9 +269,10 @@ class EPIBiasCorrection(BaseInterface):
         command = 'N4BiasFieldCorrection -d 3 -i %s -b 20 -s 1 -c [100x100x100x100,1e-6] -w thresh_mask.nii.gz -x null_mask.nii.gz -o corrected.nii.gz' % (self.inputs.input_ref_EPI)
         rc = run_command(command)
 
-        [affine, warp, inverse_warp, warped_image] = run_antsRegistration(reg_method='Rigid', moving_image=cwd+'/corrected.nii.gz', fixed_image=self.inputs.anat, anat_mask=self.inputs.anat_mask)
+        [affine, warp, inverse_warp, warped_image] = run_antsRegistration(reg_method='Rigid', moving_image=cwd+'/corrected.nii.gz', fixed_image=self.inputs.anat, anat_mask=self.inputs.anat_mask, rabies_data_type=self.inputs.rabies_data_type,
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
 
-        command = 'antsApplyTransforms -d 3 -i %s -t [%s,1] -r %s -o %s -n GenericLabel' % (self.inputs.anat_mask, affine, self.inputs.input_ref_EPI,resampled_mask)
+        command = 'antsApplyTransforms -d 3 -i %s -t [%s,1] -r %s -o %s -n GenericLabel -u %s' % (self.inputs.anat_mask, affine, self.inputs.input_ref_EPI,resampled_mask, ants_output_type(self.inputs.rabies_data_type))
         rc = run_command(command)
 
         command = 'N4BiasFieldCorrection -d 3 -i %s -b 20 -s 1 -c [100x100x100x100,1e-6] -w %s -x null_mask.nii.gz -o %s' % (self.inputs.input_ref_EPI, resampled_mask,cwd+'/iter_corrected.nii.gz')
@@ -275,10 +284,6 @@ class EPIBiasCorrection(BaseInterface):
         sitk.WriteImage(resample_image_spacing(sitk.ReadImage(cwd+'/iter_corrected.nii.gz',
                                                               self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI)
 
-        sitk.WriteImage(sitk.ReadImage(biascor_EPI, self.inputs.rabies_data_type), biascor_EPI)
-        sitk.WriteImage(sitk.ReadImage(warped_image, self.inputs.rabies_data_type), warped_image)
-        sitk.WriteImage(sitk.ReadImage(resampled_mask, self.inputs.rabies_data_type), resampled_mask)
-
         setattr(self, 'corrected_EPI', biascor_EPI)
         setattr(self, 'warped_EPI', warped_image)
         setattr(self, 'denoise_mask', resampled_mask)
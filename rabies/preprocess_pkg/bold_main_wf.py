@@ -1,3 +1,4 @@
+import os
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu, afni
 
@@ -11,7 +12,7 @@ from .confounds import init_bold_confs_wf
 from nipype.interfaces.utility import Function
 
 
-def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bold_main_wf'):
+def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', cache_dir=None, name='bold_main_wf'):
     """
     This workflow controls the functional preprocessing stages of the pipeline when both
     functional and anatomical images are provided.
@@ -20,14 +21,23 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
 
         apply_despiking
             whether to apply despiking using AFNI's 3dDespike https://afni.nimh.nih.gov/pub/dist/doc/program_help/3dDespike.html.
+        despike_method
+            'afni' runs 3dDespike on the input EPI, before the BOLD reference and motion estimation, while
+            'native' computes the despiking in-process within the STC step, after these are derived.
         tr
             repetition time for the EPI
         tpattern
-            specification for the within TR slice acquisition method. The input is fed to AFNI's 3dTshift
+            specification for the within TR slice acquisition method, 'alt' or 'seq' (as AFNI's 3dTshift alt-z and seq-z),
+            or 'bids' to use the SliceTiming metadata of the BIDS dataset
+        stc_interpolation
+            interpolation used to shift the slice timeseries, 'quintic', 'sinc' or 'fft'
         no_STC
             whether to apply slice timing correction (STC) or not
         detect_dummy
             whether to detect and remove dummy volumes at the beginning of the EPI Sequences
+        hmc_engine
+            'ants' runs antsMotionCorr for head motion estimation, while 'sitk' estimates the rigid parameters in-process,
+            without writing motion corrected timeseries unless slice_mc is selected
         slice_mc
             whether to apply slice-specific motion correction through 2D registration of each slice, which can improve the correction
             of within-TR motion
@@ -39,11 +49,19 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
             Specified dimensions for the resampling of the corrected EPI in native space.
         commonspace_resampling
             Specified dimensions for the resampling of the corrected EPI in common space.
+        cache_dir
+            Directory of the persistent registration cache, from which registrations computed
+            in a previous run with the same inputs are restored
+        brain_crop
+            whether to crop the resampled EPI grids (and the HMC reference with the 'sitk' engine) to the padded bounding
+            box of the brain mask, so that the subsequent voxelwise steps are computed over the brain only
 
     **Inputs**
 
         bold
             Input BOLD series NIfTI file
+        bids_bold
+            Original BOLD file from the BIDS dataset, for reading its metadata
         anat_ref
             Preprocessed anatomical image after bias field correction and denoising
         anat_mask
@@ -120,7 +138,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
 
     workflow = pe.Workflow(name=name)
 
-    inputnode = pe.Node(niu.IdentityInterface(fields=['subject_id', 'bold', 'anat_ref', 'anat_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'labels', 'template_to_common_affine', 'template_to_common_warp', 'anat_to_template_affine', 'anat_to_template_warp', 'template_anat']),
+    inputnode = pe.Node(niu.IdentityInterface(fields=['subject_id', 'bold', 'bids_bold', 'anat_ref', 'anat_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'labels', 'template_to_common_affine', 'template_to_common_warp', 'anat_to_template_affine', 'anat_to_template_warp', 'template_anat']),
                         name="inputnode")
 
     outputnode = pe.Node(niu.IdentityInterface(
@@ -137,11 +155,11 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
 
     if bias_cor_only or (not opts.bold_only):
         bold_reference_wf = init_bold_reference_wf(
-            detect_dummy=opts.detect_dummy, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+            detect_dummy=opts.detect_dummy, hmc_engine=opts.hmc_engine, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads)
         bias_cor_wf = bias_correction_wf(
-            bias_cor_method=opts.bias_cor_method, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory)
+            bias_cor_method=opts.bias_cor_method, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, cache_dir=cache_dir)
 
-        if opts.apply_despiking:
+        if opts.apply_despiking and opts.despike_method == 'afni':
             despike = pe.Node(
                 afni.Despike(outputtype='NIFTI_GZ'),
                 name='despike')
@@ -193,10 +211,12 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
         return workflow
 
     bold_stc_wf = init_bold_stc_wf(
-        no_STC=opts.no_STC, tr=opts.TR, tpattern=opts.tpattern, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+        no_STC=opts.no_STC, tr=opts.TR, tpattern=opts.tpattern, stc_interpolation=opts.stc_interpolation,
+        despike=(opts.apply_despiking and opts.despike_method == 'native'), bids_dir=os.path.abspath(str(opts.bids_dir)),
+        rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads)
 
     # HMC on the BOLD
-    bold_hmc_wf = init_bold_hmc_wf(slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type,
+    bold_hmc_wf = init_bold_hmc_wf(slice_mc=opts.apply_slice_mc, hmc_engine=opts.hmc_engine, brain_crop=opts.brain_crop, crop_padding=opts.crop_padding, rabies_data_type=opts.data_type,
                                    rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads)
 
     if not opts.bold_only:
@@ -219,7 +239,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
                                               name='commonspace_transforms_prep')
 
     bold_commonspace_trans_wf = init_bold_commonspace_trans_wf(resampling_dim=opts.commonspace_resampling, brain_mask=str(opts.brain_mask), WM_mask=str(opts.WM_mask), CSF_mask=str(opts.CSF_mask), vascular_mask=str(opts.vascular_mask), atlas_labels=str(opts.labels),
-        slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+        slice_mc=opts.apply_slice_mc, brain_crop=opts.brain_crop, crop_padding=opts.crop_padding, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
 
     bold_confs_wf = init_bold_confs_wf(
         aCompCor_method=aCompCor_method, name="bold_confs_wf", rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
@@ -242,8 +262,12 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
         (transitionnode, bold_stc_wf, [
             ('bold_file', 'inputnode.bold_file'),
             ]),
+        (inputnode, bold_stc_wf, [
+            ('bids_bold', 'inputnode.name_source'),
+            ]),
         (transitionnode, bold_hmc_wf, [
             ('bold_ref', 'inputnode.ref_image'),
+            ('denoise_mask', 'inputnode.ref_mask'),
             ]),
         (bold_hmc_wf, outputnode, [
             ('outputnode.motcorr_params', 'motcorr_params')]),
@@ -288,7 +312,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
 
     if not opts.bold_only:
         bold_reg_wf = init_bold_reg_wf(coreg_script=opts.coreg_script, rabies_data_type=opts.data_type,
-                                       rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+                                       rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, cache_dir=cache_dir)
 
         def SyN_coreg_transforms_prep(warp_bold2anat, affine_bold2anat):
             # transforms_list,inverses
@@ -301,14 +325,15 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
 
         # Apply transforms in 1 shot
         bold_bold_trans_wf = init_bold_preproc_trans_wf(
-            resampling_dim=opts.nativespace_resampling, slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+            resampling_dim=opts.nativespace_resampling, slice_mc=opts.apply_slice_mc, brain_crop=opts.brain_crop, crop_padding=opts.crop_padding, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
 
         workflow.connect([
             (inputnode, bold_reg_wf, [
                 ('anat_ref', 'inputnode.anat_ref'),
                 ('anat_mask', 'inputnode.anat_mask')]),
             (inputnode, bold_bold_trans_wf, [
-                ('bold', 'inputnode.name_source')]),
+                ('bold', 'inputnode.name_source'),
+                ('anat_mask', 'inputnode.brain_mask')]),
             (transitionnode, bold_reg_wf, [
                 ('corrected_EPI', 'inputnode.ref_bold_brain')]),
             (bold_reg_wf, outputnode, [
@@ -318,7 +318,6 @@ class MaskEPI(BaseInterface):
 
     def _run_interface(self, runtime):
         import os
-        import SimpleITK as sitk
 
         import pathlib  # Better path manipulation
         filename_split = pathlib.Path(
@@ -331,14 +330,12 @@ class MaskEPI(BaseInterface):
             new_mask_path = os.path.abspath('%s_%s.nii.gz' % (
                 filename_split[0], self.inputs.name_spec,))
 
+        # the mask is directly written as int16
         command = 'antsApplyTransforms -i ' + self.inputs.mask + ' -r ' + \
-            self.inputs.ref_EPI + ' -o ' + new_mask_path + ' -n GenericLabel'
+            self.inputs.ref_EPI + ' -o ' + new_mask_path + ' -n GenericLabel -u short'
         from rabies.preprocess_pkg.utils import run_command
         rc = run_command(command)
 
-        sitk.WriteImage(sitk.ReadImage(
-            new_mask_path, sitk.sitkInt16), new_mask_path)
-
         setattr(self, 'EPI_mask', new_mask_path)
         return runtime
 
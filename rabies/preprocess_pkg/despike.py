@@ -0,0 +1,121 @@
+def despike_design(num_timepoints, corder=None):
+    '''
+    Returns the (time x regressors) design matrix of the curve fitted by AFNI's 3dDespike, i.e. a quadratic
+    trend and corder pairs of sinusoids over the duration of the timeseries. The default corder is
+    num_timepoints/30, as in 3dDespike.
+    '''
+    import numpy as np
+    if corder is None:
+        corder = int(num_timepoints/30)
+    t = np.arange(num_timepoints)
+    # the trend is defined over [-1,1] to keep the fit well conditioned
+    u = 2*t/max(num_timepoints-1, 1)-1
+    regressors = [np.ones(num_timepoints), u, u**2]
+    for k in range(1, corder+1):
+        regressors.append(np.sin(2*np.pi*k*t/num_timepoints))
+        regressors.append(np.cos(2*np.pi*k*t/num_timepoints))
+    return np.stack(regressors, axis=1)
+
+
+def l1_fit(timeseries, design, n_iter=30, tol=1e-4):
+    '''
+    Fits the design to each (time x voxels) timeseries by minimizing the sum of absolute residuals, through
+    iteratively reweighted least squares vectorized across voxels. Returns the fitted timeseries.
+    '''
+    import numpy as np
+    num_regressors = design.shape[1]
+    # outer products of the regressors at each timepoint, so that the weighted normal equations of every
+    # voxel are obtained with a single matrix product
+    outer = (design[:, :, None]*design[:, None, :]).reshape(design.shape[0], -1)
+
+    betas = np.linalg.lstsq(design, timeseries, rcond=None)[0]
+    fit = design.dot(betas)
+    # lower bound on the residuals defining the weights, relative to the scale of each voxel
+    delta = np.maximum(1e-6*np.abs(timeseries).mean(axis=0), 1e-10)
+    cost = np.abs(timeseries-fit).sum(axis=0)
+    for i in range(n_iter):
+        weights = 1/np.maximum(np.abs(timeseries-fit), delta)
+        normal = weights.T.dot(outer).reshape(-1, num_regressors, num_regressors)
+        rhs = (weights*timeseries).T.dot(design)
+        betas = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0].T
+        fit = design.dot(betas)
+        new_cost = np.abs(timeseries-fit).sum(axis=0)
+        if np.max((cost-new_cost)/np.maximum(cost, delta)) < tol:
+            break
+        cost = new_cost
+    return fit
+
+
+def despike_timeseries(timeseries, corder=None, cut=(2.5, 4.0)):
+    '''
+    Despiking of (time x voxels) timeseries following AFNI's 3dDespike: a curve is fitted with L1 regression,
+    the scale of the residuals is estimated as sigma = sqrt(pi/2)*MAD, and residuals s=r/sigma beyond c1 are
+    squashed to c1+(c2-c1)*tanh((s-c1)/(c2-c1)), so that no value exceeds c2 sigma from the fit.
+    Returns the despiked timeseries and the number of values which were modified.
+    '''
+    import numpy as np
+    c1, c2 = cut
+    in_dtype = timeseries.dtype
+    # the weighted normal equations reach weights of 1/delta, which single precision cannot solve reliably,
+    # so the fit is always carried out in float64 and the output cast back to the input type
+    timeseries = timeseries.astype(np.float64)
+    design = despike_design(timeseries.shape[0], corder=corder)
+    fit = l1_fit(timeseries, design)
+    residuals = timeseries-fit
+    sigma = np.sqrt(np.pi/2)*np.median(np.abs(residuals), axis=0)
+    sigma[sigma == 0] = 1
+    s = residuals/sigma
+    spikes = np.abs(s) > c1
+    s_abs = np.abs(s[spikes])
+    s[spikes] = np.sign(s[spikes])*(c1+(c2-c1)*np.tanh((s_abs-c1)/(c2-c1)))
+    despiked = timeseries
+    despiked[spikes] = (fit+s*sigma)[spikes]
+    return despiked.astype(in_dtype, copy=False), int(spikes.sum())
+
+
+def despike_array(img_array, n_threads=1, chunk_size=2000):
+    '''
+    Despikes in place a (time x ...) array, over chunks of voxels distributed on a pool of n_threads threads.
+    Voxels with a constant timeseries (e.g. the background) are left unchanged.
+    '''
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from nipype import logging
+    log = logging.getLogger('nipype.workflow')
+
+    num_timepoints = img_array.shape[0]
+    # view of the array as (time x voxels)
+    voxels = img_array.reshape(num_timepoints, -1)
+    indices = np.flatnonzero(voxels.max(axis=0) > voxels.min(axis=0))
+
+    def despike_chunk(start):
+        chunk = indices[start:start+chunk_size]
+        voxels[:, chunk], num_spikes = despike_timeseries(voxels[:, chunk])
+        return num_spikes
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        num_spikes = sum(executor.map(despike_chunk, range(0, len(indices), chunk_size)))
+    log.info("Despiking: %i out of %i values were squashed." % (num_spikes, num_timepoints*len(indices)))
+    return img_array
+
+
+def despike(in_file, rabies_data_type=8, n_threads=1):
+    '''
+    Applies despiking (as AFNI's 3dDespike) to the input 4D image.
+    '''
+    import os
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.despike import despike_array
+
+    img = sitk.ReadImage(in_file, sitk.sitkFloat32)
+    img_array = despike_array(sitk.GetArrayFromImage(img), n_threads=n_threads)
+
+    out_dtype = sitk.GetArrayViewFromImage(sitk.Image([1, 1, 1], rabies_data_type)).dtype
+    image_out = sitk.GetImageFromArray(img_array.astype(out_dtype, copy=False), isVector=False)
+    image_out.CopyInformation(img)
+
+    import pathlib  # Better path manipulation
+    filename_split = pathlib.Path(in_file).name.rsplit(".nii")
+    out_file = os.path.abspath(filename_split[0]+'_despike.nii.gz')
+    sitk.WriteImage(image_out, out_file)
+    return out_file
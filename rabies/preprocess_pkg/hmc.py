@@ -7,12 +7,18 @@ from nipype.interfaces.base import (
 from .utils import SliceMotionCorrection
 
 
-def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='bold_hmc_wf'):
+def init_bold_hmc_wf(slice_mc=False, hmc_engine='ants', brain_crop=False, crop_padding=4, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='bold_hmc_wf'):
     """
     This workflow estimates the motion parameters to perform HMC over the BOLD image.
 
     **Parameters**
 
+        hmc_engine : str
+            'ants' runs antsMotionCorr, while 'sitk' estimates the rigid parameters in-process
+            with SimpleITK, in parallel across volumes. With 'sitk', the motion corrected
+            timeseries are only resampled if required by the slice-specific correction.
+        brain_crop : bool
+            With 'sitk', restricts the registration to the bounding box of ref_mask.
         name : str
             Name of workflow (default: ``bold_hmc_wf``)
 
@@ -22,6 +28,8 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
             BOLD series NIfTI file
         ref_image
             Reference image to which BOLD series is motion corrected
+        ref_mask
+            Brain mask on the reference image, used with brain_crop
 
     **Outputs**
 
@@ -31,7 +39,7 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
     import os
 
     workflow = pe.Workflow(name=name)
-    inputnode = pe.Node(niu.IdentityInterface(fields=['bold_file', 'ref_image']),
+    inputnode = pe.Node(niu.IdentityInterface(fields=['bold_file', 'ref_image', 'ref_mask']),
                         name='inputnode')
     outputnode = pe.Node(
         niu.IdentityInterface(
@@ -39,10 +47,18 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
         name='outputnode')
 
     # Head motion correction (hmc)
-    motion_estimation = pe.Node(EstimateMotion(rabies_data_type=rabies_data_type), name='ants_MC', mem_gb=1.1*rabies_mem_scale)
+    hmc_n_procs = int(local_threads/4)+1
+    motion_estimation = pe.Node(EstimateMotion(rabies_data_type=rabies_data_type, hmc_engine=hmc_engine, write_corrected=slice_mc, n_procs=hmc_n_procs),
+                                name='ants_MC', mem_gb=1.1*rabies_mem_scale, n_procs=hmc_n_procs)
     motion_estimation.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
+    if brain_crop and hmc_engine == 'sitk':
+        motion_estimation.inputs.crop_padding = crop_padding
+        workflow.connect([
+            (inputnode, motion_estimation, [('ref_mask', 'ref_mask')]),
+        ])
+
     workflow.connect([
         (inputnode, motion_estimation, [('ref_image', 'ref_file'),
                                         ('bold_file', 'in_file')]),
@@ -76,6 +92,16 @@ class EstimateMotionInputSpec(BaseInterfaceInputSpec):
                     desc="Reference image to which timeseries are realigned for motion estimation")
     rabies_data_type = traits.Int(mandatory=True,
         desc="Integer specifying SimpleITK data type.")
+    hmc_engine = traits.Enum('ants', 'sitk', usedefault=True,
+        desc="'ants' runs antsMotionCorr, and 'sitk' runs the in-process SimpleITK rigid registration.")
+    write_corrected = traits.Bool(True, usedefault=True,
+        desc="Whether to write the motion corrected timeseries. Always written with 'ants'.")
+    n_procs = traits.Int(1, usedefault=True,
+        desc="Number of processes registering volumes in parallel with 'sitk'.")
+    ref_mask = File(exists=True,
+        desc="Brain mask on the reference image. With 'sitk', the registration is restricted to its bounding box.")
+    crop_padding = traits.Int(4, usedefault=True,
+        desc="Number of voxels padded around the bounding box of ref_mask.")
 
 
 class EstimateMotionOutputSpec(TraitedSpec):
@@ -86,7 +112,8 @@ class EstimateMotionOutputSpec(TraitedSpec):
 
 class EstimateMotion(BaseInterface):
     """
-    Runs ants motion correction interface and returns the motion estimation
+    Runs ants motion correction interface, or the equivalent SimpleITK rigid registration,
+    and returns the motion estimation
     """
 
     input_spec = EstimateMotionInputSpec
@@ -94,6 +121,29 @@ class EstimateMotion(BaseInterface):
 
     def _run_interface(self, runtime):
         import os
+        if self.inputs.hmc_engine == 'sitk':
+            import SimpleITK as sitk
+            from .hmc import sitk_motion_correction, write_MOCOparams
+            from .utils import copyInfo_4DImage
+            from nipype.interfaces.base import isdefined
+            mask_file = self.inputs.ref_mask if isdefined(self.inputs.ref_mask) else None
+            motcorr_params, corrected_array = sitk_motion_correction(
+                self.inputs.in_file, self.inputs.ref_file, n_procs=self.inputs.n_procs, resample=self.inputs.write_corrected,
+                mask_file=mask_file, crop_padding=self.inputs.crop_padding)
+            csv_params = os.path.abspath('motcorrMOCOparams.csv')
+            write_MOCOparams(motcorr_params, csv_params)
+            setattr(self, 'csv_params', csv_params)
+
+            if self.inputs.write_corrected:
+                ref_image = sitk.ReadImage(self.inputs.ref_file)
+                out_dtype = sitk.GetArrayViewFromImage(sitk.Image([1, 1, 1], self.inputs.rabies_data_type)).dtype
+                corrected_image = copyInfo_4DImage(sitk.GetImageFromArray(
+                    corrected_array.astype(out_dtype, copy=False), isVector=False), ref_image, sitk.ReadImage(self.inputs.in_file))
+                mc_corrected_bold = os.path.abspath('motcorr.nii.gz')
+                sitk.WriteImage(corrected_image, mc_corrected_bold)
+                setattr(self, 'mc_corrected_bold', mc_corrected_bold)
+            return runtime
+
         from .utils import antsMotionCorr
         res = antsMotionCorr(in_file=self.inputs.in_file,
                              ref_file=self.inputs.ref_file, second=False, rabies_data_type=self.inputs.rabies_data_type).run()
@@ -106,5 +156,167 @@ class EstimateMotion(BaseInterface):
         return runtime
 
     def _list_outputs(self):
-        return {'mc_corrected_bold': getattr(self, 'mc_corrected_bold'),
-                'motcorr_params': getattr(self, 'csv_params')}
+        outputs = {'motcorr_params': getattr(self, 'csv_params')}
+        # parameters-only mode: no motion corrected timeseries were written
+        if hasattr(self, 'mc_corrected_bold'):
+            outputs['mc_corrected_bold'] = getattr(self, 'mc_corrected_bold')
+        return outputs
+
+
+def register_volume_rigid(fixed_image, moving_image, initial_params=None, shrink_factors=[4, 2, 1], smoothing_sigmas=[2, 1, 0], n_iter=100):
+    '''
+    Rigid registration of a 3D volume to the fixed reference with the settings of the antsMotionCorr call
+    (Mattes MI with 20 bins over a regular 20% sampling, 3 resolution levels). The transform is optimized
+    around the center of the reference, and its parameters are returned for an Euler3DTransform centered
+    on the origin, as written by antsMotionCorr in the MOCOparams, together with the metric values before
+    and after registration.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+
+    center = fixed_image.TransformContinuousIndexToPhysicalPoint(
+        (np.asarray(fixed_image.GetSize())-1)/2.0)
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(center)
+
+    registration_method = sitk.ImageRegistrationMethod()
+    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=20)
+    registration_method.SetMetricSamplingStrategy(registration_method.REGULAR)
+    registration_method.SetMetricSamplingPercentage(0.2, 1)
+    registration_method.SetInterpolator(sitk.sitkLinear)
+    # steps start at the size of a voxel, and are reduced at each change of direction. The minimal step and
+    # gradient tolerance are small enough that, as with the fixed iterations of antsMotionCorr, the fit is
+    # stopped by the number of iterations rather than by a step collapsing before convergence
+    min_spacing = min(fixed_image.GetSpacing())
+    registration_method.SetOptimizerAsRegularStepGradientDescent(
+        learningRate=min_spacing, minStep=1e-6*min_spacing, numberOfIterations=n_iter, relaxationFactor=0.8,
+        gradientMagnitudeTolerance=1e-8)
+    registration_method.SetOptimizerScalesFromPhysicalShift()
+    registration_method.SetShrinkFactorsPerLevel(shrinkFactors=shrink_factors)
+    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=smoothing_sigmas)
+    # parallelism is handled across volumes
+    registration_method.SetNumberOfThreads(1)
+
+    # as with antsMotionCorr, MetricPre is evaluated without transform, before the warm start
+    registration_method.SetInitialTransform(transform, inPlace=True)
+    metric_pre = registration_method.MetricEvaluate(fixed_image, moving_image)
+    if initial_params is not None:
+        transform.SetParameters(centered_rigid_params(initial_params, center))
+        registration_method.SetInitialTransform(transform, inPlace=True)
+    registration_method.Execute(fixed_image, moving_image)
+    metric_post = registration_method.MetricEvaluate(fixed_image, moving_image)
+
+    params = origin_rigid_params(transform.GetParameters(), center)
+    return params, metric_pre, metric_post, transform
+
+
+def origin_rigid_params(params, center):
+    # converts Euler3DTransform parameters defined around center, to the same transform centered on the origin
+    import numpy as np
+    import SimpleITK as sitk
+    transform = sitk.Euler3DTransform()
+    transform.SetParameters(params)
+    rotation = np.asarray(transform.GetMatrix()).reshape(3, 3)
+    center = np.asarray(center)
+    translation = np.asarray(params[3:])+center-rotation.dot(center)
+    return list(params[:3])+list(translation)
+
+
+def centered_rigid_params(params, center):
+    # inverse of origin_rigid_params
+    import numpy as np
+    import SimpleITK as sitk
+    transform = sitk.Euler3DTransform()
+    transform.SetParameters(params)
+    rotation = np.asarray(transform.GetMatrix()).reshape(3, 3)
+    center = np.asarray(center)
+    translation = np.asarray(params[3:])-center+rotation.dot(center)
+    return list(params[:3])+list(translation)
+
+
+def register_volume_block(in_file, ref_file, start, stop, resample=False, mask_file=None, crop_padding=4):
+    '''
+    Registers sequentially the volumes [start,stop) of the 4D in_file to ref_file, initializing each registration
+    with the parameters of the previous volume. If a mask_file is provided, the reference is cropped to the
+    bounding box of the mask for the registration. Returns the MOCOparams rows of the block, and the resampled
+    volumes (on the full reference grid) if resample is True.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.utils import copyInfo_3DImage, crop_to_mask
+    from rabies.preprocess_pkg.hmc import register_volume_rigid
+
+    fixed_image = sitk.ReadImage(ref_file, sitk.sitkFloat32)
+    if mask_file is None:
+        registration_fixed = fixed_image
+    else:
+        registration_fixed = crop_to_mask(fixed_image, sitk.ReadImage(mask_file), padding=crop_padding)
+    # make sure that the first shrinking factor allows for at least 4 slices, as with antsMotionCorr
+    shrinking_factor = max(min(4, int(np.asarray(registration_fixed.GetSize()).min()/4)), 1)
+    shrink_factors = [shrinking_factor, 2, 1]
+
+    # only the volumes of the block are read, so that the workers do not each hold the whole timeseries
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(in_file)
+    reader.SetOutputPixelType(sitk.sitkFloat32)
+    reader.ReadImageInformation()
+    reader.SetExtractIndex([0, 0, 0, int(start)])
+    reader.SetExtractSize(list(reader.GetSize()[:3])+[int(stop-start)])
+    timeseries_image = reader.Execute()
+    timeseries_array = sitk.GetArrayViewFromImage(timeseries_image)
+
+    rows = []
+    resampled = []
+    params = None
+    for i in range(stop-start):
+        moving_image = copyInfo_3DImage(sitk.GetImageFromArray(
+            timeseries_array[i, :, :, :], isVector=False), timeseries_image)
+        params, metric_pre, metric_post, transform = register_volume_rigid(
+            registration_fixed, moving_image, initial_params=params, shrink_factors=shrink_factors)
+        rows.append([metric_pre, metric_post]+list(params))
+        if resample:
+            resampled.append(sitk.GetArrayFromImage(sitk.Resample(
+                moving_image, fixed_image, transform, sitk.sitkLinear, 0.0, sitk.sitkFloat32)))
+    return [start, rows, resampled]
+
+
+def sitk_motion_correction(in_file, ref_file, n_procs=1, resample=False, mask_file=None, crop_padding=4):
+    '''
+    In-process alternative to antsMotionCorr. The volumes are split into n_procs contiguous blocks registered
+    in parallel, each volume being initialized with the motion parameters of the preceding one. Returns the
+    (volumes x 8) array of MOCOparams, and the motion corrected array if resample is True (None otherwise).
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+    import multiprocessing as mp
+    from rabies.preprocess_pkg.hmc import register_volume_block
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(in_file)
+    reader.ReadImageInformation()
+    num_volumes = reader.GetSize()[3]
+    bounds = np.linspace(0, num_volumes, min(n_procs, num_volumes)+1).astype(int)
+
+    pool = mp.Pool(processes=n_procs)
+    results = [pool.apply_async(register_volume_block, args=(
+        in_file, ref_file, start, stop, resample, mask_file, crop_padding)) for start, stop in zip(bounds[:-1], bounds[1:])]
+    results = [p.get() for p in results]
+    pool.close()
+    pool.join()
+    # enforce proper order of the blocks
+    results.sort(key=lambda r: r[0])
+
+    motcorr_params = np.asarray([row for r in results for row in r[1]])
+    if resample:
+        return motcorr_params, np.stack([vol for r in results for vol in r[2]], axis=0)
+    return motcorr_params, None
+
+
+def write_MOCOparams(motcorr_params, filename):
+    # writes the parameters with the same layout as the MOCOparams csv from antsMotionCorr
+    import csv
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(['MetricPre', 'MetricPost']+['MOCOparam%i' % (i) for i in range(motcorr_params.shape[1]-2)])
+        for row in motcorr_params:
+            writer.writerow(['%.10g' % (value) for value in row])
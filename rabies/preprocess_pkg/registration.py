@@ -3,7 +3,7 @@ from nipype.interfaces import utility as niu
 from nipype import Function
 
 
-def init_bold_reg_wf(coreg_script='SyN', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_reg_wf'):
+def init_bold_reg_wf(coreg_script='SyN', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, cache_dir=None, name='bold_reg_wf'):
     """
     This workflow registers the reference BOLD image to anat-space, using
     antsRegistration, either applying Affine registration only, or the
@@ -17,6 +17,9 @@ def init_bold_reg_wf(coreg_script='SyN', rabies_data_type=8, rabies_mem_scale=1.
             Determine whether SyN registration will used or not, and uses the
             transform from the registration as SDC transforms to transform from
             bold to anat
+        cache_dir : str
+            Directory of the persistent registration cache. The registration is
+            restored from the cache if it was computed before with the same inputs.
 
     **Inputs**
 
@@ -52,12 +55,13 @@ def init_bold_reg_wf(coreg_script='SyN', rabies_data_type=8, rabies_mem_scale=1.
     )
 
     run_reg = pe.Node(Function(input_names=["reg_method", "moving_image", "fixed_image",
-                                            "anat_mask", "rabies_data_type"],
+                                            "anat_mask", "rabies_data_type", "cache_dir"],
                                output_names=['affine_bold2anat', 'warp_bold2anat',
                                              'inverse_warp_bold2anat', 'output_warped_bold'],
                                function=run_antsRegistration), name='EPI_Coregistration', mem_gb=3*rabies_mem_scale)
     run_reg.inputs.reg_method = coreg_script
     run_reg.inputs.rabies_data_type = rabies_data_type
+    run_reg.inputs.cache_dir = cache_dir
     run_reg.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
@@ -77,18 +81,14 @@ def init_bold_reg_wf(coreg_script='SyN', rabies_data_type=8, rabies_mem_scale=1.
     return workflow
 
 
-def run_antsRegistration(reg_method, moving_image='NULL', fixed_image='NULL', anat_mask='NULL', rabies_data_type=8):
+def run_antsRegistration(reg_method, moving_image='NULL', fixed_image='NULL', anat_mask='NULL', rabies_data_type=8, cache_dir=None):
     import os
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(moving_image).name.rsplit(".nii")
 
-    from rabies.preprocess_pkg.registration import define_reg_script
-    reg_script = define_reg_script(reg_method)
-
-    command = 'bash %s %s %s %s %s %s' % (
-        reg_script, moving_image, fixed_image, anat_mask, filename_split[0], reg_method)
-    from rabies.preprocess_pkg.utils import run_command
-    rc = run_command(command)
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.registration import define_reg_script, ants_registration_command, builtin_registrations, \
+        registration_cache_key, restore_registration, store_registration, registration_outputs
 
     cwd = os.getcwd()
     warped_image = '%s/%s_output_warped_image.nii.gz' % (
@@ -97,31 +97,274 @@ def run_antsRegistration(reg_method, moving_image='NULL', fixed_image='NULL', an
     warp = '%s/%s_output_1Warp.nii.gz' % (cwd, filename_split[0],)
     inverse_warp = '%s/%s_output_1InverseWarp.nii.gz' % (
         cwd, filename_split[0],)
+    outputs = [affine, warp, inverse_warp, warped_image]
+
+    if cache_dir is not None:
+        # the transforms and warped image are restored from a previous run with the same inputs
+        key = registration_cache_key(reg_method, moving_image, fixed_image, anat_mask, rabies_data_type)
+        if restore_registration(cache_dir, key, outputs):
+            print('Registration outputs were restored from the cache %s/%s.' % (cache_dir, key))
+            return registration_outputs(outputs)
+
+    # the built-in registrations run antsRegistration with --float when float32 outputs are desired, so that the
+    # warped image is directly produced with this type
+    use_float = int(rabies_data_type == sitk.sitkFloat32)
+    if reg_method in builtin_registrations:
+        command = ants_registration_command(
+            reg_method, moving_image, fixed_image, anat_mask, filename_split[0], use_float)
+    else:
+        reg_script = define_reg_script(reg_method)
+        command = 'bash %s %s %s %s %s %s %s' % (
+            reg_script, moving_image, fixed_image, anat_mask, filename_split[0], reg_method, use_float)
+    from rabies.preprocess_pkg.utils import run_command, ensure_image_type
+    rc = run_command(command)
+
     if not os.path.isfile(warped_image) or not os.path.isfile(affine):
         raise ValueError(
             'REGISTRATION ERROR: OUTPUT FILES MISSING. Make sure the provided registration script runs properly.')
+    ensure_image_type(warped_image, rabies_data_type)
+
+    if cache_dir is not None:
+        store_registration(cache_dir, key, outputs)
+    return registration_outputs(outputs)
+
+
+def registration_outputs(outputs):
+    import os
+    [affine, warp, inverse_warp, warped_image] = outputs
     if not os.path.isfile(warp) or not os.path.isfile(inverse_warp):
         print('No non-linear warp files as output. Assumes linear registration.')
         warp = 'NULL'
         inverse_warp = 'NULL'
+    return [affine, warp, inverse_warp, warped_image]
 
+
+def registration_cache_key(reg_method, moving_image, fixed_image, anat_mask, rabies_data_type):
+    '''
+    Key of a registration in the cache, from the content of the moving image, fixed image and mask, the
+    registration method, the output data type and the ANTs version. For the built-in methods, the generated
+    antsRegistration command (with normalized image paths) is part of the key, so that changes to the stages
+    or to the iteration schedules invalidate the cached results. For multiRAT and custom registration scripts, the
+    content of the script is part of the key, so that edits to the script invalidate the cached results.
+    '''
+    import os
+    import hashlib
     import SimpleITK as sitk
-    sitk.WriteImage(sitk.ReadImage(warped_image, rabies_data_type), warped_image)
+    from rabies.preprocess_pkg.utils import hash_image
+    from rabies.preprocess_pkg.registration import builtin_registrations, ants_registration_command, ants_version, \
+        define_reg_script
+    method = [reg_method, ants_version()]
+    if reg_method in builtin_registrations:
+        command = ants_registration_command(reg_method, moving_image, fixed_image, anat_mask, 'output',
+                                            int(rabies_data_type == sitk.sitkFloat32))
+        for path, name in [(moving_image, '{moving}'), (fixed_image, '{fixed}'), (anat_mask, '{mask}')]:
+            if os.path.isfile(path):
+                command = command.replace(path, name)
+        method.append(command)
+    else:
+        # multiRAT and custom scripts are keyed on the content of the script which is run
+        with open(define_reg_script(reg_method), 'rb') as f:
+            method.append(hashlib.sha1(f.read()).hexdigest())
+    mask_hash = hash_image(anat_mask) if os.path.isfile(anat_mask) else str(anat_mask)
+    return hash_image(moving_image, extra=[hash_image(fixed_image), mask_hash, rabies_data_type]+method)
 
-    return [affine, warp, inverse_warp, warped_image]
+
+# version of ANTs, evaluated once per process
+_ants_version = []
+
+
+def ants_version():
+    import subprocess
+    if len(_ants_version) == 0:
+        try:
+            out = subprocess.run('antsRegistration --version', shell=True, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT).stdout.decode('utf-8')
+        except OSError:
+            out = ''
+        _ants_version.append(out.strip())
+    return _ants_version[0]
+
+
+# names of the registration outputs within a cache entry
+_cache_names = ['0GenericAffine.mat', '1Warp.nii.gz', '1InverseWarp.nii.gz', 'warped_image.nii.gz']
+
+
+def restore_registration(cache_dir, key, outputs):
+    # copies the cached outputs to the expected output files, and returns whether the cache entry was found
+    import os
+    import shutil
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return False
+    for name, output in zip(_cache_names, outputs):
+        if os.path.isfile(os.path.join(entry, name)):
+            shutil.copyfile(os.path.join(entry, name), output)
+    return True
+
+
+def store_registration(cache_dir, key, outputs):
+    import os
+    import shutil
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    # the entry is written to a temporary directory first, since parallel nodes may populate the cache at the same time
+    tmp_entry = entry+'.%s.tmp' % (os.getpid())
+    os.makedirs(tmp_entry, exist_ok=True)
+    for name, output in zip(_cache_names, outputs):
+        if os.path.isfile(output):
+            shutil.copyfile(output, os.path.join(tmp_entry, name))
+    try:
+        os.replace(tmp_entry, entry)
+    except OSError:
+        # another process stored the same entry in the meantime
+        shutil.rmtree(tmp_entry)
+
+
+# registrations for which the antsRegistration call is built in-process. The corresponding scripts in shell_scripts/
+# are kept as templates for custom registration scripts.
+builtin_registrations = ['Rigid', 'Affine', 'SyN', 'light_SyN', 'heavy_SyN', 'null_nonlin']
+
+# light_SyN and heavy_SyN follow the defaults of the antsRegistrationSyN.sh script from the main distro
+light_SyN_stages = \
+    '--transform Rigid[0.1] --metric Mattes[{fixed},{moving},1,128,None] --convergence [2025x2025x2025x2025x675,1e-6,10] --shrink-factors 8x7x6x5x4 --smoothing-sigmas 3.98448927075x3.4822628776x2.97928762436x2.47510701762x1.96879525311vox --masks [NULL,NULL] ' \
+    '--transform Affine[0.1] --metric Mattes[{fixed},{moving},1,128,None] --convergence [675x225x200x200x200,1e-6,10] --shrink-factors 4x3x2x1x1 --smoothing-sigmas 1.96879525311x1.45813399545x0.936031382318x0.355182697615x0vox --masks [{mask},NULL] ' \
+    '--transform SyN[0.2,2,0] --metric CC[{fixed},{moving},1,4] --convergence [2025x2025x200x50x25x25,1e-6,10] ' \
+    '--shrink-factors 6x4x3x2x1x1 ' \
+    '--smoothing-sigmas 5.48872979374x3.4822628776x2.47510701762x1.45813399545x0.936031382318x0 ' \
+    '--masks [NULL,NULL] -z 1'
+
+heavy_SyN_stages = \
+    '--transform Rigid[0.1] --metric Mattes[{fixed},{moving},1,32,None] --convergence [2025x2025x2025x2025x2025,1e-6,10] --shrink-factors 16x15x14x13x12 --smoothing-sigmas 7.99225592362x7.49173910041x6.99114831402x6.49046645078x5.98967067114vox --masks [NULL,NULL] ' \
+    '--transform Rigid[0.1] --metric Mattes[{fixed},{moving},1,64,None] --convergence [2025x2025x2025x2025x2025,1e-6,10] --shrink-factors 12x11x10x9x8 --smoothing-sigmas 5.98967067114x5.48872979374x4.98760009911x4.48621831264x3.98448927075vox --masks [NULL,NULL] ' \
+    '--transform Rigid[0.1] --metric Mattes[{fixed},{moving},1,128,None] --convergence [2025x2025x2025x2025x675,1e-6,10] --shrink-factors 8x7x6x5x4 --smoothing-sigmas 3.98448927075x3.4822628776x2.97928762436x2.47510701762x1.96879525311vox --masks [{mask},NULL] ' \
+    '--transform Rigid[0.1] --metric Mattes[{fixed},{moving},1,256,None] --convergence [675x225x200x200x200,1e-6,10] --shrink-factors 4x3x2x1x1 --smoothing-sigmas 1.96879525311x1.45813399545x0.936031382318x0.355182697615x0vox --masks [NULL,NULL] ' \
+    '--transform Similarity[0.1] --metric Mattes[{fixed},{moving},1,256,None] --convergence [675x225x200x200x200,1e-6,10] --shrink-factors 4x3x2x1x1 --smoothing-sigmas 1.96879525311x1.45813399545x0.936031382318x0.355182697615x0vox --masks [{mask},NULL] ' \
+    '--transform Affine[0.1] --metric Mattes[{fixed},{moving},1,256,None] --convergence [675x225x200x200x200,1e-6,10] --shrink-factors 4x3x2x1x1 --smoothing-sigmas 1.96879525311x1.45813399545x0.936031382318x0.355182697615x0vox --masks [{mask},NULL] ' \
+    '--transform SyN[0.2,2,0] --metric CC[{fixed},{moving},1,4] --convergence [2025x2025x2025x2025x2025x2025x2025x2025x2025x2025x2025x2025x2025x200x50x25x25,1e-6,10] ' \
+    '--shrink-factors 8x8x8x8x8x8x8x8x8x7x6x5x4x3x2x1x1 ' \
+    '--smoothing-sigmas 7.99225592362x7.49173910041x6.99114831402x6.49046645078x5.98967067114x5.48872979374x4.98760009911x4.48621831264x3.98448927075x3.4822628776x2.97928762436x2.47510701762x1.96879525311x1.45813399545x0.936031382318x0.355182697615x0 ' \
+    '--masks [NULL,NULL] -z 1'
+
+# doesn't conduct any registration and only provides null transform files, to keep a consistent workflow structure
+null_nonlin_stages = \
+    '--transform Rigid[0.1] --metric Mattes[{fixed},{moving},1,128,None] --convergence [0,1e-6,10] --shrink-factors 1 --smoothing-sigmas 1vox ' \
+    '--transform Affine[0.1] --metric Mattes[{fixed},{moving},1,128,None] --convergence [0,1e-6,10] --shrink-factors 1 --smoothing-sigmas 0vox --masks [{mask}] ' \
+    '--transform SyN[0.2,2,0] --metric CC[{fixed},{moving},1,4] --convergence [0,1e-6,10] ' \
+    '--shrink-factors 1 ' \
+    '--smoothing-sigmas 1 ' \
+    '-z 1'
+
+
+def ants_registration_command(reg_method, moving_image, fixed_image, fixed_mask, output_basename, use_float=0):
+    '''
+    Builds the antsRegistration command of a built-in registration method. 'Rigid', 'Affine' and 'SyN' use
+    iteration schedules adapted to the resolution and size of the fixed image (see ants_iteration_schedules).
+    '''
+    output = '--output [ %s_output_,%s_output_warped_image.nii.gz ]' % (output_basename, output_basename)
+    command = 'antsRegistration --dimensionality 3 --float %s' % (use_float)
+    if reg_method in ['Rigid', 'Affine', 'SyN']:
+        from string import Template
+        from rabies.preprocess_pkg.registration import ants_iteration_schedules
+        schedules = ants_iteration_schedules(fixed_image)
+        # the generated stages refer to the images through shell variables
+        variables = {'fixedfile': fixed_image, 'movingfile': moving_image,
+                     'fixedmask': fixed_mask, 'movingmask': 'NULL'}
+        steps = {stage: Template(schedules[stage]).safe_substitute(variables) for stage in schedules}
+        command += ' --verbose %s --use-histogram-matching 1 --initial-moving-transform [ %s,%s,1 ]' % (
+            output, fixed_image, moving_image)
+        if reg_method == 'Rigid':
+            command += ' '+steps['rigid']
+        elif reg_method == 'Affine':
+            command += ' '+steps['affine']
+        else:
+            command += ' %s --transform SyN[ 0.1,3,0 ] --metric CC[ %s,%s,1,4,None ] %s --masks [ %s,NULL ]' % (
+                steps['affine'], fixed_image, moving_image, steps['syn'], fixed_mask)
+    else:
+        stages = {'light_SyN': light_SyN_stages, 'heavy_SyN': heavy_SyN_stages,
+                  'null_nonlin': null_nonlin_stages}[reg_method]
+        command += ' --output [%s_output_,%s_output_warped_image.nii.gz]' % (output_basename, output_basename)
+        if not reg_method == 'null_nonlin':
+            command += ' --initial-moving-transform [%s,%s,1]' % (fixed_image, moving_image)
+        command += ' '+stages.format(fixed=fixed_image, moving=moving_image, mask=fixed_mask)
+    return command
+
+
+# iteration schedules are cached in memory per fixed image geometry, since the same template or anatomical
+# image is used as fixed image across many registrations
+_iteration_schedules = {}
+
+
+def ants_iteration_schedules(fixed_image):
+    '''
+    Returns the rigid, affine (multilevel-halving) and SyN stages generated by ants_generate_iterations.py for the
+    fixed image. The resolution and size of the image are read from its header, and a minimum of 190 slices
+    is assumed for low resolution images, as in the former generic_registration.sh.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.registration import generate_iterations
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fixed_image)
+    reader.ReadImageInformation()
+    spacing = np.abs(np.asarray(reader.GetSpacing()[:3]))
+    minimum_resolution = spacing.min()
+    maximum_resolution = (spacing*np.asarray(reader.GetSize()[:3])).max()
+
+    key = (float(minimum_resolution), float(maximum_resolution))
+    if key in _iteration_schedules:
+        return _iteration_schedules[key]
+
+    # set a minimal number of slices for evaluating iteration parameters
+    if 190 > int(maximum_resolution/minimum_resolution):
+        minimum_resolution, maximum_resolution = 0.1, 19.0
+    schedules = {'rigid': generate_iterations(minimum_resolution, maximum_resolution, output='rigid'),
+                 'affine': generate_iterations(minimum_resolution, maximum_resolution, output='multilevel-halving'),
+                 'syn': generate_iterations(minimum_resolution, maximum_resolution)}
+    _iteration_schedules[key] = schedules
+    return schedules
+
+
+def generate_iterations(minimum_resolution, maximum_resolution, output=None):
+    '''
+    Runs ants_generate_iterations.py within the current interpreter and returns its output on a single line.
+    '''
+    import os
+    import io
+    import sys
+    import shutil
+    import runpy
+    from contextlib import redirect_stdout
+    import rabies
+
+    script = os.path.dirname(os.path.realpath(rabies.__file__))+'/shell_scripts/ants_generate_iterations.py'
+    if not os.path.isfile(script):
+        script = shutil.which('ants_generate_iterations.py')
+    if script is None:
+        raise ValueError(
+            'REGISTRATION ERROR: ants_generate_iterations.py was not found in rabies/shell_scripts/ or in the PATH.')
+
+    argv = ['ants_generate_iterations.py', '--min', str(minimum_resolution), '--max', str(maximum_resolution)]
+    if output is not None:
+        argv += ['--output', output]
+    previous_argv = sys.argv
+    stdout = io.StringIO()
+    try:
+        sys.argv = argv
+        with redirect_stdout(stdout):
+            runpy.run_path(script, run_name='__main__')
+    finally:
+        sys.argv = previous_argv
+    # line continuations are removed as with the former 'eval echo' of the shell script
+    return ' '.join(stdout.getvalue().replace('\\\n', ' ').split())
 
 
 def define_reg_script(reg_option):
     import os
     import rabies
     dir_path = os.path.dirname(os.path.realpath(rabies.__file__))
-    if reg_option == 'Rigid' or reg_option == 'Affine' or reg_option == 'SyN':
-        reg_script = dir_path+'/shell_scripts/generic_registration.sh'
-    elif reg_option == 'light_SyN':
-        reg_script = dir_path+'/shell_scripts/light_SyN_registration.sh'
-    elif reg_option == 'heavy_SyN':
-        reg_script = dir_path+'/shell_scripts/heavy_SyN_registration.sh'
-    elif reg_option == 'multiRAT':
+    if reg_option == 'multiRAT':
         reg_script = dir_path+'/shell_scripts/multiRAT_registration.sh'
     else:
         '''
@@ -4,14 +4,15 @@ from nipype.interfaces import utility as niu
 from .utils import slice_applyTransforms, init_bold_reference_wf, Merge
 
 
-def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_native_trans_wf'):
+def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, brain_crop=False, crop_padding=4, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_native_trans_wf'):
     """
     This workflow resamples the input fMRI in its native (original)
-    space in a "single shot" from the original BOLD series.
+    space in a "single shot" from the original BOLD series. With brain_crop,
+    the output grid is cropped to the bounding box of the brain_mask.
     """
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(fields=[
-        'name_source', 'bold_file', 'motcorr_params', 'transforms_list', 'inverses', 'ref_file']),
+        'name_source', 'bold_file', 'motcorr_params', 'transforms_list', 'inverses', 'ref_file', 'brain_mask']),
         name='inputnode'
     )
 
@@ -23,6 +24,7 @@ def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=
         rabies_data_type=rabies_data_type), name='bold_transform', mem_gb=1*rabies_mem_scale)
     bold_transform.inputs.apply_motcorr = (not slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
+    bold_transform.inputs.crop_padding = crop_padding
 
     merge = pe.Node(Merge(rabies_data_type=rabies_data_type), name='merge', mem_gb=4*rabies_mem_scale)
     merge.plugin_args = {
@@ -32,6 +34,11 @@ def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=
     bold_reference_wf = init_bold_reference_wf(
         rabies_data_type=rabies_data_type, rabies_mem_scale=rabies_mem_scale, min_proc=min_proc)
 
+    if brain_crop:
+        workflow.connect([
+            (inputnode, bold_transform, [('brain_mask', 'mask_file')]),
+            ])
+
     workflow.connect([
         (inputnode, merge, [('name_source', 'header_source')]),
         (inputnode, bold_transform, [
@@ -51,7 +58,7 @@ def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=
     return workflow
 
 
-def init_bold_commonspace_trans_wf(resampling_dim, brain_mask, WM_mask, CSF_mask, vascular_mask, atlas_labels, slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_commonspace_trans_wf'):
+def init_bold_commonspace_trans_wf(resampling_dim, brain_mask, WM_mask, CSF_mask, vascular_mask, atlas_labels, slice_mc=False, brain_crop=False, crop_padding=4, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_commonspace_trans_wf'):
     import os
     from .confounds import MaskEPI
 
@@ -70,6 +77,10 @@ def init_bold_commonspace_trans_wf(resampling_dim, brain_mask, WM_mask, CSF_mask
         rabies_data_type=rabies_data_type), name='bold_transform', mem_gb=1*rabies_mem_scale)
     bold_transform.inputs.apply_motcorr = (not slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
+    if brain_crop:
+        # the commonspace brain mask defines the same cropped grid for every scan of the dataset
+        bold_transform.inputs.mask_file = brain_mask
+        bold_transform.inputs.crop_padding = crop_padding
 
     merge = pe.Node(Merge(rabies_data_type=rabies_data_type), name='merge', mem_gb=4*rabies_mem_scale)
     merge.plugin_args = {
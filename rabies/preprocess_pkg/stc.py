@@ -3,13 +3,17 @@ from nipype.interfaces.utility import Function
 from nipype.interfaces import utility as niu
 
 
-def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_stc_wf'):
+def init_bold_stc_wf(tr, tpattern, no_STC=False, stc_interpolation='quintic', despike=False, bids_dir=None, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='bold_stc_wf'):
     """
     This workflow performs :abbr:`STC (slice-timing correction)` over the input
     :abbr:`BOLD (blood-oxygen-level dependent)` image.
 
     **Parameters**
 
+        despike : bool
+            Whether to apply despiking (as AFNI's 3dDespike) to the timeseries. If STC
+            is applied, the despiking is computed within the same step, before the slice
+            shifts, so that the 4D data is only read and written once.
         name : str
             Name of workflow (default: ``bold_stc_wf``)
 
@@ -17,37 +21,64 @@ def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_
 
         bold_file
             BOLD series NIfTI file
-        skip_vols
-            Number of non-steady-state volumes detected at beginning of ``bold_file``
+        name_source
+            Original BOLD file from the BIDS dataset, from which the SliceTiming
+            metadata is read if tpattern is 'bids'
 
     **Outputs**
 
         stc_file
-            Slice-timing corrected BOLD series NIfTI file
+            Slice-timing corrected (and/or despiked) BOLD series NIfTI file
 
     """
     import os
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(
-        fields=['bold_file']), name='inputnode')
+        fields=['bold_file', 'name_source']), name='inputnode')
     outputnode = pe.Node(niu.IdentityInterface(
         fields=['stc_file']), name='outputnode')
 
+    stc_n_threads = int(local_threads/4)+1
     if not no_STC:
-        slice_timing_correction_node = pe.Node(Function(input_names=['in_file', 'tr', 'tpattern', 'rabies_data_type'],
+        slice_timing_correction_node = pe.Node(Function(input_names=['in_file', 'tr', 'tpattern', 'rabies_data_type', 'interpolation',
+                                                                     'name_source', 'bids_dir', 'despike', 'n_threads'],
                                                         output_names=[
                                                             'out_file'],
                                                         function=slice_timing_correction),
-                                               name='slice_timing_correction', mem_gb=1.5*rabies_mem_scale)
+                                               name='slice_timing_correction', mem_gb=1.5*rabies_mem_scale, n_procs=stc_n_threads)
+        slice_timing_correction_node.inputs.tr = tr
+        slice_timing_correction_node.inputs.tpattern = tpattern
         slice_timing_correction_node.inputs.rabies_data_type = rabies_data_type
+        slice_timing_correction_node.inputs.interpolation = stc_interpolation
+        slice_timing_correction_node.inputs.bids_dir = bids_dir
+        slice_timing_correction_node.inputs.despike = despike
+        slice_timing_correction_node.inputs.n_threads = stc_n_threads
         slice_timing_correction_node.plugin_args = {
             'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
         workflow.connect([
-            (inputnode, slice_timing_correction_node, [('bold_file', 'in_file')]),
+            (inputnode, slice_timing_correction_node, [
+                ('bold_file', 'in_file'),
+                ('name_source', 'name_source'),
+                ]),
             (slice_timing_correction_node,
              outputnode, [('out_file', 'stc_file')]),
         ])
+    elif despike:
+        from .despike import despike as despike_function
+        despike_node = pe.Node(Function(input_names=['in_file', 'rabies_data_type', 'n_threads'],
+                                        output_names=['out_file'],
+                                        function=despike_function),
+                               name='despike', mem_gb=1.5*rabies_mem_scale, n_procs=stc_n_threads)
+        despike_node.inputs.rabies_data_type = rabies_data_type
+        despike_node.inputs.n_threads = stc_n_threads
+        despike_node.plugin_args = {
+            'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
+
+        workflow.connect([
+            (inputnode, despike_node, [('bold_file', 'in_file')]),
+            (despike_node, outputnode, [('out_file', 'stc_file')]),
+        ])
     else:
         workflow.connect([
             (inputnode, outputnode, [('bold_file', 'stc_file')]),
@@ -56,28 +87,123 @@ def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_
     return workflow
 
 
-def slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type=8):
+def get_slice_timing(tpattern, num_slices, tr, name_source=None, bids_dir=None):
+    '''
+    Returns the acquisition time (in seconds, within the TR) of each slice along the anterior-posterior
+    axis of the RAS image. 'alt' and 'seq' follow AFNI's alt-z and seq-z patterns, and 'bids' reads the
+    SliceTiming metadata of name_source.
+    '''
+    import numpy as np
+    dt = tr/num_slices
+    slice_times = np.zeros(num_slices)
+    if tpattern == 'alt':
+        order = list(range(num_slices-1, -1, -2))+list(range(num_slices-2, -1, -2))
+        slice_times[order] = np.arange(num_slices)*dt
+    elif tpattern == 'seq':
+        slice_times[::-1] = np.arange(num_slices)*dt
+    elif tpattern == 'bids':
+        import nibabel as nb
+        from bids.layout import BIDSLayout
+        if name_source is None or bids_dir is None:
+            raise ValueError("The BIDS file and directory must be provided to read the SliceTiming.")
+        metadata = BIDSLayout(bids_dir, validate=False).get_metadata(name_source)
+        if not 'SliceTiming' in metadata:
+            raise ValueError("No SliceTiming metadata was found for %s." % (name_source))
+        slice_times = np.asarray(metadata['SliceTiming'], dtype=float)
+        encoding_direction = metadata.get('SliceEncodingDirection', 'k')
+        if encoding_direction.endswith('-'):
+            slice_times = slice_times[::-1]
+
+        # the timings are defined along a voxel axis of the original image, which must be the anterior-posterior axis
+        ornt = nb.io_orientation(nb.load(name_source).affine)
+        slice_axis = 'ijk'.index(encoding_direction[0])
+        if not ornt[slice_axis, 0] == 1:
+            raise ValueError("STC is applied along the anterior-posterior axis, but the slices of %s are encoded along another axis." % (name_source))
+        if ornt[slice_axis, 1] == -1:
+            slice_times = slice_times[::-1]
+        if not len(slice_times) == num_slices:
+            raise ValueError("The SliceTiming of %s has %i entries, for %i slices." % (name_source, len(slice_times), num_slices))
+    else:
+        raise ValueError('Invalid --tpattern provided.')
+    return slice_times
+
+
+def shift_kernel(shift, interpolation='quintic', sinc_width=8):
+    '''
+    Returns the sample offsets and weights interpolating a timeseries at a fractional shift of samples,
+    i.e. y[n] = sum(weights*x[n+offsets]), with a 6-point Lagrange polynomial ('quintic', as 3dTshift -quintic)
+    or a Hann-windowed sinc of half-width sinc_width ('sinc').
+    '''
+    import numpy as np
+    floor = int(np.floor(shift))
+    frac = shift-floor
+    if interpolation == 'quintic':
+        nodes = np.arange(-2, 4)
+        weights = np.ones(6)
+        for k in range(6):
+            for j in range(6):
+                if not j == k:
+                    weights[k] *= (frac-nodes[j])/(nodes[k]-nodes[j])
+    elif interpolation == 'sinc':
+        nodes = np.arange(-sinc_width+1, sinc_width+1)
+        x = frac-nodes
+        weights = np.sinc(x)*(0.5+0.5*np.cos(np.pi*x/sinc_width))
+        weights /= weights.sum()
+    else:
+        raise ValueError("Unknown interpolation %s." % (interpolation))
+    return nodes+floor, weights
+
+
+def shift_timeseries(timeseries, shift, interpolation='quintic'):
+    '''
+    Resamples the timeseries (time along the first axis) at n+shift for each sample n, vectorized over
+    the remaining axes. Samples beyond the edges are taken from the edge values, and the 'fft' interpolation
+    applies the shift to a mirrored extension of the timeseries to avoid wrapping the end onto the beginning.
+    '''
+    import numpy as np
+    num_timepoints = timeseries.shape[0]
+    if interpolation == 'fft':
+        extended = np.concatenate([timeseries, timeseries[::-1]], axis=0)
+        num_ext = extended.shape[0]
+        phase = np.exp(2j*np.pi*np.fft.rfftfreq(num_ext)*shift)
+        # the Nyquist component must stay real
+        phase[-1] = np.cos(np.pi*shift)
+        phase = phase.reshape([-1]+[1]*(timeseries.ndim-1))
+        return np.fft.irfft(np.fft.rfft(extended, axis=0)*phase, n=num_ext, axis=0)[:num_timepoints].astype(timeseries.dtype)
+
+    offsets, weights = shift_kernel(shift, interpolation)
+    indices = np.arange(num_timepoints)
+    shifted = np.zeros(timeseries.shape, dtype=timeseries.dtype)
+    for offset, weight in zip(offsets, weights):
+        shifted += timeseries[np.clip(indices+offset, 0, num_timepoints-1)]*timeseries.dtype.type(weight)
+    return shifted
+
+
+def slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type=8, interpolation='quintic', name_source=None, bids_dir=None, despike=False, n_threads=1):
     '''
     This functions applies slice-timing correction on the anterior-posterior
-    slice acquisition direction. The input image, assumed to be in RAS orientation
+    slice acquisition direction. The input image is assumed to be in RAS orientation
     (accoring to nibabel; note that the nibabel reading of RAS corresponds to
-     LPI for AFNI). The A and S dimensions will be swapped to apply AFNI's
-    3dTshift STC with a quintic fitting function, which can only be applied to
-    the Z dimension of the data matrix. The corrected image is then re-created with
-    proper axes and the corrected timeseries.
+     LPI for AFNI). Each anterior-posterior slice is accessed through a view of the
+    data array, and its timeseries are shifted in time, vectorized across voxels, to
+    the average of the slice acquisition times (as the default of AFNI's 3dTshift).
+    Slices are processed in parallel on a pool of n_threads threads. If despike
+    is selected, despiking (as AFNI's 3dDespike) is first applied to the data in memory.
 
     **Inputs**
 
         in_file
             BOLD series NIfTI file in RAS orientation.
-        ignore
-            Number of non-steady-state volumes detected at beginning of ``bold_file``
         tr
             TR of the BOLD image.
         tpattern
-            Input to AFNI's 3dTshift -tpattern option, which specifies the
-            directionality of slice acquisition, or whether it is sequential or
-            interleaved.
+            Specifies the directionality of slice acquisition, 'alt' for interleaved and
+            'seq' for sequential (as AFNI's alt-z and seq-z), or 'bids' to read the
+            SliceTiming from the metadata of name_source.
+        interpolation
+            'quintic' (as 3dTshift -quintic), 'sinc' or 'fft'.
+        despike
+            Whether to apply despiking before the slice-timing correction.
 
     **Outputs**
 
@@ -89,43 +215,36 @@ def slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type
     import os
     import SimpleITK as sitk
     import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from rabies.preprocess_pkg.stc import get_slice_timing, shift_timeseries
 
-    if tpattern == "alt":
-        tpattern = 'alt-z'
-    elif tpattern == "seq":
-        tpattern = 'seq-z'
-    else:
-        raise ValueError('Invalid --tpattern provided.')
-
-    img = sitk.ReadImage(in_file, rabies_data_type)
-
-    # get image data
+    img = sitk.ReadImage(in_file, sitk.sitkFloat32)
+    # array of shape (time, S, A, R)
     img_array = sitk.GetArrayFromImage(img)
-
-    shape = img_array.shape
-    new_array = np.zeros([shape[0], shape[2], shape[1], shape[3]])
-    for i in range(shape[2]):
-        new_array[:, i, :, :] = img_array[:, :, i, :]
-
-    image_out = sitk.GetImageFromArray(new_array, isVector=False)
-    sitk.WriteImage(image_out, 'STC_temp.nii.gz')
-
-    command = '3dTshift -quintic -prefix temp_tshift.nii.gz -tpattern %s -TR %s STC_temp.nii.gz' % (
-        tpattern, tr,)
-    from rabies.preprocess_pkg.utils import run_command
-    rc = run_command(command)
-
-    tshift_img = sitk.ReadImage(
-        'temp_tshift.nii.gz', rabies_data_type)
-    tshift_array = sitk.GetArrayFromImage(tshift_img)
-
-    new_array = np.zeros(shape)
-    for i in range(shape[2]):
-        new_array[:, :, i, :] = tshift_array[:, i, :, :]
-    image_out = sitk.GetImageFromArray(new_array, isVector=False)
-
-    from rabies.preprocess_pkg.utils import copyInfo_4DImage
-    image_out = copyInfo_4DImage(image_out, img, img)
+    if despike:
+        from rabies.preprocess_pkg.despike import despike_array
+        despike_array(img_array, n_threads=n_threads)
+    corrected_array = np.empty_like(img_array)
+
+    # views with the anterior-posterior slices along the second axis
+    slices = np.swapaxes(img_array, 1, 2)
+    corrected_slices = np.swapaxes(corrected_array, 1, 2)
+    num_slices = slices.shape[1]
+
+    TR = float(tr.split('s')[0])
+    slice_times = get_slice_timing(tpattern, num_slices, TR, name_source=name_source, bids_dir=bids_dir)
+    tzero = slice_times.mean()
+
+    def correct_slice(i):
+        corrected_slices[:, i] = shift_timeseries(slices[:, i], (tzero-slice_times[i])/TR, interpolation)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(correct_slice, range(num_slices)))
+
+    # the conversion to the output type is done on the array, since sitk.Cast is not available for all 4D types
+    out_dtype = sitk.GetArrayViewFromImage(sitk.Image([1, 1, 1], rabies_data_type)).dtype
+    image_out = sitk.GetImageFromArray(corrected_array.astype(out_dtype, copy=False), isVector=False)
+    image_out.CopyInformation(img)
 
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(in_file).name.rsplit(".nii")
@@ -3,7 +3,7 @@ import SimpleITK as sitk
 import numpy as np
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
-    File, InputMultiPath, BaseInterface
+    File, InputMultiPath, BaseInterface, isdefined
 )
 
 
@@ -149,7 +149,7 @@ class BIDSDataGraber(BaseInterface):
         return {'out_file': getattr(self, 'out_file')}
 
 
-def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='gen_bold_ref'):
+def init_bold_reference_wf(detect_dummy=False, hmc_engine='ants', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='gen_bold_ref'):
     """
     This workflow generates reference BOLD images for a series
 
@@ -158,6 +158,9 @@ def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_sc
         detect_dummy : bool
             whether to detect and remove dummy volumes, and generate a BOLD ref
             volume based on the contrast enhanced dummy volumes.
+        hmc_engine : str
+            motion realignment used to generate the reference, 'ants' for antsMotionCorr or
+            'sitk' for the in-process SimpleITK registration
         name : str
             Name of workflow (default: 'gen_bold_ref')
 
@@ -186,8 +189,9 @@ def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_sc
         niu.IdentityInterface(fields=['bold_file', 'ref_image']),
         name='outputnode')
 
-    gen_ref = pe.Node(EstimateReferenceImage(detect_dummy=detect_dummy, rabies_data_type=rabies_data_type),
-                      name='gen_ref', mem_gb=2*rabies_mem_scale)
+    gen_ref_n_procs = int(local_threads/4)+1
+    gen_ref = pe.Node(EstimateReferenceImage(detect_dummy=detect_dummy, hmc_engine=hmc_engine, n_procs=gen_ref_n_procs, rabies_data_type=rabies_data_type),
+                      name='gen_ref', mem_gb=2*rabies_mem_scale, n_procs=gen_ref_n_procs)
     gen_ref.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(2*min_proc)), 'overwrite': True}
 
@@ -204,6 +208,10 @@ class EstimateReferenceImageInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="4D EPI file")
     detect_dummy = traits.Bool(
         desc="specify if should detect and remove dummy scans, and use these volumes as reference image.")
+    hmc_engine = traits.Enum('ants', 'sitk', usedefault=True,
+        desc="'ants' runs antsMotionCorr, and 'sitk' runs the in-process SimpleITK rigid registration.")
+    n_procs = traits.Int(1, usedefault=True,
+        desc="Number of processes registering volumes in parallel with 'sitk'.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
 
@@ -282,24 +290,29 @@ class EstimateReferenceImage(BaseInterface):
                     np.median(data_slice, axis=0), isVector=False), in_nii)
                 sitk.WriteImage(image_3d, median_fname)
 
+            def motion_corrected_array(ref_fname, second):
+                if self.inputs.hmc_engine == 'sitk':
+                    # the realigned volumes are kept in memory
+                    from rabies.preprocess_pkg.hmc import sitk_motion_correction
+                    return sitk_motion_correction(slice_fname, ref_fname, n_procs=self.inputs.n_procs, resample=True)[1]
+                res = antsMotionCorr(in_file=slice_fname,
+                                     ref_file=ref_fname, second=second, rabies_data_type=self.inputs.rabies_data_type).run()
+                return sitk.GetArrayFromImage(sitk.ReadImage(
+                    res.outputs.mc_corrected_bold, self.inputs.rabies_data_type))
+
             print("First iteration to generate reference image.")
-            res = antsMotionCorr(in_file=slice_fname,
-                                 ref_file=median_fname, second=False, rabies_data_type=self.inputs.rabies_data_type).run()
-            median = np.median(sitk.GetArrayFromImage(sitk.ReadImage(
-                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), axis=0)
+            median = np.median(motion_corrected_array(median_fname, second=False), axis=0)
             tmp_median_fname = os.path.abspath("tmp_median.nii.gz")
             image_3d = copyInfo_3DImage(
                 sitk.GetImageFromArray(median, isVector=False), in_nii)
             sitk.WriteImage(image_3d, tmp_median_fname)
 
             print("Second iteration to generate reference image.")
-            res = antsMotionCorr(in_file=slice_fname,
-                                 ref_file=tmp_median_fname, second=True,  rabies_data_type=self.inputs.rabies_data_type).run()
+            corrected_array = motion_corrected_array(tmp_median_fname, second=True)
 
             # evaluate a trimmed mean instead of a median, trimming the 5% extreme values
             from scipy import stats
-            median_image_data = stats.trim_mean(sitk.GetArrayFromImage(sitk.ReadImage(
-                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), 0.05, axis=0)
+            median_image_data = stats.trim_mean(corrected_array, 0.05, axis=0)
 
         # median_image_data is a 3D array of the median image, so creates a new nii image
         # saves it
@@ -532,6 +545,10 @@ class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
         exists=True, desc="xforms from head motion estimation .csv file")
     resampling_dim = traits.Str(
         desc="Specification for the dimension of resampling.")
+    mask_file = File(exists=True,
+                     desc="If provided, the reference space is cropped to the bounding box of this brain mask.")
+    crop_padding = traits.Int(4, usedefault=True,
+                              desc="Number of voxels padded around the bounding box of the mask when cropping.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
 
@@ -555,9 +572,10 @@ class slice_applyTransforms(BaseInterface):
         # resampling the reference image to the dimension of the EPI
         import SimpleITK as sitk
         import os
-        from rabies.preprocess_pkg.utils import run_command
+        from rabies.preprocess_pkg.utils import run_command, ants_output_type
 
         img = sitk.ReadImage(self.inputs.in_file, self.inputs.rabies_data_type)
+        output_type = ants_output_type(self.inputs.rabies_data_type)
 
         if not self.inputs.resampling_dim == 'origin':
             shape = self.inputs.resampling_dim.split('x')
@@ -566,6 +584,10 @@ class slice_applyTransforms(BaseInterface):
             spacing = img.GetSpacing()[:3]
         resampled = resample_image_spacing(sitk.ReadImage(
             self.inputs.ref_file, self.inputs.rabies_data_type), spacing)
+        if isdefined(self.inputs.mask_file):
+            # the volumes are only resampled over the brain bounding box, which then defines the grid of every
+            # subsequent voxelwise step
+            resampled = crop_to_mask(resampled, sitk.ReadImage(self.inputs.mask_file), padding=self.inputs.crop_padding)
         sitk.WriteImage(resampled, 'resampled.nii.gz')
 
         # tranforms is a list of transform files, set in order of call within antsApplyTransforms
@@ -592,16 +614,13 @@ class slice_applyTransforms(BaseInterface):
                 command = 'antsMotionCorrStats -m %s -o motcorr_vol%s.mat -t %s' % (
                     motcorr_params, x, x)
                 rc = run_command(command)
-                command = 'antsApplyTransforms -i %s %s-t motcorr_vol%s.mat -n BSpline[5] -r %s -o %s' % (
-                    bold_volumes[x], transform_string, x, ref_img, warped_vol_fname)
+                command = 'antsApplyTransforms -i %s %s-t motcorr_vol%s.mat -n BSpline[5] -r %s -o %s -u %s' % (
+                    bold_volumes[x], transform_string, x, ref_img, warped_vol_fname, output_type)
                 rc = run_command(command)
             else:
-                command = 'antsApplyTransforms -i %s %s-n BSpline[5] -r %s -o %s' % (
-                    bold_volumes[x], transform_string, ref_img, warped_vol_fname)
+                command = 'antsApplyTransforms -i %s %s-n BSpline[5] -r %s -o %s -u %s' % (
+                    bold_volumes[x], transform_string, ref_img, warped_vol_fname, output_type)
                 rc = run_command(command)
-            # change image to specified data type
-            sitk.WriteImage(sitk.ReadImage(warped_vol_fname,
-                                           self.inputs.rabies_data_type), warped_vol_fname)
 
         setattr(self, 'out_files', warped_volumes)
         return runtime
@@ -742,6 +761,31 @@ def copyInfo_3DImage(image_3d, ref_3d):
     return image_3d
 
 
+def ants_output_type(rabies_data_type):
+    # the --output-data-type option of antsApplyTransforms corresponding to a SimpleITK pixel type, so that
+    # the outputs are directly written with the desired type
+    import SimpleITK as sitk
+    ants_types = {sitk.sitkUInt8: 'uchar', sitk.sitkInt8: 'char', sitk.sitkInt16: 'short', sitk.sitkInt32: 'int',
+                  sitk.sitkFloat32: 'float', sitk.sitkFloat64: 'double'}
+    if rabies_data_type not in ants_types:
+        raise ValueError('No ANTs output type corresponds to the SimpleITK data type %s.' % (str(rabies_data_type)))
+    return ants_types[rabies_data_type]
+
+
+def ensure_image_type(img_file, rabies_data_type):
+    '''
+    Converts img_file to the SimpleITK pixel type rabies_data_type, only if it is stored with a different type.
+    The type is verified from the header only, so that images already produced with the desired type are not
+    decompressed and recompressed.
+    '''
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img_file)
+    reader.ReadImageInformation()
+    if not reader.GetPixelID() == rabies_data_type:
+        sitk.WriteImage(sitk.ReadImage(img_file, rabies_data_type), img_file)
+
+
 def resample_image_spacing(image, output_spacing):
     import SimpleITK as sitk
     import numpy as np
@@ -764,6 +808,80 @@ def resample_image_spacing(image, output_spacing):
     return pos_resampled_image
 
 
+def crop_to_mask(image, mask_image, padding=4):
+    '''
+    Crops the 3D image to the bounding box of the mask, padded by a number of voxels on each side. The mask is
+    resampled onto the grid of the image, and the origin of the cropped image is shifted accordingly, so that
+    the cropped image keeps the same physical space and can be re-embedded onto the original grid by resampling.
+    '''
+    import SimpleITK as sitk
+    import numpy as np
+    mask_array = sitk.GetArrayFromImage(sitk.Resample(
+        mask_image, image, sitk.Transform(), sitk.sitkNearestNeighbor, 0))
+    if not mask_array.any():
+        raise ValueError("The mask provided for cropping doesn't overlap with the image.")
+    # bounds are in (x,y,z) order of the image indices
+    nonzero = np.nonzero(mask_array)[::-1]
+    size = np.asarray(image.GetSize())
+    lower = np.maximum([axis.min()-padding for axis in nonzero], 0)
+    upper = np.minimum([axis.max()+1+padding for axis in nonzero], size)
+    return image[int(lower[0]):int(upper[0]), int(lower[1]):int(upper[1]), int(lower[2]):int(upper[2])]
+
+
+def compute_temporal_stats(bold_file, mask_file=None, chunk_size=50):
+    '''
+    Single-pass computation of the voxelwise temporal mean, standard deviation
+    and tSNR maps, together with the DVARS timecourse, from a 4D timeseries.
+    Volumes are read in chunks along the time axis and merged with Welford/Chan
+    updates in float32, so the full 4D array is never held in memory.
+    DVARS is evaluated within the mask if provided, otherwise on the whole
+    field of view, and is set to 0 for the first volume.
+    '''
+    import numpy as np
+    import nibabel as nb
+    img = nb.load(bold_file)
+    shape = img.shape[:3]
+    num_volumes = img.shape[3]
+    if mask_file is None:
+        mask = np.ones(shape, dtype=bool)
+    else:
+        mask = np.asarray(nb.load(mask_file).dataobj).astype(bool)
+
+    mean = np.zeros(shape, dtype=np.float32)
+    M2 = np.zeros(shape, dtype=np.float32)
+    DVARS = np.zeros(num_volumes, dtype=np.float32)
+    prev_volume = None
+    n = 0
+    for start in range(0, num_volumes, chunk_size):
+        chunk = np.asarray(
+            img.dataobj[:, :, :, start:start+chunk_size], dtype=np.float32)
+        n_chunk = chunk.shape[3]
+
+        # merge the chunk moments with the running moments
+        chunk_mean = chunk.mean(axis=3)
+        chunk_M2 = ((chunk-chunk_mean[:, :, :, np.newaxis])**2).sum(axis=3)
+        delta = chunk_mean-mean
+        n_total = n+n_chunk
+        mean += delta*(n_chunk/n_total)
+        M2 += chunk_M2+(delta**2)*(n*n_chunk/n_total)
+        n = n_total
+
+        # temporal derivative of the masked voxels, carrying over the last volume of the previous chunk
+        masked = chunk[mask]
+        if prev_volume is None:
+            DVARS[start+1:start+n_chunk] = np.sqrt(
+                (np.diff(masked, axis=1)**2).mean(axis=0))
+        else:
+            DVARS[start:start+n_chunk] = np.sqrt((np.diff(np.concatenate(
+                (prev_volume[:, np.newaxis], masked), axis=1), axis=1)**2).mean(axis=0))
+        prev_volume = masked[:, -1]
+
+    std = np.sqrt(M2/n)
+    tSNR = np.zeros(shape, dtype=np.float32)
+    np.divide(mean, std, out=tSNR, where=std > 0)
+    return mean, std, tSNR, DVARS
+
+
 def convert_to_RAS(img_file, out_dir=None):
     # convert the input image to the RAS orientation convention
     import os
@@ -851,6 +969,38 @@ def run_command(command, verbose = False):
     return rc
 
 
+# partial image digests computed within this process, keyed on the path, modification time and size of the file
+_image_hash_cache = {}
+
+def hash_image(img_file, extra=None):
+    '''
+    Returns a sha1 digest of the voxel content, shape and affine of an image, together
+    with additional parameters, to be used as a key for content-addressed caches.
+    The digest ignores the file path and compression, so that identical images
+    written by different nodes share the same key. The digest of the image content is
+    memoized on the file path and modification time, so that repeated keys are cheap.
+    '''
+    import os
+    import hashlib
+    import numpy as np
+    import nibabel as nb
+    stat = os.stat(img_file)
+    file_key = (os.path.abspath(img_file), stat.st_mtime_ns, stat.st_size)
+    if file_key not in _image_hash_cache:
+        img = nb.load(img_file)
+        sha = hashlib.sha1()
+        sha.update(str(img.shape).encode())
+        sha.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+        sha.update(np.ascontiguousarray(np.asarray(img.dataobj)).tobytes())
+        _image_hash_cache[file_key] = sha
+    sha = _image_hash_cache[file_key].copy()
+    if extra is None:
+        extra = []
+    for e in extra:
+        sha.update(str(e).encode())
+    return sha.hexdigest()
+
+
 def flatten_list(l):
     if type(l) == list:
         flattened = []
@@ -11,10 +11,12 @@ class PlotOverlapInputSpec(BaseInterfaceInputSpec):
                  desc="Fixed image from registration.")
     out_dir = traits.Str(mandatory=True, desc="Directory for QC outputs.")
     name_source = traits.Str(mandatory=True, desc="Input file template for naming outputs.")
+    qc_mode = traits.Enum('inline', 'deferred', 'off', usedefault=True,
+                          desc="Render the figure now, record it for 'rabies qc', or skip it.")
 
 
 class PlotOverlapOutputSpec(TraitedSpec):
-    out_png = File(exists=True, desc="Output png.")
+    out_png = File(desc="Output png. With a deferred qc_mode, it is only created by 'rabies qc'.")
 
 
 class PlotOverlap(BaseInterface):
@@ -27,17 +29,13 @@ class PlotOverlap(BaseInterface):
         import pathlib
         filename_template = pathlib.Path(self.inputs.name_source).name.rsplit(".nii")[0]
 
-        import rabies
-        dir_path = os.path.dirname(os.path.realpath(rabies.__file__))
-        script_path = dir_path+'/shell_scripts/plot_overlap.sh'
         os.makedirs(self.inputs.out_dir, exist_ok=True)
         out_name = self.inputs.out_dir+'/' + \
             filename_template+'_registration.png'
 
-        from rabies.preprocess_pkg.utils import run_command
-        command = 'bash %s %s %s %s' % (
-            script_path, self.inputs.moving, self.inputs.fixed, out_name)
-        rc = run_command(command)
+        from rabies.preprocess_pkg.visual_diagnosis import dispatch_qc
+        dispatch_qc('plot_overlap', {'moving':os.path.abspath(self.inputs.moving), 'fixed':os.path.abspath(self.inputs.fixed),
+                    'out_png':out_name}, self.inputs.qc_mode, self.inputs.out_dir)
 
         setattr(self, 'out_png', out_name)
         return runtime
@@ -46,28 +44,85 @@ class PlotOverlap(BaseInterface):
         return {'out_png': getattr(self, 'out_png')}
 
 
+def plot_overlap(moving, fixed, out_png):
+    import os
+    import rabies
+    from rabies.preprocess_pkg.utils import run_command
+    dir_path = os.path.dirname(os.path.realpath(rabies.__file__))
+    script_path = dir_path+'/shell_scripts/plot_overlap.sh'
+    command = 'bash %s %s %s %s' % (
+        script_path, moving, fixed, out_png)
+    rc = run_command(command)
+
+
+def otsu_thresholds(array, num_thresholds=4, num_bins=200):
+    # multi-level Otsu thresholds, found by dynamic programming over the histogram bins, which
+    # maximizes the between-class variance exactly without testing every combination of thresholds
+    import numpy as np
+    values = array[np.isfinite(array)]
+    hist, bin_edges = np.histogram(values, bins=num_bins)
+    p = hist/hist.sum()
+    centers = (bin_edges[:-1]+bin_edges[1:])/2
+    W = np.concatenate([[0], np.cumsum(p)])
+    S = np.concatenate([[0], np.cumsum(p*centers)])
+
+    # cost[i,j] is the between-class variance term of a class covering the bins i to j-1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = (S[None, :]-S[:, None])**2/(W[None, :]-W[:, None])
+    cost[~np.isfinite(cost)] = 0
+    cost[np.tril_indices(num_bins+1)] = -np.inf
+
+    best = cost[0, :]
+    argmax_list = []
+    for k in range(num_thresholds):
+        total = best[:, None]+cost
+        argmax_list.append(total.argmax(axis=0))
+        best = total.max(axis=0)
+
+    # backtrack the class boundaries from the last bin
+    boundaries = []
+    j = num_bins
+    for argmax in argmax_list[::-1]:
+        j = argmax[j]
+        boundaries.append(j)
+    return bin_edges[np.array(boundaries[::-1])]
+
+
+def downsample_img(image, max_dim=128):
+    # subsample a 3D image with a constant voxel stride so that no dimension exceeds max_dim, which is
+    # sufficient for display and reduces the cost of rendering
+    import numpy as np
+    import nibabel as nb
+    img = nb.load(image) if isinstance(image, str) else image
+    if max_dim is None or max_dim <= 0:
+        return img
+    step = int(np.ceil(max(img.shape[:3])/max_dim))
+    if step <= 1:
+        return img
+    affine = img.affine.copy()
+    affine[:3, :3] *= step
+    return nb.Nifti1Image(np.asarray(img.dataobj[::step, ::step, ::step]), affine)
+
+
 def otsu_scaling(image):
     import numpy as np
     import nibabel as nb
-    img=nb.load(image)
-    array=np.asarray(img.dataobj)
+    from rabies.preprocess_pkg.visual_diagnosis import otsu_thresholds
+    img = nb.load(image) if isinstance(image, str) else image
+    array = np.asarray(img.dataobj).astype(np.float32)
 
     # select a smart vmax for the image display to enhance contrast
-    from rabies.preprocess_pkg.utils import run_command
-    command = 'ThresholdImage 3 %s otsu_weight.nii.gz Otsu 4' % (image)
-    rc = run_command(command)
-
-    # clip off the background
-    mask = np.asarray(nb.load('otsu_weight.nii.gz').dataobj)
-    voxel_subset=array[mask>1.0]
+    # clip off the background, i.e. the two lowest of the 5 Otsu classes (labels 0 and 1 from ThresholdImage)
+    thresholds = otsu_thresholds(array, num_thresholds=4)
+    voxel_subset = array[array > thresholds[1]]
 
     # select a maximal value which encompasses 90% of the voxels in the mask
-    voxel_subset.sort()
-    vmax=voxel_subset[int(len(voxel_subset)*0.9)]
+    idx = int(len(voxel_subset)*0.9)
+    vmax = np.partition(voxel_subset, idx)[idx]
 
     # re-scale the values to be within a range of -1 and 1
     scaled = ((array/vmax)*2)-1
-    return nb.Nifti1Image(scaled, img.affine, img.header)
+    return nb.Nifti1Image(scaled, img.affine)
 
 def plot_3d(image,axes,vmax=1,cmap='gray', cbar=False):
     from nilearn import plotting
@@ -79,7 +134,7 @@ def plot_3d(image,axes,vmax=1,cmap='gray', cbar=False):
     display3 = plotting.plot_stat_map(image,bg_img=image, axes=ax, cmap=cmap, cut_coords=4, display_mode='z', vmax=vmax, threshold=None, draw_cross=False, colorbar=cbar)
     return display1,display2,display3
 
-def plot_reg(image1,image2, name_source, out_dir):
+def plot_reg(image1,image2, name_source, out_dir, dpi=100, max_dim=128):
     import os
     import pathlib
     filename_template = pathlib.Path(name_source).name.rsplit(".nii")[0]
@@ -88,10 +143,14 @@ def plot_reg(image1,image2, name_source, out_dir):
         filename_template
 
     import matplotlib.pyplot as plt
-    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling
+    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling,downsample_img
     fig,axes = plt.subplots(nrows=2, ncols=3, figsize=(12*3,2*2))
     plt.tight_layout()
 
+    # each image is loaded and downsampled once, and used both as background and as edges
+    image1 = downsample_img(image1, max_dim)
+    image2 = downsample_img(image2, max_dim)
+
     scaled = otsu_scaling(image1)
     display1,display2,display3 = plot_3d(scaled,axes[0,:], cmap='gray')
     display1.add_edges(image2)
@@ -103,13 +162,12 @@ def plot_reg(image1,image2, name_source, out_dir):
     display1.add_edges(image1)
     display2.add_edges(image1)
     display3.add_edges(image1)
-    fig.savefig('%s_registration.png' % (prefix), bbox_inches='tight')
+    fig.savefig('%s_registration.png' % (prefix), bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
 
 def template_diagnosis(anat_template, opts, out_dir):
     import os
-    from nilearn import plotting
-    import matplotlib.pyplot as plt
-    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling
+    from rabies.preprocess_pkg.visual_diagnosis import dispatch_qc
     brain_mask = str(opts.brain_mask)
     WM_mask = str(opts.WM_mask)
     CSF_mask = str(opts.CSF_mask)
@@ -125,46 +183,56 @@ def template_diagnosis(anat_template, opts, out_dir):
         if ((array!=1)*(array!=0)).sum()>0:
             raise ValueError("The file %s is not a binary mask. Non-binary masks cannot be processed." % (mask))
 
-    scaled = otsu_scaling(anat_template)
+    dispatch_qc('plot_template_diagnosis', {'anat_template':anat_template, 'brain_mask':brain_mask, 'WM_mask':WM_mask,
+                'CSF_mask':CSF_mask, 'vascular_mask':vascular_mask, 'labels':labels, 'out_dir':out_dir,
+                'dpi':opts.qc_dpi, 'max_dim':opts.qc_max_dim}, opts.qc_mode, out_dir)
+
+def plot_template_diagnosis(anat_template, brain_mask, WM_mask, CSF_mask, vascular_mask, labels, out_dir, dpi=100, max_dim=128):
+    from nilearn import plotting
+    import matplotlib.pyplot as plt
+    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling,downsample_img
+
+    scaled = otsu_scaling(downsample_img(anat_template, max_dim))
 
     fig,axes = plt.subplots(nrows=6, ncols=3, figsize=(12*3,2*6))
     plt.tight_layout()
 
     display1,display2,display3 = plot_3d(scaled,axes[0,:], cmap='gray')
     # plot brain mask
-    mask = brain_mask
+    mask = downsample_img(brain_mask, max_dim)
     display1,display2,display3 = plot_3d(scaled,axes[1,:], cmap='gray')
     display1.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display2.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display3.add_overlay(mask, cmap=plotting.cm.red_transparent)
     # plot WM mask
-    mask = WM_mask
+    mask = downsample_img(WM_mask, max_dim)
     display1,display2,display3 = plot_3d(scaled,axes[2,:], cmap='gray')
     display1.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display2.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display3.add_overlay(mask, cmap=plotting.cm.red_transparent)
     # plot CSF mask
-    mask = CSF_mask
+    mask = downsample_img(CSF_mask, max_dim)
     display1,display2,display3 = plot_3d(scaled,axes[3,:], cmap='gray')
     display1.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display2.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display3.add_overlay(mask, cmap=plotting.cm.red_transparent)
     # plot VASC mask
-    mask = vascular_mask
+    mask = downsample_img(vascular_mask, max_dim)
     display1,display2,display3 = plot_3d(scaled,axes[4,:], cmap='gray')
     display1.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display2.add_overlay(mask, cmap=plotting.cm.red_transparent)
     display3.add_overlay(mask, cmap=plotting.cm.red_transparent)
 
     # plot labels
-    mask = labels
+    mask = downsample_img(labels, max_dim)
     display1,display2,display3 = plot_3d(scaled,axes[5,:], cmap='gray')
     display1.add_overlay(mask, cmap='rainbow')
     display2.add_overlay(mask, cmap='rainbow')
     display3.add_overlay(mask, cmap='rainbow')
-    fig.savefig(out_dir+'/template_diagnosis.png', bbox_inches='tight')
+    fig.savefig(out_dir+'/template_diagnosis.png', bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
 
-def temporal_diagnosis(bold_file, confounds_csv, FD_csv, rabies_data_type, name_source, out_dir):
+def temporal_diagnosis(bold_file, brain_mask, confounds_csv, FD_csv, name_source, out_dir, dpi=100, max_dim=128, qc_mode='inline'):
     import os
     import pathlib
     filename_template = pathlib.Path(name_source).name.rsplit(".nii")[0]
@@ -173,11 +241,35 @@ def temporal_diagnosis(bold_file, confounds_csv, FD_csv, rabies_data_type, name_
         filename_template
 
     import numpy as np
-    import SimpleITK as sitk
+    import nibabel as nb
+    from rabies.preprocess_pkg.visual_diagnosis import dispatch_qc
+    from rabies.preprocess_pkg.utils import compute_temporal_stats
+
+    # calculate STD and tSNR map on preprocessed timeseries
+    mean, std, tSNR, DVARS = compute_temporal_stats(bold_file, brain_mask)
+
+    img = nb.load(bold_file)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    std_filename = os.path.abspath('tSTD.nii.gz')
+    nb.Nifti1Image(std, img.affine, header).to_filename(std_filename)
+
+    tSNR_filename = os.path.abspath('tSNR.nii.gz')
+    nb.Nifti1Image(tSNR, img.affine, header).to_filename(tSNR_filename)
+
+    # the maps are derived in all QC modes, since they are outputs of the workflow
+    dispatch_qc('plot_temporal_diagnosis', {'confounds_csv':confounds_csv, 'FD_csv':FD_csv, 'DVARS':DVARS,
+                'std_filename':std_filename, 'tSNR_filename':tSNR_filename, 'prefix':prefix, 'dpi':dpi, 'max_dim':max_dim},
+                qc_mode, out_dir)
+
+    return std_filename, tSNR_filename
+
+def plot_temporal_diagnosis(confounds_csv, FD_csv, DVARS, std_filename, tSNR_filename, prefix, dpi=100, max_dim=128):
+    import numpy as np
+    import nibabel as nb
     from nilearn import plotting
     import matplotlib.pyplot as plt
-    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling
-    from rabies.preprocess_pkg.utils import copyInfo_3DImage
+    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,downsample_img
     fig,axes = plt.subplots(nrows=3, ncols=3, figsize=(12*3,3*3))
     # plot the motion timecourses
     import pandas as pd
@@ -198,35 +290,24 @@ def temporal_diagnosis(bold_file, confounds_csv, FD_csv, rabies_data_type, name_
     df = pd.read_csv(FD_csv)
     ax=axes[0,2]
     ax.plot(df['Mean'], color='r')
-    ax.set_title('Framewise Displacement', fontsize=20)
+    ax_DVARS = ax.twinx()
+    ax_DVARS.plot(DVARS, color='b')
+    ax.legend(['FD'], loc='upper left')
+    ax_DVARS.legend(['DVARS'], loc='upper right')
+    ax.set_title('Framewise Displacement and DVARS', fontsize=20)
 
     plt.tight_layout()
 
-    # calculate STD and tSNR map on preprocessed timeseries
-    img = sitk.ReadImage(bold_file, rabies_data_type)
-    array = sitk.GetArrayFromImage(img)
-    mean = array.mean(axis=0)
-    std = array.std(axis=0)
-    std_filename = os.path.abspath('tSTD.nii.gz')
-    image_3d = copyInfo_3DImage(
-        sitk.GetImageFromArray(std, isVector=False), img)
-    sitk.WriteImage(image_3d, std_filename)
+    std_img = nb.load(std_filename)
+    tSNR_img = nb.load(tSNR_filename)
+    plot_3d(downsample_img(std_img, max_dim),axes[1,:],vmax=np.asarray(std_img.dataobj).max(),cmap=plotting.cm.cold_hot, cbar=True)
+    plot_3d(downsample_img(tSNR_img, max_dim),axes[2,:],vmax=np.asarray(tSNR_img.dataobj).max(),cmap='Spectral', cbar=True)
 
-    tSNR = np.divide(mean, std)
-    tSNR_filename = os.path.abspath('tSNR.nii.gz')
-    image_3d = copyInfo_3DImage(
-        sitk.GetImageFromArray(tSNR, isVector=False), img)
-    sitk.WriteImage(image_3d, tSNR_filename)
-
-    plot_3d(std_filename,axes[1,:],vmax=std.max(),cmap=plotting.cm.cold_hot, cbar=True)
-    plot_3d(tSNR_filename,axes[2,:],vmax=tSNR.max(),cmap='Spectral', cbar=True)
-
-    fig.savefig('%s_temporal_diagnosis.png' % (prefix), bbox_inches='tight')
-
-    return std_filename, tSNR_filename
+    fig.savefig('%s_temporal_diagnosis.png' % (prefix), bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
 
 
-def denoising_diagnosis(raw_img,init_denoise,warped_mask,final_denoise, name_source, out_dir):
+def denoising_diagnosis(raw_img,init_denoise,warped_mask,final_denoise, name_source, out_dir, dpi=100, max_dim=128, qc_mode='inline'):
     import os
     import pathlib
     filename_template = pathlib.Path(name_source).name.rsplit(".nii")[0]
@@ -234,23 +315,119 @@ def denoising_diagnosis(raw_img,init_denoise,warped_mask,final_denoise, name_sou
     prefix = out_dir+'/'+ \
         filename_template
 
+    from rabies.preprocess_pkg.visual_diagnosis import dispatch_qc
+    dispatch_qc('plot_denoising_diagnosis', {'raw_img':raw_img, 'init_denoise':init_denoise, 'warped_mask':warped_mask,
+                'final_denoise':final_denoise, 'prefix':prefix, 'dpi':dpi, 'max_dim':max_dim}, qc_mode, out_dir)
+
+def plot_denoising_diagnosis(raw_img,init_denoise,warped_mask,final_denoise, prefix, dpi=100, max_dim=128):
     from nilearn import plotting
     import matplotlib.pyplot as plt
-    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling
+    from rabies.preprocess_pkg.visual_diagnosis import plot_3d,otsu_scaling,downsample_img
     fig,axes = plt.subplots(nrows=4, ncols=3, figsize=(12*3,2*4))
     plt.tight_layout()
 
-    scaled = otsu_scaling(raw_img)
+    warped_mask = downsample_img(warped_mask, max_dim)
+    scaled = otsu_scaling(downsample_img(raw_img, max_dim))
     display1,display2,display3 = plot_3d(scaled,axes[0,:], cmap='viridis')
     display1,display2,display3 = plot_3d(scaled,axes[2,:], cmap='viridis')
     display1.add_overlay(warped_mask, cmap=plotting.cm.red_transparent)
     display2.add_overlay(warped_mask, cmap=plotting.cm.red_transparent)
     display3.add_overlay(warped_mask, cmap=plotting.cm.red_transparent)
 
-    scaled = otsu_scaling(init_denoise)
+    scaled = otsu_scaling(downsample_img(init_denoise, max_dim))
     display1,display2,display3 = plot_3d(scaled,axes[1,:], cmap='viridis')
 
-    scaled = otsu_scaling(final_denoise)
+    scaled = otsu_scaling(downsample_img(final_denoise, max_dim))
     display1,display2,display3 = plot_3d(scaled,axes[3,:], cmap='viridis')
 
-    fig.savefig('%s_denoising.png' % (prefix), bbox_inches='tight')
+    fig.savefig('%s_denoising.png' % (prefix), bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+
+
+def dispatch_qc(function_name, kwargs, qc_mode, out_dir):
+    '''
+    Generates a QC figure by calling the plotting function function_name from this module with kwargs.
+    With qc_mode='inline' the figure is rendered immediately, with 'deferred' the call is recorded in the qc_jobs
+    folder of the QC report (the parent of out_dir) to be rendered later with 'rabies qc', and with 'off' nothing is done.
+    '''
+    import os
+    if qc_mode == 'inline':
+        import rabies.preprocess_pkg.visual_diagnosis as visual_diagnosis
+        getattr(visual_diagnosis, function_name)(**kwargs)
+    elif qc_mode == 'deferred':
+        import pickle
+        import hashlib
+        job_dir = os.path.join(os.path.dirname(os.path.normpath(out_dir)), 'qc_jobs')
+        os.makedirs(job_dir, exist_ok=True)
+        job = {'function_name':function_name, 'kwargs':kwargs}
+        data = pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL)
+        job_file = '%s/%s_%s.pkl' % (job_dir, function_name, hashlib.md5(data).hexdigest()[:16])
+        # write then rename, so that 'rabies qc' never reads a partial job
+        tmp_file = '%s.tmp%i' % (job_file, os.getpid())
+        with open(tmp_file, 'wb') as handle:
+            handle.write(data)
+        os.replace(tmp_file, job_file)
+    elif not qc_mode == 'off':
+        raise ValueError("qc_mode must be 'inline', 'deferred' or 'off', got %s." % (qc_mode))
+
+
+def _init_qc_worker():
+    # the plotting libraries are imported once per worker, rather than once per figure
+    # import errors are left to be reported by each job, since a failing initializer would respawn workers indefinitely
+    import importlib
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        # the modules are only loaded in the worker, they are not used here
+        importlib.import_module('matplotlib.pyplot')
+        importlib.import_module('nilearn.plotting')
+    except ImportError:
+        pass
+
+
+def _run_qc_job(job_file):
+    # each job runs in its own temporary folder, since some renderers write intermediate files in the working directory
+    import os
+    import pickle
+    import shutil
+    import tempfile
+    from rabies.preprocess_pkg.visual_diagnosis import dispatch_qc
+    with open(job_file, 'rb') as handle:
+        job = pickle.load(handle)
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp_dir)
+        dispatch_qc(job['function_name'], job['kwargs'], 'inline', None)
+        os.remove(job_file)
+        return None
+    except Exception as e:
+        return '%s: %s' % (job_file, e)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def render_qc_jobs(qc_report_dir, n_procs=1):
+    '''
+    Renders the QC figures recorded with qc_mode='deferred' under qc_report_dir, on a pool of n_procs processes.
+    Job files are deleted once rendered, so that failed jobs can be re-run. Returns the list of failures.
+    '''
+    import os
+    import glob
+    from rabies.preprocess_pkg.visual_diagnosis import _init_qc_worker, _run_qc_job
+    job_files = sorted(glob.glob(os.path.join(qc_report_dir, 'qc_jobs', '*.pkl')))
+    if len(job_files) == 0:
+        return []
+    if n_procs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(n_procs, len(job_files)), initializer=_init_qc_worker)
+        try:
+            results = pool.map(_run_qc_job, job_files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_qc_worker()
+        results = [_run_qc_job(job_file) for job_file in job_files]
+    return [result for result in results if result is not None]
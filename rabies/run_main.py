@@ -42,6 +42,11 @@ def get_parser():
         A few built-in resting-state functional connectivity (FC) analysis options are provided to conduct rapid analysis on the cleaned timeseries.
         The options include seed-based FC, voxelwise or parcellated whole-brain FC, group-ICA and dual regression.
         """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    qc = subparsers.add_parser("qc",
+                               help="""
+        Renders the visual QC report figures which were deferred during preprocessing with --qc_mode deferred,
+        in parallel on a pool of processes.
+        """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     g_execution = parser.add_argument_group(
         "Options for managing the execution of the workflow.")
@@ -78,6 +83,17 @@ def get_parser():
     preprocess.add_argument('--apply_despiking', dest='apply_despiking', action='store_true',
                             help="Whether to apply despiking of the EPI timeseries based on AFNI's "
                             "3dDespike https://afni.nimh.nih.gov/pub/dist/doc/program_help/3dDespike.html.")
+    preprocess.add_argument('--despike_method', type=str, default='afni',
+                            choices=['native', 'afni'],
+                            help="'afni' runs 3dDespike on the input EPI, so that the BOLD reference, bias correction and "
+                            "motion estimation are all derived from the despiked EPI. 'native' applies the despiking algorithm "
+                            "of 3dDespike in-process, within the slice timing correction step so that the EPI is read only once; "
+                            "the BOLD reference and motion estimation are then derived from the EPI before despiking.")
+    preprocess.add_argument('--hmc_engine', type=str, default='ants',
+                            choices=['ants', 'sitk'],
+                            help="Engine for head motion estimation. 'ants' runs antsMotionCorr. 'sitk' runs an in-process "
+                            "rigid registration with SimpleITK, in parallel across volumes, which only outputs the motion "
+                            "parameters (in the same csv format) unless --apply_slice_mc requires the realigned timeseries.")
     preprocess.add_argument('--apply_slice_mc', dest='apply_slice_mc', action='store_true',
                             help="Whether to apply a slice-specific motion correction after initial volumetric rigid correction. "
                             "This second motion correction can correct for interslice misalignment resulting from within-TR motion."
@@ -93,6 +109,18 @@ def get_parser():
     preprocess.add_argument("--debug", dest='debug', action='store_true',
                             help="Run in debug mode.")
 
+    g_qc = preprocess.add_argument_group("Options for the generation of the visual QC report.")
+    g_qc.add_argument("--qc_mode", type=str, default='inline',
+                      choices=['inline', 'deferred', 'off'],
+                      help="'inline' renders the QC figures within the preprocessing workflow. 'deferred' only records the "
+                      "figures to generate, which are then rendered in parallel after preprocessing with 'rabies qc'. "
+                      "'off' skips the QC figures.")
+    g_qc.add_argument("--qc_dpi", type=int, default=100,
+                      help="Resolution (dots per inch) of the QC figures.")
+    g_qc.add_argument("--qc_max_dim", type=int, default=128,
+                      help="Images are subsampled for display in the QC figures so that no dimension exceeds this number of voxels. "
+                      "Specify 0 to display images at their original resolution.")
+
     g_registration = preprocess.add_argument_group(
         "Options for the registration steps. Built-in options for selecting registration scripts include 'Rigid', 'Affine', 'SyN' (non-linear), 'light_SyN', 'heavy_SyN', 'multiRAT', but"
         " can specify a custom registration script following the template script structure (see RABIES/rabies/shell_scripts/ for template)."
@@ -112,6 +140,12 @@ def get_parser():
                                 "each anatomical scan will be individually registered to the commonspace template using the --template_reg_script."
                                 "Note that this option, although faster, is expected to reduce the quality of commonspace registration.")
 
+    g_registration.add_argument("--no_reg_cache", dest='no_reg_cache', action='store_true',
+                                help="Registrations are cached in output_dir/rabies_cache/registrations, keyed on the content of "
+                                "their input images, the registration command (or the content of a custom script) and the ANTs version, "
+                                "and are restored on later runs with the same inputs. This option disables the cache. "
+                                "Deleting the rabies_cache/registrations folder clears all cached registrations.")
+
     g_resampling = preprocess.add_argument_group("Options for the resampling of the EPI. "
                                                  "Axis resampling specifications must follow the format 'dim1xdim2xdim3' (in mm) with the RAS axis convention (dim1=Right-Left, dim2=Anterior-Posterior, dim3=Superior-Inferior).")
     g_resampling.add_argument('--nativespace_resampling', type=str, default='origin',
@@ -121,6 +155,14 @@ def get_parser():
                               help="Can specify a resampling dimension for the commonspace outputs. Must be of the form dim1xdim2xdim3 (in mm). The original dimensions are conserved "
                               "if 'origin' is specified."
                               "***this option specifies the resampling for the --bold_only workflow")
+    g_resampling.add_argument('--brain_crop', dest='brain_crop', action='store_true',
+                              help="Crop the nativespace and commonspace EPI outputs to the bounding box of the brain mask "
+                              "(padded by --crop_padding voxels), so that the resampling, confound estimation and the subsequent "
+                              "confound regression and analyses only process the brain. The headers of the cropped outputs "
+                              "preserve their physical space. With --hmc_engine sitk, the motion estimation is also restricted "
+                              "to the brain bounding box. Note that a user-provided --IC_file must then be on the cropped grid.")
+    g_resampling.add_argument('--crop_padding', type=int, default=4,
+                              help="Number of voxels padded around the brain bounding box with --brain_crop.")
     g_resampling.add_argument(
         '--anatomical_resampling', type=str, default='inputs_defined',
         help="""To optimize the efficiency of registration, the provided anatomical template is resampled based on the provided
@@ -142,16 +184,22 @@ def get_parser():
         help="""Option for job submission
         specifying requested time per pairwise registration.""")
 
-    g_stc = preprocess.add_argument_group("""Specify Slice Timing Correction info that is fed to AFNI 3dTshift
-    (https://afni.nimh.nih.gov/pub/dist/doc/program_help/3dTshift.html). The STC is applied in the
-    anterior-posterior orientation, assuming slices were acquired in this direction.""")
+    g_stc = preprocess.add_argument_group("""Specify Slice Timing Correction info. The timeseries of each slice are shifted
+    to the average of the slice acquisition times, as with AFNI 3dTshift (https://afni.nimh.nih.gov/pub/dist/doc/program_help/3dTshift.html).
+    The STC is applied in the anterior-posterior orientation, assuming slices were acquired in this direction.""")
     g_stc.add_argument('--TR', type=str, default='1.0s',
                        help="Specify repetition time (TR) in seconds.")
     g_stc.add_argument('--no_STC', dest='no_STC', action='store_true',
                        help="Select this option to ignore the STC step.")
     g_stc.add_argument('--tpattern', type=str, default='alt',
-                       choices=['alt', 'seq'],
-                       help="Specify if interleaved or sequential acquisition. 'alt' for interleaved, 'seq' for sequential.")
+                       choices=['alt', 'seq', 'bids'],
+                       help="Specify if interleaved or sequential acquisition. 'alt' for interleaved, 'seq' for sequential "
+                       "(as AFNI's alt-z and seq-z patterns). 'bids' reads the slice acquisition times from the SliceTiming "
+                       "metadata of each scan in the BIDS dataset.")
+    g_stc.add_argument('--stc_interpolation', type=str, default='quintic',
+                       choices=['quintic', 'sinc', 'fft'],
+                       help="Interpolation used to shift the slice timeseries in time. 'quintic' is a 6-point polynomial as "
+                       "3dTshift -quintic, 'sinc' a windowed sinc over 16 timepoints, and 'fft' a Fourier phase shift.")
 
     g_atlas = preprocess.add_argument_group(
         'Provided commonspace atlas files.')
@@ -204,6 +252,11 @@ def get_parser():
     confound_regression.add_argument('--aroma_dim', type=int,
                                      default=0,
                                      help='Can specify a number of dimension for the MELODIC run before ICA-AROMA.')
+    confound_regression.add_argument('--aroma_ica_engine', type=str, default='melodic',
+                                     choices=['melodic', 'fastica'],
+                                     help="Select the ICA decomposition for ICA-AROMA. 'melodic' runs FSL MELODIC, whereas 'fastica' "
+                                     "runs a PCA reduction followed by FastICA within the python process. With 'fastica', the maps are "
+                                     "thresholded from robustly standardized Z-maps instead of MELODIC's mixture modeling.")
     confound_regression.add_argument('--conf_list', type=str,
                                      nargs="*",  # 0 or more values expected => creates a list
                                      default=[],
@@ -239,14 +292,31 @@ def get_parser():
                                      "Each seed must consist of a binary mask representing the ROI in commonspace.")
     g_fc_matrix = analysis.add_argument_group(
         'Options for performing a whole-brain timeseries correlation matrix analysis.')
-    g_fc_matrix.add_argument("--FC_matrix", dest='FC_matrix', action='store_true',
+    g_fc_matrix.add_argument("--FC_matrix", dest='FC_matrix', type=str,
+                             nargs="*",  # 0 or more values expected => creates a list
+                             default=None,
                              help="Choose this option to derive a whole-brain functional connectivity matrix, based on the correlation of regional timeseries "
-                             "for each subject cleaned timeseries.")
+                             "for each subject cleaned timeseries. A list of label images can be provided, in which case one parcellated matrix is derived "
+                             "for each atlas from a single read of the timeseries (the atlases must be in commonspace). Otherwise, the atlas labels "
+                             "provided for preprocessing are used.")
     g_fc_matrix.add_argument("--ROI_type", type=str, default='parcellated',
                              choices=['parcellated', 'voxelwise'],
                              help="Define the types of ROI to extract regional timeseries for correlation matrix analysis. "
                              "Options are 'parcellated', in which case the atlas labels provided for preprocessing are used as ROIs, or "
                              "'voxelwise', in which case all voxel timeseries are cross-correlated.")
+    g_fc_matrix.add_argument("--FC_dtype", type=str, default='float32',
+                             choices=['float32', 'float16'],
+                             help="Data type used to store the voxelwise correlation matrix.")
+    g_fc_matrix.add_argument("--FC_top_k", type=int, default=0,
+                             help="For the voxelwise matrix, only store the k most correlated voxels for each voxel (in a .npz file with "
+                             "'indices' and 'values' arrays). By default (0), the full upper triangle of the matrix is stored "
+                             "row by row as a 1D .npy array, which can be indexed with numpy.triu_indices(num_voxels, 1).")
+    g_fc_matrix.add_argument("--FC_threshold", type=float, default=None,
+                             help="For the voxelwise matrix, only store voxel pairs with an absolute correlation above this threshold, "
+                             "as 'rows', 'cols' and 'values' arrays of the upper triangle in a .npz file. Cannot be combined with --FC_top_k.")
+    g_fc_matrix.add_argument("--FC_mem_gb", type=float, default=4.0,
+                             help="Memory (in GB) allocated to the computation of each voxelwise matrix. This value is declared to the "
+                             "scheduler, and the matrix is computed in blocks of rows fitting within this budget.")
     g_group_ICA = analysis.add_argument_group("Options for performing group-ICA using FSL's MELODIC on the whole dataset cleaned timeseries."
                                               "Note that confound regression must have been conducted on commonspace outputs.")
     g_group_ICA.add_argument("--group_ICA", dest='group_ICA', action='store_true',
@@ -255,6 +325,14 @@ def get_parser():
                              help="Specify repetition time (TR) in seconds.")
     g_group_ICA.add_argument('--dim', type=int, default=0,
                              help="You can specify the number of ICA components to be derived. The default uses an automatic estimation.")
+    g_group_ICA.add_argument('--group_ICA_engine', type=str, default='melodic',
+                             choices=['melodic', 'migp'],
+                             help="Select the group-ICA implementation. 'melodic' runs FSL's MELODIC on the temporal concatenation of all scans, "
+                             "whereas 'migp' streams the scans one at a time into an Incremental Group PCA (Smith et al. 2014) within the python "
+                             "process, followed by spatial FastICA, so that memory does not grow with the number of scans. 'migp' requires --dim.")
+    g_group_ICA.add_argument('--migp_dim', type=int, default=0,
+                             help="Internal dimension of the MIGP estimate. By default, the number of timepoints of one scan is used "
+                             "(and at least twice --dim).")
     g_DR_ICA = analysis.add_argument_group("Options for performing a dual regression analysis based on a previous group-ICA run from FSL's MELODIC. "
                                            "Note that confound regression must have been conducted on commonspace outputs.")
     g_DR_ICA.add_argument("--DR_ICA", dest='DR_ICA', action='store_true',
@@ -264,6 +342,11 @@ def get_parser():
                           help="Option to provide a melodic_IC.nii.gz file with the ICA components from a previous group-ICA run. "
                           "If none is provided, a group-ICA will be run with the dataset cleaned timeseries.")
 
+    qc.add_argument('output_dir', action='store', type=Path,
+                    help='path to the RABIES preprocessing output directory, where the QC_report folder is found.')
+    qc.add_argument('--n_procs', type=int, default=multiprocessing.cpu_count(),
+                    help="Number of processes rendering the figures in parallel.")
+
     return parser
 
 
@@ -306,6 +389,9 @@ def execute_workflow():
         workflow = confound_regression(opts, None, log)
     elif opts.rabies_step == 'analysis':
         workflow = analysis(opts, log)
+    elif opts.rabies_step == 'qc':
+        render_qc(opts, log)
+        return
     else:
         parser.print_help()
 
@@ -320,6 +406,18 @@ def execute_workflow():
         raise
 
 
+def render_qc(opts, log):
+    from rabies.preprocess_pkg.visual_diagnosis import render_qc_jobs
+    qc_report_dir = os.path.abspath(str(opts.output_dir))+'/QC_report'
+    if not os.path.isdir(qc_report_dir):
+        raise ValueError("No QC_report folder found in %s." % (str(opts.output_dir)))
+    failures = render_qc_jobs(qc_report_dir, n_procs=opts.n_procs)
+    for failure in failures:
+        log.warning('QC rendering failed for %s' % (failure))
+    if len(failures) > 0:
+        raise ValueError("%i QC figures could not be rendered; re-run 'rabies qc' to retry them." % (len(failures)))
+
+
 def preprocess(opts, cr_opts, analysis_opts, log):
     # Verify input and output directories
     data_dir_path = os.path.abspath(str(opts.bids_dir))
@@ -11,6 +11,7 @@ movingmask=NULL
 fixedmask=$3
 _arg_outputbasename=$4
 method=$5
+use_float=${6:-0}
 
 fixed_minimum_resolution=$(python -c "print(min([abs(x) for x in [float(x) for x in \"$(PrintHeader ${fixedfile} 1)\".split(\"x\")]]))")
 fixed_maximum_resolution=$(python -c "print(max([ a*b for a,b in zip([abs(x) for x in [float(x) for x in \"$(PrintHeader ${fixedfile} 1)\".split(\"x\")]],[abs(x) for x in [float(x) for x in \"$(PrintHeader ${fixedfile} 2)\".split(\"x\")]])]))")
@@ -28,7 +29,7 @@ else
 fi
 
 if [[ $method == "SyN" ]]; then
-  antsRegistration --dimensionality 3 --verbose \
+  antsRegistration --dimensionality 3 --float ${use_float} --verbose \
     --output [ ${_arg_outputbasename}_output_,${_arg_outputbasename}_output_warped_image.nii.gz ] \
     --use-histogram-matching 1 \
     --initial-moving-transform [ ${fixedfile},${movingfile},1 ] \
@@ -38,13 +39,13 @@ if [[ $method == "SyN" ]]; then
     $(eval echo ${steps_syn}) \
     --masks [ ${fixedmask},${movingmask} ]
 elif [[ $method == "Affine" ]]; then
-  antsRegistration --dimensionality 3 --verbose \
+  antsRegistration --dimensionality 3 --float ${use_float} --verbose \
     --output [ ${_arg_outputbasename}_output_,${_arg_outputbasename}_output_warped_image.nii.gz ] \
     --use-histogram-matching 1 \
     --initial-moving-transform [ ${fixedfile},${movingfile},1 ] \
     $(eval echo ${steps_affine})
 elif [[ $method == "Rigid" ]]; then
-  antsRegistration --dimensionality 3 --verbose \
+  antsRegistration --dimensionality 3 --float ${use_float} --verbose \
     --output [ ${_arg_outputbasename}_output_,${_arg_outputbasename}_output_warped_image.nii.gz ] \
     --use-histogram-matching 1 \
     --initial-moving-transform [ ${fixedfile},${movingfile},1 ] \
@@ -16,8 +16,9 @@ fixed=$2
 mask=$3
 filename_template=$4
 token=$5
+use_float=${6:-0}
 
-antsRegistration --dimensionality 3 \
+antsRegistration --dimensionality 3 --float ${use_float} \
   --output [${filename_template}_output_,${filename_template}_output_warped_image.nii.gz] \
   --initial-moving-transform [$fixed,$moving,1] \
   --transform Rigid[0.1] --metric Mattes[$fixed,$moving,1,128,None] --convergence [2025x2025x2025x2025x675,1e-6,10] --shrink-factors 8x7x6x5x4 --smoothing-sigmas 3.98448927075x3.4822628776x2.97928762436x2.47510701762x1.96879525311vox --masks [NULL,NULL] \
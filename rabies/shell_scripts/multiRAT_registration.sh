@@ -16,6 +16,7 @@ fixed_pre=$2
 mask=$3
 filename_template=$4
 token=$5
+use_float=${6:-0}
 moving='scan_autobox.nii.gz'
 fixed='template_autobox.nii.gz'
 
@@ -23,13 +24,13 @@ fixed='template_autobox.nii.gz'
 3dAutobox -input $fixed_pre -prefix $fixed
 
 
-antsRegistration --dimensionality 3 \
+antsRegistration --dimensionality 3 --float ${use_float} \
   --output [${filename_template}_tmp_,${filename_template}_tmp_warped_image.nii.gz] \
   --initial-moving-transform [$fixed,$moving,1] --winsorize-image-intensities [0.1,0.995] \
   --transform Rigid[0.1] --metric MI[$fixed,$moving,1,32,Regular,0.25] --convergence [1000x1000x1000x500,1e-6,10] --shrink-factors 3x2x1x1 --smoothing-sigmas 3x2x1x0vox -v 0 -z 1
 
 
-antsRegistration --dimensionality 3 \
+antsRegistration --dimensionality 3 --float ${use_float} \
   --output [${filename_template}_tmp2_,${filename_template}_tmp2_warped_image.nii.gz] \
   --transform Similarity[0.1] --metric MI[$fixed,${filename_template}_tmp_warped_image.nii.gz,1,32,Regular,0.25] --convergence [1000x1000x1000x500x100,1e-8,10] --shrink-factors 4x3x2x1x1 --smoothing-sigmas 4x2x2x1x0vox \
   --transform SyN[0.1,3,0] --metric CC[$fixed,${filename_template}_tmp_warped_image.nii.gz,1,4] --convergence [20x15x10,1e-6,10] \
@@ -42,7 +43,7 @@ ComposeMultiTransform 3 ${filename_template}_output_1InverseWarp.nii.gz -R ${fix
 
 cp ${filename_template}_tmp_0GenericAffine.mat ${filename_template}_output_0GenericAffine.mat
 
-antsApplyTransforms -i ${moving_pre} -r ${fixed_pre} -t ${filename_template}_output_1Warp.nii.gz -t ${filename_template}_output_0GenericAffine.mat -o ${filename_template}_output_warped_image.nii.gz
+antsApplyTransforms --float ${use_float} -i ${moving_pre} -r ${fixed_pre} -t ${filename_template}_output_1Warp.nii.gz -t ${filename_template}_output_0GenericAffine.mat -o ${filename_template}_output_warped_image.nii.gz
 
 
 rm $moving
@@ -17,8 +17,9 @@ fixed=$2
 mask=$3
 filename_template=$4
 token=$5
+use_float=${6:-0}
 
-antsRegistration --dimensionality 3 \
+antsRegistration --dimensionality 3 --float ${use_float} \
   --output [${filename_template}_output_,${filename_template}_output_warped_image.nii.gz] \
   --transform Rigid[0.1] --metric Mattes[$fixed,$moving,1,128,None] --convergence [0,1e-6,10] --shrink-factors 1 --smoothing-sigmas 1vox \
   --transform Affine[0.1] --metric Mattes[$fixed,$moving,1,128,None] --convergence [0,1e-6,10] --shrink-factors 1 --smoothing-sigmas 0vox --masks [$mask] \
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from rabies.preprocess_pkg.bias_correction import otsu_bias_cor
+
+
+@pytest.mark.parametrize('shrink_factor', [1, 2])
+def test_otsu_bias_cor_removes_smooth_bias(tmp_path, shrink_factor):
+    rng = np.random.default_rng(0)
+    shape = (24, 32, 32)
+    zz, yy, xx = np.mgrid[:shape[0], :shape[1], :shape[2]]
+    r = ((zz-12)/10)**2+((yy-16)/14)**2+((xx-16)/14)**2
+    # two tissue classes within an ellipsoid, under a smooth multiplicative bias field
+    tissue = np.where(r < 0.3, 600., np.where(r < 1, 1000., 0.))
+    bias = np.exp(0.4*(xx-16)/16+0.2*(zz-12)/12)
+    array = (tissue*bias+rng.normal(0, 10, shape)*(r < 1)).astype(np.float32)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.2, 0.2, 0.2))
+    out_name = str(tmp_path/'corrected.nii.gz')
+
+    corrected = otsu_bias_cor(image, image, b_value=2, out_name=out_name, n_iter=50, shrink_factor=shrink_factor)
+    corrected_array = sitk.GetArrayFromImage(sitk.ReadImage(out_name))
+    assert np.allclose(corrected_array, sitk.GetArrayFromImage(corrected))
+
+    def coefficient_of_variation(a):
+        outer_class = (r > 0.45) & (r < 0.85)
+        return a[outer_class].std()/a[outer_class].mean()
+    # the intensity spread within the tissue class is mostly due to the bias field
+    assert coefficient_of_variation(array) > 0.15
+    assert coefficient_of_variation(corrected_array) < 0.5*coefficient_of_variation(array)
@@ -0,0 +1,109 @@
+import numpy as np
+from scipy.optimize import linprog
+from scipy.stats import norm
+
+from rabies.preprocess_pkg.despike import despike_design, l1_fit, despike_timeseries, despike_array
+
+
+def smooth_timeseries(num_timepoints, num_voxels, rng, corder=None):
+    # random curves within the span of the despiking design, around a baseline of 1000
+    design = despike_design(num_timepoints, corder=corder)
+    betas = rng.normal(0, 5, size=(design.shape[1], num_voxels))
+    betas[0] += 1000
+    return design.dot(betas)
+
+
+def test_l1_fit_matches_linear_program():
+    rng = np.random.default_rng(0)
+    num_timepoints = 300
+    design = despike_design(num_timepoints)
+    timeseries = smooth_timeseries(num_timepoints, 5, rng)+rng.standard_t(2, (num_timepoints, 5))
+    fit = l1_fit(timeseries, design)
+    # exact least absolute deviations, as min sum(u+v) subject to design.b+u-v = y with u,v >= 0
+    num_regressors = design.shape[1]
+    cost = np.concatenate([np.zeros(num_regressors), np.ones(2*num_timepoints)])
+    constraints = np.concatenate([design, np.eye(num_timepoints), -np.eye(num_timepoints)], axis=1)
+    bounds = [(None, None)]*num_regressors+[(0, None)]*2*num_timepoints
+    for i in range(timeseries.shape[1]):
+        solution = linprog(cost, A_eq=constraints, b_eq=timeseries[:, i], bounds=bounds, method='highs')
+        # the minimum is flat in some directions, so the costs are compared rather than the fitted curves
+        assert np.abs(timeseries[:, i]-fit[:, i]).sum() < solution.fun*(1+1e-3)
+
+
+def test_l1_fit_ignores_outliers():
+    rng = np.random.default_rng(0)
+    curve = smooth_timeseries(300, 50, rng)
+    timeseries = curve.copy()
+    # 5% of the timepoints are corrupted by large outliers
+    outliers = rng.random(timeseries.shape) < 0.05
+    timeseries[outliers] += rng.choice([-1, 1], outliers.sum())*rng.uniform(50, 200, outliers.sum())
+    fit = l1_fit(timeseries, despike_design(300))
+    assert np.abs(fit-curve).max() < 0.05
+
+
+def test_spikes_are_squashed_and_other_values_unchanged():
+    rng = np.random.default_rng(1)
+    num_timepoints = 600
+    # bounded noise, which stays within c1 sigma of the fit. The margin is only of ~0.4 for uniform noise,
+    # so a low order fit over a long timeseries keeps the error of the fit itself below it
+    clean = smooth_timeseries(num_timepoints, 200, rng, corder=1)+rng.uniform(-1, 1, (num_timepoints, 200))
+    clean = clean.astype(np.float32)
+    timeseries = clean.copy()
+    spikes = np.zeros(timeseries.shape, dtype=bool)
+    spikes[rng.choice(num_timepoints, 6, replace=False)] = True
+    timeseries[spikes] += 100
+
+    despiked, num_spikes = despike_timeseries(timeseries.copy(), corder=1)
+    assert despiked.dtype == np.float32
+    assert num_spikes == spikes.sum()
+    assert np.array_equal(despiked[~spikes], timeseries[~spikes])
+    # the squashed values stay within c2=4 sigma of the fit, where sigma is below the noise amplitude of 1
+    assert np.abs(despiked[spikes]-clean[spikes]).max() < 4
+
+    # the spikes, at s = r/sigma, are replaced with the fit plus c1+(c2-c1)*tanh((s-c1)/(c2-c1)) sigma
+    fit = l1_fit(timeseries.astype(np.float64), despike_design(num_timepoints, corder=1))
+    sigma = np.sqrt(np.pi/2)*np.median(np.abs(timeseries-fit), axis=0)
+    s = (timeseries-fit)/sigma
+    squashed = fit+(2.5+1.5*np.tanh((s-2.5)/1.5))*sigma
+    assert np.allclose(despiked[spikes], squashed[spikes], rtol=0, atol=1e-3)
+
+
+def test_squashed_fraction_on_gaussian_noise():
+    # sigma is estimated as sqrt(pi/2)*median(|residual|), as documented for 3dDespike. Since the L1 fit passes
+    # exactly through as many timepoints as there are regressors, the median is taken over a few exact zeros,
+    # and the expected fraction of values beyond c1=2.5 sigma_hat is above the 1.2% of a Gaussian
+    rng = np.random.default_rng(2)
+    num_timepoints = 300
+    timeseries = rng.normal(1000, 5, (num_timepoints, 5000))
+    num_regressors = despike_design(num_timepoints).shape[1]
+    quantile = (0.5*num_timepoints-num_regressors)/(num_timepoints-num_regressors)
+    threshold = 2.5*np.sqrt(np.pi/2)*norm.ppf((1+quantile)/2)
+    expected_fraction = 2*norm.sf(threshold)
+
+    _, num_spikes = despike_timeseries(timeseries.copy())
+    assert abs(num_spikes/timeseries.size-expected_fraction) < 0.005
+
+
+def test_float32_matches_float64():
+    rng = np.random.default_rng(3)
+    timeseries = rng.normal(1000, 5, (300, 500))
+    despiked64, num64 = despike_timeseries(timeseries.copy())
+    despiked32, num32 = despike_timeseries(timeseries.astype(np.float32))
+    assert np.abs(despiked32-despiked64).max() < 0.01*5
+    assert abs(num32-num64) <= 0.001*timeseries.size
+
+
+def test_despike_array_in_place():
+    rng = np.random.default_rng(4)
+    img_array = rng.normal(1000, 5, (100, 4, 5, 6)).astype(np.float32)
+    img_array[:, 0, 0, 0] = 0
+    img_array[50, 1, 1, 1] += 500
+    # the IRLS stopping criterion is shared by the voxels of a chunk, so the reference is computed per chunk
+    voxels = img_array.reshape(100, -1)[:, 1:].copy()
+    expected = np.concatenate([despike_timeseries(voxels[:, i:i+17].copy())[0] for i in range(0, voxels.shape[1], 17)],
+                              axis=1)
+    out = despike_array(img_array, n_threads=2, chunk_size=17)
+    assert out is img_array
+    assert np.all(img_array[:, 0, 0, 0] == 0)
+    assert np.array_equal(img_array.reshape(100, -1)[:, 1:], expected)
+    assert img_array[50, 1, 1, 1] < 1000+4*5
@@ -0,0 +1,76 @@
+import numpy as np
+import nibabel as nb
+
+from rabies.analysis_pkg import analysis_functions
+from rabies.analysis_pkg.analysis_functions import DR_operator, dual_regression, get_DR_operator, sub_DR_ICA
+from rabies.analysis_pkg.utils import MaskIndex
+
+
+def reference_dual_regression(IC_vectors, timeseries):
+    # the previous implementation, with the least squares problems solved by lstsq in float64
+    X = IC_vectors.T.astype(np.float64)
+    Y = timeseries.T.astype(np.float64)
+    X = X-X.mean(axis=0)
+    Y = Y-Y.mean(axis=0)
+    Y = (Y.T-Y.mean(axis=1)).T
+    w = np.linalg.lstsq(X, Y, rcond=None)[0]
+    w = (w.T/w.std(axis=1)).T
+    return np.linalg.lstsq(w.T, timeseries.astype(np.float64), rcond=None)[0]
+
+
+def synthetic_data(rng, num_ICs=6, num_voxels=800, num_timepoints=100):
+    IC_vectors = rng.laplace(size=(num_ICs, num_voxels))+0.3
+    timecourses = rng.normal(size=(num_timepoints, num_ICs))
+    timeseries = 500+timecourses.dot(IC_vectors)+rng.normal(0, 2, (num_timepoints, num_voxels))
+    return IC_vectors.astype(np.float32), timeseries.astype(np.float32)
+
+
+def test_DR_operator_matches_lstsq():
+    rng = np.random.default_rng(0)
+    IC_vectors, timeseries = synthetic_data(rng)
+    operator = DR_operator(IC_vectors)
+    assert operator.dtype == np.float32
+    # the operator solves the least squares fit of the spatially centered ICs onto any volume
+    X = IC_vectors.T.astype(np.float64)
+    X = X-X.mean(axis=0)
+    expected = np.linalg.lstsq(X, timeseries.T.astype(np.float64), rcond=None)[0]
+    assert np.allclose(operator.dot(timeseries.T.astype(np.float64)), expected, rtol=0, atol=1e-4*np.abs(expected).max())
+    # the rows sum to zero, so the spatial centering of the volumes has no effect
+    assert np.abs(operator.sum(axis=1)).max() < 1e-5*np.abs(operator).sum(axis=1).max()
+
+
+def test_dual_regression_matches_reference():
+    rng = np.random.default_rng(1)
+    IC_vectors, timeseries = synthetic_data(rng)
+    expected = reference_dual_regression(IC_vectors, timeseries)
+    for sub_ICs in [dual_regression(IC_vectors, timeseries),
+                    dual_regression(None, timeseries, operator=DR_operator(IC_vectors))]:
+        assert sub_ICs.shape == IC_vectors.shape
+        assert np.abs(sub_ICs-expected).max() < 1e-4*np.abs(expected).max()
+
+
+def test_sub_DR_ICA_shares_the_operator(tmp_path, monkeypatch):
+    monkeypatch.setattr(analysis_functions, '_DR_operator_cache', {})
+    rng = np.random.default_rng(2)
+    shape = (10, 9, 8)
+    mask = rng.random(shape) < 0.8
+    mask_file = str(tmp_path/'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    mask_index = MaskIndex(mask_file)
+    IC_vectors, timeseries = synthetic_data(rng, num_voxels=mask_index.num_voxels)
+    IC_file = str(tmp_path/'melodic_IC.nii.gz')
+    mask_index.to_img(IC_vectors).to_filename(IC_file)
+    bold_file = str(tmp_path/'bold.nii.gz')
+    mask_index.to_img(timeseries).to_filename(bold_file)
+    cache_dir = str(tmp_path/'cache')
+
+    expected = reference_dual_regression(IC_vectors, timeseries)
+    sub_ICs = sub_DR_ICA(bold_file, mask_file, IC_file, cache_dir=cache_dir)
+    assert np.abs(sub_ICs-expected).max() < 1e-4*np.abs(expected).max()
+
+    # the operator is restored from the cache directory in a new process, without recomputing it
+    operator = get_DR_operator(IC_file, mask_file)
+    monkeypatch.setattr(analysis_functions, '_DR_operator_cache', {})
+    monkeypatch.setattr(analysis_functions, 'DR_operator', None)
+    assert np.array_equal(get_DR_operator(IC_file, mask_file, cache_dir=cache_dir), operator)
+    assert np.array_equal(sub_DR_ICA(bold_file, mask_file, IC_file, cache_dir=cache_dir), sub_ICs)
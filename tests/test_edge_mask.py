@@ -0,0 +1,66 @@
+import numpy as np
+import nibabel as nb
+import pytest
+from scipy import ndimage
+
+from rabies.conf_reg_pkg.mod_ICA_AROMA import ICA_AROMA_functions
+from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import compute_edge_mask
+
+
+def reference_edge_mask(mask_array, num_edge_voxels):
+    # the previous voxelwise implementation
+    mask_array = mask_array.astype(np.float64)
+    shape = mask_array.shape
+    edge_mask = np.zeros(shape, dtype=bool)
+    num_voxel = 0
+    while num_voxel < num_edge_voxels:
+        for x in range(shape[0]):
+            for y in range(shape[1]):
+                for z in range(shape[2]):
+                    if mask_array[x, y, z]:
+                        if (mask_array[x-1:x+2, y-1:y+2, z-1:z+2] == 0).sum() > 0:
+                            edge_mask[x, y, z] = 1
+        mask_array = mask_array-edge_mask
+        num_voxel += 1
+    return edge_mask
+
+
+def random_mask(seed):
+    # smooth blob, which is cut by the image boundaries on some sides
+    rng = np.random.default_rng(seed)
+    mask = ndimage.gaussian_filter(rng.random((18, 16, 14)), 2) > 0.5
+    mask[:, :, -3:] |= mask[:, :, -4:-3]
+    mask[:3] = 1
+    return mask
+
+
+@pytest.mark.parametrize('num_edge_voxels', [1, 2, 3])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_edge_mask_matches_voxelwise_loop(tmp_path, monkeypatch, num_edge_voxels, seed):
+    monkeypatch.setattr(ICA_AROMA_functions, '_edge_mask_cache', {})
+    mask = random_mask(seed)
+    mask_file = str(tmp_path/'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    out_file = str(tmp_path/'edge.nii.gz')
+    compute_edge_mask(mask_file, out_file, num_edge_voxels)
+    edge_mask = np.asarray(nb.load(out_file).dataobj).astype(bool)
+    assert edge_mask.any()
+    assert np.array_equal(edge_mask, reference_edge_mask(mask, num_edge_voxels))
+
+
+def test_edge_mask_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ICA_AROMA_functions, '_edge_mask_cache', {})
+    mask = random_mask(0)
+    mask_file = str(tmp_path/'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    cache_dir = str(tmp_path/'cache')
+    compute_edge_mask(mask_file, str(tmp_path/'edge1.nii.gz'), 2, cache_dir=cache_dir)
+    expected = np.asarray(nb.load(str(tmp_path/'edge1.nii.gz')).dataobj)
+
+    # restored from the cache directory in a new process, then from memory
+    monkeypatch.setattr(ICA_AROMA_functions, '_edge_mask_cache', {})
+    monkeypatch.setattr(ndimage, 'binary_erosion', None)
+    for name in ['edge2.nii.gz', 'edge3.nii.gz']:
+        compute_edge_mask(mask_file, str(tmp_path/name), 2, cache_dir=cache_dir)
+        assert np.array_equal(np.asarray(nb.load(str(tmp_path/name)).dataobj), expected)
+    assert len(ICA_AROMA_functions._edge_mask_cache) == 1
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import estimate_pca_dim
+
+
+def centered_eigenvalues(data):
+    # voxels x time data, demeaned over time for each voxel as in runICA_python
+    data = data - data.mean(axis=1)[:, np.newaxis]
+    data = data - data.mean(axis=0)
+    return np.linalg.eigvalsh(np.dot(data.T, data) / (data.shape[0] - 1))
+
+
+@pytest.mark.parametrize('rank', [0, 10, 25])
+def test_estimate_pca_dim_known_rank(rank):
+    rng = np.random.default_rng(0)
+    num_voxels, num_timepoints = 5000, 200
+    data = rng.normal(size=(num_voxels, num_timepoints))
+    if rank > 0:
+        data += np.dot(rng.normal(size=(num_voxels, rank)), rng.normal(size=(rank, num_timepoints)))
+    # pure noise is estimated with a single component, as with sklearn's PCA(n_components='mle')
+    assert estimate_pca_dim(centered_eigenvalues(data), num_voxels) == max(rank, 1)
+
+
+def test_minka_log_likelihood_matches_sklearn():
+    _pca = pytest.importorskip('sklearn.decomposition._pca')
+    from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import minka_log_likelihood
+    rng = np.random.default_rng(1)
+    num_voxels, num_timepoints = 2000, 80
+    data = rng.normal(size=(num_voxels, num_timepoints))
+    data += np.dot(rng.normal(size=(num_voxels, 5)), rng.normal(size=(5, num_timepoints)))
+    spectrum = np.sort(centered_eigenvalues(data))[::-1][:-1]
+    expected = [_pca._assess_dimension(spectrum, rank, num_voxels) for rank in range(1, len(spectrum))]
+    assert np.allclose(minka_log_likelihood(spectrum, num_voxels), expected, rtol=1e-10)
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from scipy import ndimage
+
+from rabies.preprocess_pkg.hmc import register_volume_rigid, origin_rigid_params, centered_rigid_params, \
+    sitk_motion_correction, write_MOCOparams
+
+
+def phantom(seed=0):
+    # smooth random texture within an ellipsoid, on an anisotropic grid
+    rng = np.random.default_rng(seed)
+    shape = (32, 64, 64)
+    array = ndimage.gaussian_filter(rng.random(shape), 2.5)
+    array = (array-array.min())/(array.max()-array.min())*1000
+    zz, yy, xx = np.mgrid[:shape[0], :shape[1], :shape[2]]
+    array *= (((zz-16)/13)**2+((yy-32)/26)**2+((xx-32)/26)**2) < 1
+    image = sitk.GetImageFromArray(array.astype(np.float32))
+    image.SetSpacing((0.25, 0.25, 0.5))
+    image.SetOrigin((-8., -8., -8.))
+    return image
+
+
+def move(image, params):
+    # the MOCOparams map points of the reference onto the moving volume, with the rotation centered on the origin
+    transform = sitk.Euler3DTransform()
+    transform.SetParameters(params)
+    return sitk.Resample(image, image, transform.GetInverse(), sitk.sitkLinear, 0.0)
+
+
+def test_rigid_params_center_conversion():
+    params = [0.05, -0.025, 0.04, 0.25, -0.15, 0.2]
+    center = [1., -2., 3.]
+    assert np.allclose(origin_rigid_params(centered_rigid_params(params, center), center), params)
+
+    # both parameterizations describe the same transform
+    centered = sitk.Euler3DTransform()
+    centered.SetCenter(center)
+    centered.SetParameters(centered_rigid_params(params, center))
+    origin = sitk.Euler3DTransform()
+    origin.SetParameters(params)
+    point = (0.5, 1.5, -2.5)
+    assert np.allclose(centered.TransformPoint(point), origin.TransformPoint(point))
+
+
+def test_register_volume_known_motion():
+    reference = phantom()
+    true_params = [0.05, -0.025, 0.04, 0.25, -0.15, 0.2]
+    params, metric_pre, metric_post, transform = register_volume_rigid(reference, move(reference, true_params))
+    assert np.abs(np.asarray(params[:3])-true_params[:3]).max() < 0.003
+    assert np.abs(np.asarray(params[3:])-true_params[3:]).max() < 0.02
+    # Mattes MI is negative, and improves with registration
+    assert metric_post < metric_pre
+
+
+def test_sitk_motion_correction_known_motion(tmp_path):
+    reference = phantom()
+    true_params = np.asarray([[0.02*np.sin(t), -0.01*t, 0.015, 0.1*t, -0.05, 0.08*np.cos(t)] for t in range(4)])
+    volumes = [sitk.GetArrayFromImage(move(reference, list(params))) for params in true_params]
+    timeseries = sitk.GetImageFromArray(np.stack(volumes), isVector=False)
+    timeseries.SetSpacing(reference.GetSpacing()+(1.,))
+    timeseries.SetOrigin(reference.GetOrigin()+(0.,))
+    in_file = str(tmp_path/'bold.nii.gz')
+    ref_file = str(tmp_path/'ref.nii.gz')
+    sitk.WriteImage(timeseries, in_file)
+    sitk.WriteImage(reference, ref_file)
+
+    motcorr_params, corrected = sitk_motion_correction(in_file, ref_file, n_procs=2, resample=True)
+    csv_file = str(tmp_path/'MOCOparams.csv')
+    write_MOCOparams(motcorr_params, csv_file)
+    df = pd.read_csv(csv_file)
+    assert list(df.columns[:2]) == ['MetricPre', 'MetricPost']
+    estimated = df[['MOCOparam%i' % (i) for i in range(6)]].values
+    assert np.abs(estimated[:, :3]-true_params[:, :3]).max() < 0.003
+    assert np.abs(estimated[:, 3:]-true_params[:, 3:]).max() < 0.02
+
+    # the realigned volumes match the reference within the brain
+    reference_array = sitk.GetArrayFromImage(reference)
+    inside = ndimage.binary_erosion(reference_array > 0, iterations=3)
+    assert corrected.shape == (4,)+reference_array.shape
+    assert np.abs(corrected[:, inside]-reference_array[inside]).mean() < 0.05*reference_array[inside].mean()
@@ -0,0 +1,84 @@
+import numpy as np
+import nibabel as nb
+
+from rabies.analysis_pkg.analysis_functions import migp, migp_group_ICA
+from rabies.analysis_pkg.utils import MaskIndex
+
+
+def write_dataset(tmp_path, maps, shape=(12, 10, 8), num_scans=4, num_timepoints=60, noise=0.1, seed=0):
+    # scans sharing the same spatial maps (one value per voxel of the mask), with their own timecourses and noise
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    mask[1:-1, 1:-1, 1:-1] = True
+    mask_file = str(tmp_path/'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    mask_index = MaskIndex(mask_file)
+    bold_files = []
+    for i in range(num_scans):
+        timecourses = rng.normal(size=(num_timepoints, maps.shape[0]))
+        timeseries = 100+timecourses.dot(maps[:, :mask_index.num_voxels])+rng.normal(0, noise, (num_timepoints, mask_index.num_voxels))
+        bold_file = str(tmp_path/('bold%i.nii.gz' % (i)))
+        mask_index.to_img(timeseries.astype(np.float32)).to_filename(bold_file)
+        bold_files.append(bold_file)
+    return bold_files, mask_file
+
+
+def normalized_scans(bold_files, mask_file):
+    # the demeaned and variance normalized scans, concatenated in time, as input to a full group PCA
+    mask_index = MaskIndex(mask_file)
+    scans = []
+    for bold_file in bold_files:
+        timeseries = mask_index.gather_file(bold_file, dtype=np.float64)
+        timeseries -= timeseries.mean(axis=0)
+        timeseries /= timeseries.std(axis=0)
+        scans.append(timeseries)
+    return np.concatenate(scans, axis=0)
+
+
+def test_migp_exact_when_voxels_fit(tmp_path):
+    # with fewer voxels than migp_dim, the reduction keeps all the information: the spatial covariance matches
+    # the one of the full concatenated data
+    rng = np.random.default_rng(1)
+    bold_files, mask_file = write_dataset(tmp_path, rng.normal(size=(3, 18)), shape=(5, 5, 4), num_timepoints=30,
+                                          noise=1)
+    W = migp(bold_files, mask_file, migp_dim=40)
+    X = normalized_scans(bold_files, mask_file)
+    assert W.shape == (40, 18)
+    assert np.allclose(W.T.dot(W), X.T.dot(X), rtol=0, atol=1e-3*np.abs(X.T.dot(X)).max())
+
+
+def test_migp_matches_group_PCA_subspace(tmp_path):
+    rng = np.random.default_rng(2)
+    num_components = 5
+    maps = rng.laplace(size=(num_components, 12*10*8))
+    bold_files, mask_file = write_dataset(tmp_path, maps, noise=1)
+    W = migp(bold_files, mask_file, migp_dim=20)
+    assert W.shape[0] == 20
+    X = normalized_scans(bold_files, mask_file)
+
+    # the strongest spatial eigenvectors and eigenvalues of the MIGP estimate match the ones of the full data
+    _, s_full, V_full = np.linalg.svd(X, full_matrices=False)
+    _, s_migp, V_migp = np.linalg.svd(W.astype(np.float64), full_matrices=False)
+    cosines = np.linalg.svd(V_full[:num_components].dot(V_migp[:num_components].T), compute_uv=False)
+    assert cosines.min() > 0.999
+    assert np.allclose(s_migp[:num_components], s_full[:num_components], rtol=0.01)
+
+
+def test_migp_group_ICA_recovers_maps(tmp_path):
+    rng = np.random.default_rng(3)
+    num_components = 4
+    # sparse, positively skewed maps, as expected by spatial ICA. The signal is of the order of the noise, so the
+    # variance normalization of each voxel leaves the maps mostly unchanged
+    maps = np.abs(rng.laplace(size=(num_components, 12*10*8)))*(rng.random((num_components, 12*10*8)) < 0.2)
+    bold_files, mask_file = write_dataset(tmp_path, maps, num_scans=3, noise=1, seed=3)
+    IC_file = migp_group_ICA(bold_files, mask_file, num_components, str(tmp_path/'group_melodic.ica'), migp_dim=30)
+    mask_index = MaskIndex(mask_file)
+    ICs = mask_index.gather_file(IC_file, dtype=np.float64)
+    assert ICs.shape == (num_components, mask_index.num_voxels)
+    assert np.allclose(ICs.mean(axis=1), 0, atol=1e-4)
+    assert np.allclose(ICs.std(axis=1), 1, atol=1e-3)
+
+    # each true map is recovered by one of the components, with a positive sign
+    correlations = np.corrcoef(ICs, maps[:, :mask_index.num_voxels])[:num_components, num_components:]
+    assert np.all(correlations.max(axis=0) > 0.75)
+    assert sorted(correlations.argmax(axis=0)) == list(range(num_components))
@@ -0,0 +1,57 @@
+import itertools
+
+import numpy as np
+import SimpleITK as sitk
+
+from rabies.preprocess_pkg.visual_diagnosis import otsu_thresholds
+
+
+def mixture(seed, classes=[(0, 5, 20000), (100, 10, 8000), (200, 15, 6000), (350, 20, 4000), (500, 30, 3000)]):
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.normal(mean, std, num) for mean, std, num in classes]).astype(np.float32)
+
+
+def test_otsu_thresholds_match_itk():
+    # ITK (as used by ANTs ThresholdImage Otsu) searches all combinations of thresholds
+    array = mixture(0)
+    otsu = sitk.OtsuMultipleThresholdsImageFilter()
+    otsu.SetNumberOfThresholds(4)
+    otsu.SetNumberOfHistogramBins(200)
+    otsu.Execute(sitk.GetImageFromArray(array.reshape(1, 1, -1)))
+    itk_thresholds = np.asarray(otsu.GetThresholds())
+
+    thresholds = otsu_thresholds(array, num_thresholds=4, num_bins=200)
+    # ITK pads the histogram range slightly, so the thresholds agree within a small fraction of a bin
+    bin_width = (array.max()-array.min())/200
+    assert np.abs(thresholds-itk_thresholds).max() < 0.05*bin_width
+    assert np.mean(np.digitize(array, thresholds) == np.digitize(array, itk_thresholds)) > 0.999
+
+
+def test_otsu_thresholds_exhaustive_search():
+    # the dynamic programming solution maximizes the between-class variance over all combinations of bins
+    array = mixture(3, classes=[(0, 3, 3000), (20, 4, 2000), (45, 6, 1500), (60, 3, 500)])
+    num_bins = 30
+    thresholds = otsu_thresholds(array, num_thresholds=3, num_bins=num_bins)
+
+    hist, bin_edges = np.histogram(array, bins=num_bins)
+    p = hist/hist.sum()
+    centers = (bin_edges[:-1]+bin_edges[1:])/2
+
+    def between_class_variance(boundaries):
+        edges = [0]+list(boundaries)+[num_bins]
+        total = 0
+        for start, stop in zip(edges[:-1], edges[1:]):
+            w = p[start:stop].sum()
+            if w > 0:
+                total += (p[start:stop]*centers[start:stop]).sum()**2/w
+        return total
+
+    best = max(itertools.combinations(range(1, num_bins), 3), key=between_class_variance)
+    assert np.allclose(between_class_variance(np.searchsorted(bin_edges, thresholds)), between_class_variance(best))
+    assert np.allclose(thresholds, bin_edges[list(best)])
+
+
+def test_otsu_thresholds_ignore_nan():
+    array = mixture(4)
+    with_nan = np.concatenate([array, np.full(100, np.nan, dtype=np.float32)])
+    assert np.array_equal(otsu_thresholds(with_nan), otsu_thresholds(array))
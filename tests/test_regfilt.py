@@ -0,0 +1,75 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from rabies.conf_reg_pkg.mod_ICA_AROMA.ICA_AROMA_functions import regfilt, denoising
+
+
+def reference_regfilt(voxel_timeseries, mix, denIdx, aggressive=False):
+    # fsl_regfilt in float64: the voxel means are removed and restored around the regression of the data
+    # onto the demeaned design, and the fitted contribution of the filtered components is subtracted
+    data = voxel_timeseries.astype(np.float64).T
+    voxel_mean = data.mean(axis=0)
+    data = data-voxel_mean
+    mix = mix-mix.mean(axis=0)
+    if aggressive:
+        betas = np.linalg.lstsq(mix[:, denIdx], data, rcond=None)[0]
+    else:
+        betas = np.linalg.lstsq(mix, data, rcond=None)[0][denIdx]
+    return (data-mix[:, denIdx].dot(betas)+voxel_mean).T
+
+
+def synthetic_data(rng, num_voxels=500, num_timepoints=150, num_ICs=12):
+    # component timecourses with non-zero means, as in melodic_mix, mixed into voxel timeseries with noise
+    mix = rng.normal(0.2, 1, (num_timepoints, num_ICs))
+    maps = rng.normal(0, 5, (num_ICs, num_voxels))
+    baseline = rng.uniform(500, 1500, num_voxels)
+    noise = rng.normal(0, 2, (num_timepoints, num_voxels))
+    return (baseline+(mix-mix.mean(axis=0)).dot(maps)+noise).T.astype(np.float32), mix, maps, baseline
+
+
+@pytest.mark.parametrize('aggressive', [False, True])
+def test_regfilt_matches_fsl_regfilt(aggressive):
+    rng = np.random.default_rng(0)
+    voxel_timeseries, mix, maps, baseline = synthetic_data(rng)
+    denIdx = np.array([1, 4, 5, 9])
+    denoised = regfilt(voxel_timeseries, mix, denIdx, aggressive=aggressive, block_size=64)
+    assert denoised.dtype == np.float32
+    expected = reference_regfilt(voxel_timeseries, mix, denIdx, aggressive=aggressive)
+    assert np.abs(denoised-expected).max() < 1e-5*np.abs(expected).max()
+
+
+def test_regfilt_nonaggressive_known_answer():
+    # without noise, non-aggressive denoising removes exactly the contribution of the motion components
+    rng = np.random.default_rng(1)
+    _, mix, maps, baseline = synthetic_data(rng)
+    demeaned_mix = mix-mix.mean(axis=0)
+    voxel_timeseries = (baseline+demeaned_mix.dot(maps)).T
+    denIdx = np.array([0, 3])
+    keep = np.setdiff1d(np.arange(mix.shape[1]), denIdx)
+    denoised = regfilt(voxel_timeseries, mix, denIdx)
+    expected = (baseline+demeaned_mix[:, keep].dot(maps[keep])).T
+    assert np.abs(denoised-expected).max() < 1e-3
+
+
+def test_denoising_within_mask(tmp_path):
+    rng = np.random.default_rng(2)
+    voxel_timeseries, mix, maps, baseline = synthetic_data(rng, num_voxels=6*5*4)
+    array = voxel_timeseries.reshape(6, 5, 4, -1)
+    in_file = str(tmp_path/'func.nii.gz')
+    nb.Nifti1Image(array, np.eye(4)).to_filename(in_file)
+    melmix = str(tmp_path/'melodic_mix')
+    np.savetxt(melmix, mix)
+    mask = rng.random((6, 5, 4)) < 0.7
+    mask_file = str(tmp_path/'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    denIdx = np.array([2, 7])
+
+    denoised = denoising(None, in_file, str(tmp_path), melmix, 'both', denIdx, mask=mask_file)
+    for den in ['nonaggr', 'aggr']:
+        written = np.asarray(nb.load(str(tmp_path/('denoised_func_data_%s.nii.gz' % (den)))).dataobj)
+        assert np.array_equal(written, np.asarray(denoised[den].dataobj))
+        expected = reference_regfilt(array[mask], mix, denIdx, aggressive=(den == 'aggr'))
+        assert np.allclose(written[mask], expected, rtol=0, atol=1e-2)
+        # voxels outside of the mask are left unchanged
+        assert np.array_equal(written[~mask], array[~mask])
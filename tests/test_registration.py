@@ -0,0 +1,152 @@
+import os
+import shlex
+import subprocess
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+import rabies
+from rabies.preprocess_pkg import registration
+from rabies.preprocess_pkg.registration import ants_registration_command, registration_cache_key, \
+    restore_registration, store_registration, run_antsRegistration
+
+shell_scripts = os.path.dirname(os.path.realpath(rabies.__file__))+'/shell_scripts'
+
+# records the arguments of antsRegistration instead of running it
+fake_antsRegistration = '''#!/bin/bash
+printf '%s\\n' "$@" > "$ANTS_ARGS_FILE"
+'''
+
+# prints the spacing (1) or size (2) of an image, as ANTs' PrintHeader
+fake_PrintHeader = '''#!/usr/bin/env python
+import sys
+import nibabel as nb
+img = nb.load(sys.argv[1])
+values = img.header.get_zooms()[:3] if sys.argv[2] == '1' else img.shape[:3]
+print('x'.join([str(float(v)) for v in values]))
+'''
+
+# deterministic stand-in for ants_generate_iterations.py, with the same shell variables and line continuations
+fake_generate_iterations = '''#!/usr/bin/env python
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--min', type=float)
+parser.add_argument('--max', type=float)
+parser.add_argument('--output', default='syn')
+opts = parser.parse_args()
+if opts.output == 'syn':
+    print('--convergence [ %ix10,1e-6,10 ] \\\\\\n--shrink-factors 2x1 --smoothing-sigmas %sx0vox' % (int(opts.max), opts.min))
+else:
+    print('--transform %s[ 0.1 ] --metric Mattes[ ${fixedfile},${movingfile},1,32,None ] \\\\\\n'
+          '--convergence [ %ix10,1e-6,10 ] --shrink-factors 2x1 --smoothing-sigmas %sx0vox --masks [ ${fixedmask},${movingmask} ]'
+          % ('Rigid' if opts.output == 'rigid' else 'Affine', int(opts.max), opts.min))
+'''
+
+
+@pytest.fixture
+def fake_ants(tmp_path, monkeypatch):
+    bin_dir = tmp_path/'bin'
+    bin_dir.mkdir()
+    fakes = [('antsRegistration', fake_antsRegistration), ('PrintHeader', fake_PrintHeader)]
+    if os.path.isfile(shell_scripts+'/ants_generate_iterations.py'):
+        # the Python driver uses the installed script, which the shell script must then find first in the PATH
+        os.symlink(shell_scripts+'/ants_generate_iterations.py', bin_dir/'ants_generate_iterations.py')
+    else:
+        fakes.append(('ants_generate_iterations.py', fake_generate_iterations))
+    for name, content in fakes:
+        (bin_dir/name).write_text(content)
+        (bin_dir/name).chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir)+os.pathsep+os.environ['PATH'])
+    monkeypatch.setenv('ANTS_ARGS_FILE', str(tmp_path/'args.txt'))
+    monkeypatch.setattr(registration, '_iteration_schedules', {})
+    return tmp_path
+
+
+def write_image(filename, shape=(200, 20, 10), spacing=0.125, seed=0):
+    data = np.random.default_rng(seed).random(shape).astype(np.float32)
+    nb.Nifti1Image(data, np.diag([spacing]*3+[1])).to_filename(filename)
+    return str(filename)
+
+
+@pytest.mark.parametrize('reg_method, script', [('light_SyN', 'light_SyN_registration.sh'),
+                                                ('heavy_SyN', 'heavy_SyN_registration.sh'),
+                                                ('null_nonlin', 'null_nonlin.sh'),
+                                                ('Rigid', 'generic_registration.sh'),
+                                                ('Affine', 'generic_registration.sh'),
+                                                ('SyN', 'generic_registration.sh')])
+def test_command_matches_shell_script(fake_ants, reg_method, script):
+    moving = write_image(fake_ants/'moving.nii.gz', seed=1)
+    fixed = write_image(fake_ants/'fixed.nii.gz', seed=2)
+    mask = write_image(fake_ants/'mask.nii.gz', seed=3)
+    subprocess.run(['bash', '%s/%s' % (shell_scripts, script), moving, fixed, mask, 'out', reg_method, '1'],
+                   check=True, cwd=str(fake_ants), stderr=subprocess.DEVNULL)
+    script_args = (fake_ants/'args.txt').read_text().split('\n')[:-1]
+
+    command = ants_registration_command(reg_method, moving, fixed, mask, 'out', use_float=1)
+    assert shlex.split(command) == ['antsRegistration']+script_args
+
+
+def test_store_and_restore(tmp_path):
+    outputs = [str(tmp_path/name) for name in ['a_0GenericAffine.mat', 'a_1Warp.nii.gz',
+                                               'a_1InverseWarp.nii.gz', 'a_warped.nii.gz']]
+    # linear registration: no warp files
+    for output in [outputs[0], outputs[3]]:
+        with open(output, 'w') as f:
+            f.write(os.path.basename(output))
+    cache_dir = str(tmp_path/'cache')
+    assert not restore_registration(cache_dir, 'key', outputs)
+    store_registration(cache_dir, 'key', outputs)
+
+    restored = [str(tmp_path/'restored'/os.path.basename(output)) for output in outputs]
+    os.makedirs(tmp_path/'restored')
+    assert restore_registration(cache_dir, 'key', restored)
+    for output, restored_output in zip(outputs, restored):
+        assert os.path.isfile(restored_output) == os.path.isfile(output)
+        if os.path.isfile(output):
+            assert open(restored_output).read() == open(output).read()
+
+
+def test_run_antsRegistration_restores_cache(tmp_path, monkeypatch):
+    moving = write_image(tmp_path/'moving.nii.gz', seed=1)
+    fixed = write_image(tmp_path/'fixed.nii.gz', seed=2)
+    script = tmp_path/'custom.sh'
+    # the custom registration only writes the affine and warped image, and counts its executions
+    script.write_text('#!/bin/bash\necho run >> %s/count.txt\necho affine > $4_output_0GenericAffine.mat\n'
+                      'cp $1 $4_output_warped_image.nii.gz\n' % (tmp_path))
+    cache_dir = str(tmp_path/'cache')
+    for run in ['run1', 'run2']:
+        os.makedirs(tmp_path/run)
+        monkeypatch.chdir(tmp_path/run)
+        affine, warp, inverse_warp, warped = run_antsRegistration(
+            str(script), moving, fixed, 'NULL', rabies_data_type=8, cache_dir=cache_dir)
+        assert os.path.isfile(affine) and os.path.isfile(warped)
+        assert warp == 'NULL' and inverse_warp == 'NULL'
+    assert open(tmp_path/'count.txt').read().split() == ['run']
+
+
+def test_cache_key_follows_script_content(tmp_path, monkeypatch):
+    moving = write_image(tmp_path/'moving.nii.gz', seed=1)
+    fixed = write_image(tmp_path/'fixed.nii.gz', seed=2)
+    script = tmp_path/'multiRAT_registration.sh'
+    script.write_text('antsRegistration a\n')
+    # multiRAT is resolved to its script in shell_scripts/, which is replaced here by an editable copy
+    monkeypatch.setattr(registration, 'define_reg_script', lambda reg_option: str(script))
+    key = registration_cache_key('multiRAT', moving, fixed, 'NULL', 8)
+    assert registration_cache_key('multiRAT', moving, fixed, 'NULL', 8) == key
+    script.write_text('antsRegistration b\n')
+    assert not registration_cache_key('multiRAT', moving, fixed, 'NULL', 8) == key
+    # the key also depends on the content of the images
+    write_image(tmp_path/'moving.nii.gz', seed=4)
+    assert not registration_cache_key('multiRAT', moving, fixed, 'NULL', 8) == key
+
+
+def test_cache_key_follows_builtin_command(tmp_path, monkeypatch):
+    moving = write_image(tmp_path/'moving.nii.gz', seed=1)
+    fixed = write_image(tmp_path/'fixed.nii.gz', seed=2)
+    key = registration_cache_key('light_SyN', moving, fixed, 'NULL', 8)
+    # the key does not depend on the image paths
+    os.rename(moving, tmp_path/'moving2.nii.gz')
+    assert registration_cache_key('light_SyN', str(tmp_path/'moving2.nii.gz'), fixed, 'NULL', 8) == key
+    monkeypatch.setattr(registration, 'light_SyN_stages', registration.light_SyN_stages.replace('2025x', '1000x'))
+    assert not registration_cache_key('light_SyN', str(tmp_path/'moving2.nii.gz'), fixed, 'NULL', 8) == key
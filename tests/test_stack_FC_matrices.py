@@ -0,0 +1,66 @@
+import numpy as np
+
+from rabies.analysis_pkg.analysis_functions import stack_FC_matrices, load_FC_matrix
+
+
+def write_FC_matrix(filename, labels, rng, atlas='labels'):
+    corr_matrix = np.corrcoef(rng.normal(size=(len(labels), 50)))
+    np.savez(filename, upper_triangle=corr_matrix[np.triu_indices(len(labels), 1)].astype(np.float32),
+             labels=np.asarray(labels), atlas=atlas)
+    return str(filename)
+
+
+def full_matrix(data_file, roi_labels):
+    # the correlation matrix of a scan over the given labels, with NaN for the labels missing from the scan
+    labels, corr_matrix = load_FC_matrix(data_file)
+    positions = np.searchsorted(roi_labels, labels)
+    full = np.full((len(roi_labels), len(roi_labels)), np.nan)
+    full[np.ix_(positions, positions)] = corr_matrix
+    return full
+
+
+def test_stack_matching_labels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    data_files = [write_FC_matrix(tmp_path/('scan%i.npz' % (i)), [1, 2, 5, 7], rng) for i in range(3)]
+    [stack_file], [stats_file] = stack_FC_matrices([data_files[:2], data_files[2]])
+
+    stack = np.load(stack_file)
+    assert stack.shape == (3, 6)
+    z = np.arctanh(np.stack([np.load(data_file)['upper_triangle'] for data_file in data_files]).astype(np.float64))
+    stats = np.load(stats_file)
+    assert np.array_equal(stats['labels'], [1, 2, 5, 7])
+    assert np.allclose(stats['mean_z'], z.mean(axis=0), atol=1e-6)
+    assert np.allclose(stats['var_z'], z.var(axis=0, ddof=1), atol=1e-6)
+    assert np.all(stats['num_scans'] == 3)
+
+
+def test_stack_different_labels(tmp_path, monkeypatch):
+    # e.g. native space parcellations, where some ROIs fall outside of the mask of a scan
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(1)
+    label_sets = [[1, 2, 3, 5], [2, 3, 4, 5, 6], [1, 2, 3, 4, 5, 6]]
+    data_files = [write_FC_matrix(tmp_path/('scan%i.npz' % (i)), labels, rng) for i, labels in enumerate(label_sets)]
+    data_files.append(write_FC_matrix(tmp_path/'other.npz', [1, 2], rng, atlas='other'))
+    stack_files, stats_files = stack_FC_matrices(data_files)
+    assert len(stack_files) == 2
+
+    stats = np.load(stats_files[0])
+    roi_labels = stats['labels']
+    assert np.array_equal(roi_labels, [1, 2, 3, 4, 5, 6])
+    triu = np.triu_indices(len(roi_labels), 1)
+    expected = np.stack([full_matrix(data_file, roi_labels)[triu] for data_file in data_files[:3]])
+    stack = np.load(stack_files[0])
+    assert stack.shape == (3, 15)
+    assert np.array_equal(np.isnan(stack), np.isnan(expected))
+    assert np.allclose(stack, expected, equal_nan=True)
+
+    z = np.arctanh(expected)
+    num_scans = (~np.isnan(z)).sum(axis=0)
+    assert num_scans.min() == 1
+    assert np.allclose(stats['mean_z'], np.nanmean(z, axis=0), atol=1e-6)
+    # the variance is undefined for the edges found in a single scan
+    assert np.array_equal(np.isnan(stats['var_z']), num_scans < 2)
+    assert np.allclose(stats['var_z'][num_scans > 1], np.nanvar(z[:, num_scans > 1], axis=0, ddof=1), atol=1e-6)
+    assert np.array_equal(stats['num_scans'], num_scans)
+    assert list(stats['files']) == data_files[:3]
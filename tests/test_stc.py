@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+import nibabel as nb
+import pytest
+import SimpleITK as sitk
+
+from rabies.preprocess_pkg.stc import get_slice_timing, shift_timeseries, slice_timing_correction
+
+
+def test_slice_timing_patterns():
+    # alt-z acquires the even slices then the odd ones, and seq-z all slices in order, starting from the last
+    # slice along the anterior-posterior axis of the RAS array
+    assert np.allclose(get_slice_timing('alt', 5, 1.0), [0.4, 0.8, 0.2, 0.6, 0])
+    assert np.allclose(get_slice_timing('alt', 6, 1.2), np.array([5, 2, 4, 1, 3, 0])*0.2)
+    assert np.allclose(get_slice_timing('seq', 5, 1.0), [0.8, 0.6, 0.4, 0.2, 0])
+    with pytest.raises(ValueError):
+        get_slice_timing('foo', 5, 1.0)
+
+
+@pytest.mark.parametrize('interpolation, tol', [('quintic', 1e-5), ('sinc', 2e-3), ('fft', 2e-3)])
+@pytest.mark.parametrize('shift', [0.3, -0.45, 1.7])
+def test_shift_sinusoid(interpolation, tol, shift):
+    n = np.arange(200)
+    frequency = 2*np.pi/20
+    timeseries = np.stack([np.sin(frequency*n), np.cos(frequency*n)], axis=1)
+    shifted = shift_timeseries(timeseries, shift, interpolation)
+    # sample n of the output is the input at n+shift, away from the edges
+    expected = np.stack([np.sin(frequency*(n+shift)), np.cos(frequency*(n+shift))], axis=1)
+    assert np.abs(shifted-expected)[10:-10].max() < tol
+
+
+def test_shift_keeps_float32():
+    timeseries = np.random.default_rng(0).normal(size=(50, 3, 4)).astype(np.float32)
+    for interpolation in ['quintic', 'sinc', 'fft']:
+        assert shift_timeseries(timeseries, 0.25, interpolation).dtype == np.float32
+    # an integer shift is a translation of the samples
+    assert np.allclose(shift_timeseries(timeseries, 2, 'quintic')[:-2], timeseries[2:], atol=1e-6)
+
+
+@pytest.mark.parametrize('tpattern', ['alt', 'seq'])
+def test_slice_timing_correction_aligns_slices(tmp_path, monkeypatch, tpattern):
+    monkeypatch.chdir(tmp_path)
+    tr = 1.5
+    num_timepoints, num_slices = 120, 7
+    frequency = 2*np.pi/(12*tr)
+    slice_times = get_slice_timing(tpattern, num_slices, tr)
+    # each anterior-posterior slice samples the same signal at its own acquisition time
+    times = np.arange(num_timepoints)[:, None]*tr+slice_times[None, :]
+    array = np.zeros((num_timepoints, 4, num_slices, 5), dtype=np.float32)
+    array += (100+10*np.sin(frequency*times))[:, None, :, None]
+    image = sitk.GetImageFromArray(array, isVector=False)
+    in_file = str(tmp_path/'bold.nii.gz')
+    sitk.WriteImage(image, in_file)
+
+    out_file = slice_timing_correction(in_file, tr='%ss' % (tr), tpattern=tpattern)
+    corrected = sitk.GetArrayFromImage(sitk.ReadImage(out_file))
+    assert corrected.dtype == np.float32
+    # all slices are aligned to the mean slice time
+    expected = 100+10*np.sin(frequency*(np.arange(num_timepoints)*tr+slice_times.mean()))
+    assert np.abs(corrected-expected[:, None, None, None])[5:-5].max() < 1e-3
+
+
+@pytest.mark.parametrize('y_flip, encoding_direction, reversed_times', [
+    (1, 'j', False), (-1, 'j', True), (1, 'j-', True), (-1, 'j-', False)])
+def test_bids_slice_timing_orientation(tmp_path, y_flip, encoding_direction, reversed_times):
+    pytest.importorskip('bids')
+    bids_dir = tmp_path/'bids'
+    func_dir = bids_dir/'sub-01'/'func'
+    func_dir.mkdir(parents=True)
+    (bids_dir/'dataset_description.json').write_text(json.dumps({'Name': 'test', 'BIDSVersion': '1.6.0'}))
+    name_source = str(func_dir/'sub-01_task-rest_bold.nii.gz')
+    # the second voxel axis is anterior-posterior, in either direction
+    affine = np.diag([0.2, y_flip*0.2, 0.5, 1.])
+    nb.Nifti1Image(np.zeros((3, 4, 2, 5), dtype=np.float32), affine).to_filename(name_source)
+    slice_timing = [0, 0.5, 0.25, 0.75]
+    (func_dir/'sub-01_task-rest_bold.json').write_text(json.dumps(
+        {'RepetitionTime': 1.0, 'SliceTiming': slice_timing, 'SliceEncodingDirection': encoding_direction}))
+
+    slice_times = get_slice_timing('bids', 4, 1.0, name_source=name_source, bids_dir=str(bids_dir))
+    expected = slice_timing[::-1] if reversed_times else slice_timing
+    assert np.allclose(slice_times, expected)
+
+
+def test_bids_slice_timing_wrong_axis(tmp_path):
+    pytest.importorskip('bids')
+    bids_dir = tmp_path/'bids'
+    func_dir = bids_dir/'sub-01'/'func'
+    func_dir.mkdir(parents=True)
+    (bids_dir/'dataset_description.json').write_text(json.dumps({'Name': 'test', 'BIDSVersion': '1.6.0'}))
+    name_source = str(func_dir/'sub-01_task-rest_bold.nii.gz')
+    nb.Nifti1Image(np.zeros((3, 4, 2, 5), dtype=np.float32), np.eye(4)).to_filename(name_source)
+    (func_dir/'sub-01_task-rest_bold.json').write_text(json.dumps(
+        {'RepetitionTime': 1.0, 'SliceTiming': [0, 0.5], 'SliceEncodingDirection': 'k'}))
+    # slices along the superior-inferior axis cannot be corrected along the anterior-posterior axis
+    with pytest.raises(ValueError):
+        get_slice_timing('bids', 4, 1.0, name_source=name_source, bids_dir=str(bids_dir))
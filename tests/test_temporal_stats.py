@@ -0,0 +1,39 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from rabies.preprocess_pkg.utils import compute_temporal_stats
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 50, 200])
+@pytest.mark.parametrize('use_mask', [True, False])
+def test_temporal_stats_match_numpy(tmp_path, chunk_size, use_mask):
+    rng = np.random.default_rng(0)
+    shape = (6, 7, 5)
+    # a large baseline relative to the fluctuations, as in raw EPI, with a drift and a few zero voxels
+    baseline = rng.uniform(500, 2000, shape)
+    array = baseline[..., None]+rng.normal(0, 10, shape+(120,))+np.linspace(0, 20, 120)
+    array[0, 0, :] = 0
+    bold_file = str(tmp_path/'bold.nii.gz')
+    nb.Nifti1Image(array.astype(np.float32), np.eye(4)).to_filename(bold_file)
+    mask = rng.random(shape) < 0.5
+    if use_mask:
+        mask_file = str(tmp_path/'mask.nii.gz')
+        nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    else:
+        mask_file = None
+        mask = np.ones(shape, dtype=bool)
+
+    mean, std, tSNR, DVARS = compute_temporal_stats(bold_file, mask_file, chunk_size=chunk_size)
+
+    # reference computed in float64 on the full array, as the previous in-memory implementation
+    array = array.astype(np.float32).astype(np.float64)
+    assert np.allclose(mean, array.mean(axis=3), rtol=1e-6)
+    assert np.allclose(std, array.std(axis=3), rtol=1e-4, atol=1e-4)
+    nonzero = array.std(axis=3) > 0
+    assert np.allclose(tSNR[nonzero], array.mean(axis=3)[nonzero]/array.std(axis=3)[nonzero], rtol=1e-4)
+    assert np.all(tSNR[~nonzero] == 0)
+
+    expected_DVARS = np.concatenate([[0], np.sqrt((np.diff(array[mask], axis=1)**2).mean(axis=0))])
+    assert DVARS.shape == (120,)
+    assert np.allclose(DVARS, expected_DVARS, rtol=1e-5)